@@ -0,0 +1,97 @@
+from sqlalchemy import select, func, case, tuple_
+from sqlalchemy.orm import Session
+from datetime import datetime
+import base64
+import json
+import threading
+import time
+from models import User
+
+# Admin statistics shared by the JSON (/admin/) and HTML (/admin) views
+
+TOTALS_TTL_SECONDS = 30
+
+_totals_lock = threading.Lock()
+_totals_cache = {"expires": 0.0, "value": None}
+
+def encode_cursor(value, user_id: int) -> str:
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, user_id]).encode()).decode()
+
+def decode_cursor(cursor: str):
+    value, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return value, user_id
+
+def list_users(db: Session, limit: int = 50, sort: str = "id", order: str = "asc", cursor: str = None):
+    """One page of users with upload counts and storage, plus the cursor for the next page.
+
+    Counts are the maintained User.uploads_count and User.storage_used, so
+    no page aggregates uploads, and pages are addressed by keyset
+    (sort value, id) so deep pages cost the same as the first.
+    """
+    sort_columns = {
+        "id": User.id,
+        "username": User.username,
+        "created_at": User.created_at,
+        "uploads": User.uploads_count,
+        "storage": User.storage_used,
+    }
+    if sort not in sort_columns:
+        raise ValueError(f"Unknown sort {sort!r}")
+    sort_col = sort_columns[sort]
+
+    stmt = select(
+        User.id, User.username, User.email, User.is_premium, User.is_admin, User.created_at,
+        User.uploads_count, User.storage_used,
+    )
+    if cursor:
+        value, last_id = decode_cursor(cursor)
+        if sort == "created_at" and value is not None:
+            value = datetime.fromisoformat(value)
+        if sort == "id":
+            stmt = stmt.where(User.id > last_id if order == "asc" else User.id < last_id)
+        else:
+            key = tuple_(sort_col, User.id)
+            stmt = stmt.where(key > tuple_(value, last_id) if order == "asc" else key < tuple_(value, last_id))
+    if order == "asc":
+        stmt = stmt.order_by(sort_col.asc(), User.id.asc())
+    else:
+        stmt = stmt.order_by(sort_col.desc(), User.id.desc())
+
+    rows = db.execute(stmt.limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, sort_col.key), last.id)
+    return rows, next_cursor
+
+def site_totals(db: Session):
+    """Site-wide totals from the maintained counters, cached for TOTALS_TTL_SECONDS."""
+    now = time.monotonic()
+    with _totals_lock:
+        if _totals_cache["value"] is not None and _totals_cache["expires"] > now:
+            return _totals_cache["value"]
+    total_users, total_uploads, total_storage, premium_count = db.execute(
+        select(
+            func.count(User.id),
+            func.coalesce(func.sum(User.uploads_count), 0),
+            func.coalesce(func.sum(User.storage_used), 0),
+            func.coalesce(func.sum(case((User.is_premium == True, 1), else_=0)), 0),
+        )
+    ).one()
+    totals = {
+        "total_users": total_users,
+        "total_uploads": int(total_uploads),
+        "total_storage_gb": round(total_storage / (1024**3), 2),
+        "premium_count": int(premium_count),
+    }
+    with _totals_lock:
+        _totals_cache["value"] = totals
+        _totals_cache["expires"] = now + TOTALS_TTL_SECONDS
+    return totals
+
+def invalidate_totals():
+    with _totals_lock:
+        _totals_cache["expires"] = 0.0
@@ -0,0 +1,205 @@
+from sqlalchemy import insert, select, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from collections import deque, Counter
+from datetime import datetime
+import json
+import logging
+import threading
+import time
+from config import ANALYTICS_QUEUE_MAX, ANALYTICS_BATCH_SIZE, ANALYTICS_FLUSH_INTERVAL
+from database import SessionLocal
+from models import Analytics, AnalyticsHourly, AnalyticsDaily
+
+logger = logging.getLogger(__name__)
+
+ROLLUPS = {"hour": AnalyticsHourly, "day": AnalyticsDaily}
+
+def bucket_start(ts: datetime, granularity: str) -> datetime:
+    if granularity == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _upsert_counts(db: Session, model, counts: Counter):
+    rows = [{"user_id": u, "event_type": e, "bucket": b, "count": n} for (u, e, b), n in counts.items()]
+    dialect = db.bind.dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert_ = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        stmt = insert_(model).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["user_id", "event_type", "bucket"],
+            set_={"count": model.count + stmt.excluded["count"]},
+        )
+        db.execute(stmt)
+        return
+    for row in rows:
+        existing = db.get(model, (row["user_id"], row["event_type"], row["bucket"]))
+        if existing:
+            existing.count = model.count + row["count"]
+        else:
+            db.add(model(**row))
+
+def apply_rollups(db: Session, events):
+    """Fold a batch of Analytics rows into the hourly and daily rollups (caller commits)."""
+    for granularity, model in ROLLUPS.items():
+        counts = Counter(
+            (e["user_id"], e["event_type"], bucket_start(e["timestamp"], granularity))
+            for e in events if e["user_id"] is not None
+        )
+        if counts:
+            _upsert_counts(db, model, counts)
+
+def rebuild_rollups(db: Session, batch_size: int = 5000) -> int:
+    """Recompute both rollup tables from the raw analytics table."""
+    db.query(AnalyticsHourly).delete()
+    db.query(AnalyticsDaily).delete()
+    processed = 0
+    last_id = 0
+    while True:
+        rows = db.execute(
+            select(Analytics.id, Analytics.user_id, Analytics.event_type, Analytics.timestamp)
+            .where(Analytics.id > last_id)
+            .order_by(Analytics.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        apply_rollups(db, [
+            {"user_id": r.user_id, "event_type": r.event_type, "timestamp": r.timestamp}
+            for r in rows if r.timestamp is not None
+        ])
+        processed += len(rows)
+        last_id = rows[-1].id
+    db.commit()
+    return processed
+
+def query_rollups(db: Session, user_id: int, start: datetime, end: datetime, granularity: str):
+    """Per-event-type counts for [start, end) in hour or day buckets."""
+    model = ROLLUPS[granularity]
+    rows = db.execute(
+        select(model.event_type, model.bucket, model.count)
+        .where(model.user_id == user_id, model.bucket >= bucket_start(start, granularity), model.bucket < end)
+        .order_by(model.bucket)
+    ).all()
+    series = {}
+    for event_type, bucket, count in rows:
+        series.setdefault(event_type, []).append({"bucket": bucket.isoformat(), "count": count})
+    return series
+
+def event_totals(db: Session, user_id: int, since: datetime = None):
+    """Total events per type, summed from the daily rollup."""
+    stmt = select(AnalyticsDaily.event_type, func.sum(AnalyticsDaily.count)).where(AnalyticsDaily.user_id == user_id)
+    if since is not None:
+        stmt = stmt.where(AnalyticsDaily.bucket >= bucket_start(since, "day"))
+    return {event_type: int(total) for event_type, total in db.execute(stmt.group_by(AnalyticsDaily.event_type))}
+
+class AnalyticsQueue:
+    """In-process buffer for Analytics rows.
+
+    Request handlers call enqueue(), which never touches the database; a
+    background thread drains the buffer with multi-row INSERTs whenever it
+    holds batch_size events or flush_interval seconds have passed.
+    """
+
+    def __init__(self, max_size=ANALYTICS_QUEUE_MAX, batch_size=ANALYTICS_BATCH_SIZE, flush_interval=ANALYTICS_FLUSH_INTERVAL):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._events = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.flushes = 0
+        self.flush_seconds_total = 0.0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    def enqueue(self, user_id, event_type: str, details: dict = None):
+        event = {
+            "user_id": user_id,
+            "event_type": event_type,
+            "details": json.dumps(details or {}),
+            "timestamp": datetime.utcnow(),
+        }
+        with self._lock:
+            if len(self._events) >= self.max_size:
+                self.dropped += 1
+                return False
+            self._events.append(event)
+            self.enqueued += 1
+            depth = len(self._events)
+        if depth >= self.batch_size:
+            self._wake.set()
+        return True
+
+    def flush(self):
+        """Write everything currently queued, returning the number of rows written."""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._events.popleft() for _ in range(min(self.batch_size, len(self._events)))]
+                if not batch:
+                    break
+                started = time.perf_counter()
+                db = SessionLocal()
+                try:
+                    db.execute(insert(Analytics), batch)
+                    apply_rollups(db, batch)
+                    db.commit()
+                    written += len(batch)
+                except Exception:
+                    db.rollback()
+                    logger.exception("Dropping %d analytics events after failed flush", len(batch))
+                    with self._lock:
+                        self.dropped += len(batch)
+                finally:
+                    db.close()
+                elapsed = time.perf_counter() - started
+                self.flushes += 1
+                self.flush_seconds_total += elapsed
+                self.last_flush_seconds = elapsed
+                self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.written += written
+        return written
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def start(self):
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="analytics-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        # Drain whatever is left so a graceful shutdown loses nothing
+        if self._thread is not None:
+            self._stopping = True
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        return {
+            "depth": len(self._events),
+            "max_size": self.max_size,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "last_flush_ms": round(self.last_flush_seconds * 1000, 3),
+            "max_flush_ms": round(self.max_flush_seconds * 1000, 3),
+            "avg_flush_ms": round(self.flush_seconds_total * 1000 / self.flushes, 3) if self.flushes else 0.0,
+        }
+
+analytics_queue = AnalyticsQueue()
@@ -1,26 +1,26 @@
-from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, FileResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from slowapi.errors import RateLimitExceeded
-from slowapi import _rate_limit_exceeded_handler
-from database import Base, get_db
-import models  # Import after Base
 from middleware import AnalyticsMiddleware
-from utils import limiter
-from config import templates
+from metrics import MetricsMiddleware, metrics_exporter
+from analytics import analytics_queue
+from maintenance import maintenance
+from media import media_worker
+from events import event_hub
+from ratelimit import RateLimitHeadersMiddleware
+from config import templates, METRICS_TOKEN
 from routes.auth import router as auth_router
 from routes.api import router as api_router
+from routes.multipart import router as multipart_router
+from routes.batch import router as batch_router
 from routes.admin import router as admin_router
 from routes.frontend import router as frontend_router
+from routes.ws import router as ws_router
 
 # FastAPI app
 app = FastAPI(title="DataForge API")
 
-# Rate limiting
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -32,32 +32,60 @@ app.add_middleware(
 
 # Static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
 # Apply middleware
 app.add_middleware(AnalyticsMiddleware)  # Correctly register the middleware
+app.add_middleware(RateLimitHeadersMiddleware)
+app.add_middleware(MetricsMiddleware)  # outermost, so its timings cover everything else
 
 # Include routers
 app.include_router(auth_router, prefix="/auth")
 app.include_router(api_router, prefix="/api")
+app.include_router(multipart_router, prefix="/api/upload")
+app.include_router(batch_router, prefix="/api")
 app.include_router(admin_router, prefix="/admin")
 app.include_router(frontend_router)
-
-# WebSocket for real-time logs
-@app.websocket("/ws/logs")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    try:
-        while True:
-            data = await websocket.receive_text()
-            await websocket.send_text(f"Real-time log: {data} at {datetime.now()}")
-    except WebSocketDisconnect:
-        pass
+app.include_router(ws_router)
 
 # Startup
+# The schema is managed by migrations/, applied before the workers start
+# (gunicorn.conf.py; `python manage.py migrate` when running uvicorn directly),
+# so nothing here creates or inspects it.
+@app.on_event("startup")
+def start_analytics_writer():
+    analytics_queue.start()
+
+@app.on_event("shutdown")
+def stop_analytics_writer():
+    analytics_queue.stop()
+
+@app.on_event("startup")
+def start_metrics_exporter():
+    metrics_exporter.start()
+
+@app.on_event("shutdown")
+def stop_metrics_exporter():
+    metrics_exporter.stop()
+
+@app.on_event("startup")
+def start_maintenance():
+    maintenance.start()
+
+@app.on_event("shutdown")
+def stop_maintenance():
+    maintenance.stop()
+
 @app.on_event("startup")
-def startup():
-    Base.metadata.create_all(bind=engine)
+def start_media_worker():
+    media_worker.start()
+
+@app.on_event("shutdown")
+def stop_media_worker():
+    media_worker.stop()
+
+@app.on_event("shutdown")
+def stop_event_hub():
+    event_hub.stop()
 
 # Root for health
 @app.get("/")
@@ -67,3 +95,9 @@ async def root(request: Request):
 @app.get("/health")
 def health():
     return {"status": "healthy"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        return PlainTextResponse("Unauthorized\n", status_code=401)
+    return PlainTextResponse(metrics_exporter.collect(), media_type="text/plain; version=0.0.4; charset=utf-8")
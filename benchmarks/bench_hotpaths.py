@@ -0,0 +1,316 @@
+"""Load test for the main request paths, run in-process against a throwaway database.
+
+Drives the FastAPI app through httpx's ASGI transport (one process, one event
+loop: the numbers describe a single gunicorn worker) with a temp uploads/
+directory and a fresh SQLite file, or any DATABASE_URL given with --database-url
+(its tables are created and dropped, so point it at a scratch database).
+
+    python benchmarks/bench_hotpaths.py                                # all scenarios
+    python benchmarks/bench_hotpaths.py -s upload_file -s share -c 32 -n 500
+    python benchmarks/bench_hotpaths.py --output results.json --baseline benchmarks/baseline.json
+    python benchmarks/bench_hotpaths.py --save-baseline benchmarks/baseline.json
+
+httpx's ASGI transport buffers whole response bodies, so peak RSS for the
+streaming paths (export, large share fetches) includes the client's copy.
+
+Each scenario reports throughput, p50/p95/p99 latency, error count and peak
+RSS. With --baseline, a scenario whose p95 grew or whose throughput fell by
+more than --tolerance is reported as a regression and the exit status is 1.
+Baselines are machine-specific: regenerate the stored one on the machine
+that runs the comparison.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCENARIOS = ["signup", "login", "upload_text", "upload_file", "read_v2", "share", "export", "admin"]
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))] if values else 0.0
+
+def rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+class RssSampler:
+    """Peak resident set size while a scenario runs, sampled every 20 ms."""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, rss_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = rss_bytes()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+def prepare_environment(args):
+    """chdir into a scratch directory and point the app's settings at it (before the app is imported)."""
+    work = tempfile.mkdtemp(prefix="dataforge-bench-")
+    for name in ("templates", "static"):
+        os.symlink(os.path.join(ROOT, name), os.path.join(work, name))
+    os.chdir(work)
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{work}/bench.db"
+    os.environ["SHARED_STATE_PATH"] = os.path.join(work, "state.db")
+    os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    os.environ.setdefault("MAINTENANCE_ENABLED", "false")
+    return work
+
+def seed(args):
+    """Users with tokens, API keys and a few uploads each; one of them is an admin."""
+    import models
+    from database import SessionLocal, engine
+    from storage import create_upload, temp_path, copy_stream
+    from utils import create_access_token, get_password_hash
+    from sqlalchemy import text
+    import migrations
+    import io
+
+    models.Base.metadata.drop_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS schema_migrations"))
+        conn.execute(text("DROP TABLE IF EXISTS uploads_fts"))
+    migrations.migrate(engine)
+    password_hash = get_password_hash("bench-password")
+    db = SessionLocal()
+    users, shares, uploads = [], [], {}
+    try:
+        for i in range(args.users):
+            user = models.User(
+                name=f"Bench {i}", username=f"bench{i}", email=f"bench{i}@example.com",
+                password_hash=password_hash, api_key=str(uuid.uuid4()), is_admin=(i == 0),
+            )
+            db.add(user)
+            db.commit()
+            users.append({
+                "username": user.username,
+                "api_key": user.api_key,
+                "token": create_access_token(data={"sub": user.username}),
+            })
+            uploads[user.username] = []
+            for j in range(args.seed_uploads):
+                if j % 2:
+                    upload = create_upload(db, user, "text", content=f"seed note {i}-{j} " * 20)
+                else:
+                    tmp = temp_path()
+                    size, sha256 = copy_stream(io.BytesIO(os.urandom(args.seed_file_size)), tmp)
+                    upload = create_upload(db, user, "document", tmp=tmp, size_bytes=size, sha256=sha256,
+                                           filename=f"seed-{j}.bin", share=True, ttl_hours=24)
+                    shares.append(f"/api/share/{upload.id}?token={upload.share_links[0].token}")
+                uploads[user.username].append(upload.id)
+    finally:
+        db.close()
+    return {"users": users, "shares": shares, "uploads": uploads}
+
+def make_requests(ctx, args):
+    """Scenario name -> coroutine function (client, i) -> response."""
+    users, shares, uploads = ctx["users"], ctx["shares"], ctx["uploads"]
+    file_body = os.urandom(args.file_size)
+    run_id = uuid.uuid4().hex[:8]
+
+    def user(i):
+        return users[i % len(users)]
+
+    def bearer(token):
+        return {"Authorization": f"Bearer {token}"}
+
+    async def signup(client, i):
+        name = f"new{uuid.uuid4().hex[:12]}"
+        return await client.post("/auth/signup", json={"name": name, "username": name, "email": f"{name}@example.com", "password": "bench-password"})
+
+    async def login(client, i):
+        return await client.post("/auth/login", json={"username": user(i)["username"], "password": "bench-password"})
+
+    async def upload_text(client, i):
+        return await client.post("/api/upload", data={"type": "text", "content": f"note {i} " * 100}, headers=bearer(user(i)["token"]))
+
+    async def upload_file(client, i):
+        # A distinct prefix per request so blob de-duplication doesn't flatter the numbers
+        body = i.to_bytes(8, "big") + run_id.encode() + file_body
+        return await client.post(
+            "/api/upload", data={"type": "document", "share": "true"},
+            files={"file": (f"bench-{i}.bin", body, "application/octet-stream")}, headers=bearer(user(i)["token"]),
+        )
+
+    async def read_v2(client, i):
+        u = user(i)
+        ids = uploads[u["username"]]
+        return await client.get(f"/api/v2/{u['username']}", params={"uploads": ids[i % len(ids)]}, headers=bearer(u["api_key"]))
+
+    async def share(client, i):
+        return await client.get(shares[i % len(shares)])
+
+    async def export(client, i):
+        return await client.get("/api/export", headers=bearer(user(i)["token"]))
+
+    async def admin(client, i):
+        return await client.get("/admin/", params={"limit": 50}, headers=bearer(users[0]["token"]))
+
+    return {
+        "signup": signup, "login": login, "upload_text": upload_text, "upload_file": upload_file,
+        "read_v2": read_v2, "share": share, "export": export, "admin": admin,
+    }
+
+async def run_scenario(client, request, requests: int, concurrency: int):
+    latencies, errors = [], []
+    queue = iter(range(requests))
+
+    async def worker():
+        for i in queue:
+            started = time.perf_counter()
+            try:
+                response = await request(client, i)
+                await response.aread()
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+            except Exception as e:
+                errors.append(type(e).__name__)
+            latencies.append(time.perf_counter() - started)
+
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "error_samples": sorted({str(e) for e in errors})[:5],
+        "throughput_rps": round(requests / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2) if latencies else 0.0,
+        "peak_rss_mb": round(rss.peak / (1 << 20), 1),
+    }
+
+async def run_all(args, scenarios):
+    import httpx
+    from app import app
+    from ratelimit import rate_limiter
+
+    # Per-IP and per-user limits would otherwise throttle the simulated clients
+    rate_limiter.enabled = args.keep_rate_limits
+    ctx = seed(args)
+    requests = make_requests(ctx, args)
+    results = {}
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for name in scenarios:
+                count = args.requests if name not in ("signup", "login", "export") else max(args.requests // 10, args.concurrency)
+                await run_scenario(client, requests[name], min(args.warmup, count), args.concurrency)
+                results[name] = await run_scenario(client, requests[name], count, args.concurrency)
+                print(f"{name:12} {json.dumps(results[name])}", flush=True)
+    return results
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """Scenarios that got slower (p95) or lost throughput by more than tolerance, or started failing."""
+    regressions = []
+    for name, current in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95_ms']} ms -> {current['p95_ms']} ms")
+        if current["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {base['throughput_rps']} -> {current['throughput_rps']} req/s")
+        if current["errors"] > base["errors"]:
+            regressions.append(f"{name}: errors {base['errors']} -> {current['errors']}")
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-s", "--scenario", action="append", choices=SCENARIOS, help="Run only these (repeatable)")
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("-n", "--requests", type=int, default=200, help="Requests per scenario (signup/login/export run a tenth)")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--seed-uploads", type=int, default=6, help="Uploads created per user before the run")
+    parser.add_argument("--seed-file-size", type=int, default=64 * 1024)
+    parser.add_argument("--file-size", type=int, default=4 * 1024 * 1024, help="Body size for upload_file")
+    parser.add_argument("--bcrypt-rounds", type=int, default=int(os.getenv("BCRYPT_ROUNDS", 12)))
+    parser.add_argument("--database-url", help="Scratch database to use instead of a temp SQLite file (tables are dropped)")
+    parser.add_argument("--keep-rate-limits", action="store_true")
+    parser.add_argument("--output", help="Write results as JSON")
+    parser.add_argument("--baseline", help="Compare against this results file")
+    parser.add_argument("--save-baseline", help="Write results to this file as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative change before flagging a regression")
+    args = parser.parse_args()
+
+    # Resolve output paths before prepare_environment changes directory
+    for attr in ("output", "baseline", "save_baseline"):
+        if getattr(args, attr):
+            setattr(args, attr, os.path.abspath(getattr(args, attr)))
+    work = prepare_environment(args)
+    try:
+        scenarios = args.scenario or SCENARIOS
+        started = datetime.utcnow()
+        scenario_results = asyncio.run(run_all(args, scenarios))
+        results = {
+            "meta": {
+                "started_at": started.isoformat(),
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "database": os.environ["DATABASE_URL"].split("://", 1)[0],
+                "concurrency": args.concurrency,
+                "requests": args.requests,
+                "file_size": args.file_size,
+                "bcrypt_rounds": args.bcrypt_rounds,
+                "process_max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            },
+            "scenarios": scenario_results,
+        }
+        for path in filter(None, (args.output, args.save_baseline)):
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+                f.write("\n")
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare(results, json.load(f), args.tolerance)
+            if regressions:
+                print("Regressions against baseline:")
+                for line in regressions:
+                    print(f"  {line}")
+                sys.exit(1)
+            print("No regressions against baseline")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Login latency and event-loop lag under concurrent load.
+
+Compares bcrypt run inline on the event loop (the old behaviour) with the
+bounded hashing pool used by the login routes now:
+
+    python benchmarks/bench_login.py --concurrency 32 --rounds 12
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+async def measure_lag(stop: asyncio.Event, samples: list, interval=0.005):
+    # How late does a 5 ms timer fire? Anything above zero is time the loop was blocked.
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - started - interval)
+
+async def run(mode: str, concurrency: int, accounts: list, requests: int):
+    import utils
+
+    async def inline_login(password, hashed):
+        return utils.verify_password(password, hashed)
+
+    async def pooled_login(password, hashed):
+        return await utils.verify_password_async(password, hashed)
+
+    login = inline_login if mode == "inline" else pooled_login
+    latencies, lag = [], []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_lag(stop, lag))
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with sem:
+            assert await login(*accounts[i % len(accounts)])
+        # Measured from when the burst was issued, as a client would see it
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await lag_task
+    return {
+        "mode": mode,
+        "requests": requests,
+        "throughput_rps": round(requests / elapsed, 1),
+        "login_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "login_p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "loop_lag_p99_ms": round(percentile(lag, 99) * 1000, 1) if lag else None,
+        "loop_lag_max_ms": round(max(lag) * 1000, 1) if lag else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=int(os.getenv("BCRYPT_ROUNDS", 12)))
+    args = parser.parse_args()
+    os.environ["BCRYPT_ROUNDS"] = str(args.rounds)
+    os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+    import utils
+    # One account per request so request coalescing doesn't flatter the pooled numbers
+    accounts = []
+    for i in range(args.requests):
+        password = f"password-{i}"
+        accounts.append((password, utils.get_password_hash(password)))
+    for mode in ("inline", "pool"):
+        print(asyncio.run(run(mode, args.concurrency, accounts, args.requests)))
+
+if __name__ == "__main__":
+    main()
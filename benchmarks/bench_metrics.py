@@ -0,0 +1,102 @@
+"""Overhead of the metrics instrumentation.
+
+Times the same requests through an app with and without MetricsMiddleware,
+and the cost of the SQLAlchemy cursor hooks per query:
+
+    python benchmarks/bench_metrics.py --requests 5000
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+def build_app(instrumented: bool):
+    from fastapi import FastAPI
+    from metrics import MetricsMiddleware
+
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int):
+        return {"id": item_id}
+
+    if instrumented:
+        app.add_middleware(MetricsMiddleware)
+    return app
+
+async def time_requests(app, requests: int):
+    import httpx
+
+    latencies = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        for i in range(200):  # warm-up
+            await client.get(f"/items/{i}")
+        for i in range(requests):
+            started = time.perf_counter()
+            await client.get(f"/items/{i}")
+            latencies.append(time.perf_counter() - started)
+    return latencies
+
+def time_queries(queries: int, hooked: bool):
+    from sqlalchemy import create_engine, event, text
+    from sqlalchemy.engine import Engine
+    import metrics
+
+    if not hooked:
+        event.remove(Engine, "before_cursor_execute", metrics._before_cursor_execute)
+        event.remove(Engine, "after_cursor_execute", metrics._after_cursor_execute)
+    engine = create_engine("sqlite://")
+    try:
+        with engine.connect() as conn:
+            started = time.perf_counter()
+            for _ in range(queries):
+                conn.execute(text("SELECT 1")).scalar()
+            return (time.perf_counter() - started) / queries
+    finally:
+        if not hooked:
+            event.listen(Engine, "before_cursor_execute", metrics._before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", metrics._after_cursor_execute)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=20000)
+    args = parser.parse_args()
+    os.environ.setdefault("DATABASE_URL", "sqlite://")
+    os.environ.setdefault("SHARED_STATE_PATH", os.path.join(tempfile.mkdtemp(), "state.db"))
+
+    results = {}
+    for instrumented in (False, True):
+        latencies = asyncio.run(time_requests(build_app(instrumented), args.requests))
+        results[instrumented] = latencies
+        print({
+            "middleware": instrumented,
+            "requests": args.requests,
+            "mean_us": round(statistics.mean(latencies) * 1e6, 1),
+            "p50_us": round(percentile(latencies, 50) * 1e6, 1),
+            "p99_us": round(percentile(latencies, 99) * 1e6, 1),
+        })
+    overhead = statistics.mean(results[True]) - statistics.mean(results[False])
+    print({"middleware_overhead_us_per_request": round(overhead * 1e6, 1)})
+
+    plain = time_queries(args.queries, hooked=False)
+    hooked = time_queries(args.queries, hooked=True)
+    print({"query_us_plain": round(plain * 1e6, 2), "query_us_hooked": round(hooked * 1e6, 2),
+           "hook_overhead_us_per_query": round((hooked - plain) * 1e6, 2)})
+
+    from metrics import snapshot, merge, render
+    started = time.perf_counter()
+    body = render(merge([snapshot()] * 4), workers=4)
+    print({"render_4_workers_ms": round((time.perf_counter() - started) * 1000, 2), "bytes": len(body)})
+
+if __name__ == "__main__":
+    main()
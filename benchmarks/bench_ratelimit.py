@@ -0,0 +1,175 @@
+"""Overhead of rate limiting.
+
+Times a bucket take on each backend, the same takes from several processes
+sharing one store (as gunicorn workers do), and requests through an app with
+and without a limit_user dependency, alone and then concurrently while other
+processes write to the same store (with the worst event loop stall, against
+the same take made on the loop):
+
+    python benchmarks/bench_ratelimit.py --requests 5000 --processes 4
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+def time_takes(backend, takes: int, keys: int):
+    latencies = []
+    for i in range(takes):
+        started = time.perf_counter()
+        backend.take_tokens(f"rl:bench:{i % keys}", 1e9, 1e9)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+def _contend(takes: int, keys: int, results):
+    from shared_state import SharedStore
+    store = SharedStore()
+    started = time.perf_counter()
+    for i in range(takes):
+        store.take_tokens(f"rl:contend:{i % keys}", 1e9, 1e9)
+    results.put(time.perf_counter() - started)
+
+def contended(processes: int, takes: int, keys: int) -> dict:
+    """Every process taking from the same keys at once: SQLite serializes the writes."""
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_contend, args=(takes, keys, results)) for _ in range(processes)]
+    started = time.perf_counter()
+    for p in procs:
+        p.start()
+    elapsed = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    return {
+        "processes": processes,
+        "keys": keys,
+        "takes_per_s": round(processes * takes / max(elapsed), 0),
+        "mean_us": round(statistics.mean(elapsed) / takes * 1e6, 1),
+        "wall_s": round(time.perf_counter() - started, 2),
+    }
+
+def build_app(mode: str):
+    """mode: "none" (no limit), "limit_user" (the app's dependency) or "on_loop" (the
+    same take from an async dependency, i.e. on the event loop, for comparison)."""
+    from fastapi import FastAPI, Depends, Request
+    from ratelimit import limit_user, rate_limiter, plan_limit
+
+    class Principal:
+        id = 1
+        is_premium = True
+
+    def auth():
+        return Principal()
+
+    async def on_loop(request: Request, user=Depends(auth)):
+        rate_limiter.hit(request, "api", user.id, plan_limit("api", user))
+
+    app = FastAPI()
+    dependencies = {"none": [], "limit_user": [limit_user(auth)], "on_loop": [Depends(on_loop)]}[mode]
+
+    @app.get("/items/{item_id}", dependencies=dependencies)
+    async def item(item_id: int, user=Depends(auth)):
+        return {"id": item_id}
+
+    return app
+
+async def time_requests(app, requests: int, concurrency: int = 1):
+    """Per-request latencies, plus the event loop's worst stall while they ran."""
+    import httpx
+
+    latencies = []
+    stalls = [0.0]
+    done = asyncio.Event()
+
+    async def probe():
+        # A 1 ms sleep that wakes late measures how long something held the loop
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stalls[0] = max(stalls[0], time.perf_counter() - started - 0.001)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        for i in range(200):  # warm-up
+            await client.get(f"/items/{i}")
+        counter = iter(range(requests))
+
+        async def worker():
+            for i in counter:
+                started = time.perf_counter()
+                await client.get(f"/items/{i}")
+                latencies.append(time.perf_counter() - started)
+
+        prober = asyncio.ensure_future(probe())
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await prober
+    return latencies, elapsed, stalls[0]
+
+def summary(latencies) -> dict:
+    return {
+        "mean_us": round(statistics.mean(latencies) * 1e6, 1),
+        "p50_us": round(percentile(latencies, 50) * 1e6, 1),
+        "p99_us": round(percentile(latencies, 99) * 1e6, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--takes", type=int, default=20000)
+    parser.add_argument("--keys", type=int, default=1000, help="Distinct buckets taken from in turn")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=32, help="Requests in flight for the under-load run")
+    args = parser.parse_args()
+    os.environ.setdefault("DATABASE_URL", "sqlite://")
+    os.environ.setdefault("SHARED_STATE_PATH", os.path.join(tempfile.mkdtemp(), "state.db"))
+    os.environ["RATE_LIMIT_PREMIUM"] = "1000000000/second"  # measure the check, never reject
+
+    from ratelimit import MemoryBuckets
+    from shared_state import SharedStore
+    for name, backend in (("memory", MemoryBuckets()), ("shared", SharedStore())):
+        print({"backend": name, "takes": args.takes, **summary(time_takes(backend, args.takes, args.keys))})
+
+    for keys in (1, args.keys):
+        print(contended(args.processes, args.takes // args.processes, keys))
+
+    results = {}
+    for mode in ("none", "limit_user"):
+        latencies, _, _ = asyncio.run(time_requests(build_app(mode), args.requests))
+        results[mode] = latencies
+        print({"mode": mode, "requests": args.requests, **summary(latencies)})
+    overhead = statistics.mean(results["limit_user"]) - statistics.mean(results["none"])
+    print({"rate_limit_overhead_us_per_request": round(overhead * 1e6, 1)})
+
+    # Under load: --concurrency requests in flight while --processes - 1 other
+    # "workers" write to the same store, so takes wait on SQLite's write lock
+    ctx = multiprocessing.get_context("spawn")
+    for mode in ("on_loop", "limit_user"):
+        sink = ctx.Queue()
+        others = [ctx.Process(target=_contend, args=(args.takes, 1, sink)) for _ in range(args.processes - 1)]
+        for p in others:
+            p.start()
+        time.sleep(1)  # let them get going (spawn imports)
+        latencies, elapsed, stall = asyncio.run(time_requests(build_app(mode), args.requests, args.concurrency))
+        for p in others:
+            p.terminate()
+            p.join()
+        print({
+            "mode": mode, "concurrency": args.concurrency, "contending_processes": len(others),
+            "rps": round(len(latencies) / elapsed), **summary(latencies),
+            "max_loop_stall_ms": round(stall * 1e3, 1),
+        })
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Cold-start time: schema migrations and worker boot.
+
+Times `manage.py migrate` on a new database and on an up-to-date one (the
+cost of every deploy with nothing pending), then boots --workers app
+processes at once, as gunicorn does, in two modes:
+
+    create_all   each worker creates/inspects the schema at startup (the old behaviour)
+    migrated     the schema was migrated beforehand; workers do no schema work
+
+Each worker imports the app, runs its startup hooks and answers /health.
+
+    python benchmarks/bench_startup.py --workers 4
+    python benchmarks/bench_startup.py --database-url postgresql://.../scratch
+
+With --database-url the tables in that database are dropped first, so point
+it at a scratch database.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def child(mode: str):
+    started = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    from fastapi.testclient import TestClient
+    from app import app
+    imported = time.perf_counter()
+    if mode == "create_all":
+        from database import Base, engine
+        from search import ensure_sqlite_index
+        Base.metadata.create_all(bind=engine)
+        ensure_sqlite_index(engine)
+    schema = time.perf_counter()
+    with TestClient(app) as client:
+        client.get("/health").raise_for_status()
+    ready = time.perf_counter()
+    print(json.dumps({"import_s": imported - started, "schema_s": schema - imported, "ready_s": ready - started}))
+
+def reset_database(env):
+    code = (
+        "import sys; sys.path.insert(0, %r)\n"
+        "from sqlalchemy import text\n"
+        "from database import Base, engine\n"
+        "import models\n"
+        "Base.metadata.drop_all(bind=engine)\n"
+        "with engine.begin() as conn:\n"
+        "    conn.execute(text('DROP TABLE IF EXISTS schema_migrations'))\n"
+        "    conn.execute(text('DROP TABLE IF EXISTS uploads_fts'))\n"
+    ) % ROOT
+    subprocess.run([sys.executable, "-c", code], env=env, check=True)
+
+def timed_migrate(env) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(ROOT, "manage.py"), "migrate"], env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+def boot_workers(env, mode: str, workers: int) -> dict:
+    started = time.perf_counter()
+    procs = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", mode], env=env, stdout=subprocess.PIPE)
+        for _ in range(workers)
+    ]
+    results = []
+    for proc in procs:
+        out, _ = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(f"{mode} worker failed (exit {proc.returncode})")
+        results.append(json.loads(out.decode().strip().splitlines()[-1]))
+    wall = time.perf_counter() - started
+    return {
+        "mode": mode,
+        "workers": workers,
+        "all_ready_s": round(wall, 3),
+        "worker_ready_mean_s": round(statistics.mean(r["ready_s"] for r in results), 3),
+        "schema_mean_s": round(statistics.mean(r["schema_s"] for r in results), 4),
+        "import_mean_s": round(statistics.mean(r["import_s"] for r in results), 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--database-url")
+    parser.add_argument("--child", choices=["create_all", "migrated"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    work = tempfile.mkdtemp(prefix="dataforge-startup-")
+    os.makedirs(os.path.join(work, "uploads"), exist_ok=True)
+    for name in ("static", "templates"):
+        os.symlink(os.path.join(ROOT, name), os.path.join(work, name))
+    os.chdir(work)
+    env = dict(
+        os.environ,
+        DATABASE_URL=args.database_url or f"sqlite:///{work}/bench.db",
+        SHARED_STATE_PATH=os.path.join(work, "state.db"),
+        MAINTENANCE_ENABLED="false",
+        MEDIA_ENABLED="false",
+        METRICS_ENABLED="false",
+    )
+
+    reset_database(env)
+    print({"migrate_new_database_s": round(timed_migrate(env), 3)})
+    print({"migrate_up_to_date_s": round(timed_migrate(env), 3)})
+    for mode in ("create_all", "migrated"):
+        runs = [boot_workers(env, mode, args.workers) for _ in range(args.rounds)]
+        best = min(runs, key=lambda r: r["all_ready_s"])
+        print(best)
+
+if __name__ == "__main__":
+    main()
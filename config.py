@@ -1,8 +1,155 @@
 from fastapi.templating import Jinja2Templates
 import os
+import tempfile
 
 # Templates
 templates = Jinja2Templates(directory="templates")
 
 # Ensure uploads directory exists
 os.makedirs("uploads", exist_ok=True)
+
+# Uploads are copied to disk in chunks of this size so memory use stays flat
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+
+# Where stored files live (filestore.py): "local" shards them under STORAGE_LOCAL_ROOT,
+# "s3" puts them in an S3-compatible bucket (needs boto3; credentials from AWS_* variables).
+# STORAGE_READ_FALLBACK names a second backend to read from while migrating between them.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+STORAGE_LOCAL_ROOT = os.getenv("STORAGE_LOCAL_ROOT", "uploads")
+STORAGE_READ_FALLBACK = os.getenv("STORAGE_READ_FALLBACK", "")
+STORAGE_S3_BUCKET = os.getenv("STORAGE_S3_BUCKET", "")
+STORAGE_S3_PREFIX = os.getenv("STORAGE_S3_PREFIX", "")
+STORAGE_S3_ENDPOINT_URL = os.getenv("STORAGE_S3_ENDPOINT_URL", "")  # e.g. http://localhost:9000 for MinIO
+STORAGE_S3_REGION = os.getenv("STORAGE_S3_REGION", "")
+
+# Resumable multipart uploads
+MULTIPART_MAX_PART_SIZE = int(os.getenv("MULTIPART_MAX_PART_SIZE", 64 * 1024 * 1024))
+UPLOAD_SESSION_TTL_HOURS = int(os.getenv("UPLOAD_SESSION_TTL_HOURS", 24))
+
+# Batch endpoints (routes/batch.py)
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 1000))  # items per POST /api/upload/batch
+BATCH_MAX_FETCH_IDS = int(os.getenv("BATCH_MAX_FETCH_IDS", 1000))  # ids per /api/uploads/batch
+BATCH_MAX_LINE_BYTES = int(os.getenv("BATCH_MAX_LINE_BYTES", 32 * 1024 * 1024))  # one NDJSON item, base64 included
+
+# Analytics events are queued in memory and written in batches by a background thread
+ANALYTICS_QUEUE_MAX = int(os.getenv("ANALYTICS_QUEUE_MAX", 10000))
+ANALYTICS_BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", 500))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", 2.0))
+
+# State shared between the gunicorn workers on this host (a SQLite file, ideally on tmpfs)
+SHARED_STATE_PATH = os.getenv(
+    "SHARED_STATE_PATH",
+    "/dev/shm/dataforge-state.db" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "dataforge-state.db")
+)
+
+# Schema migrations (migrations/) run once per deploy, before the workers start
+# (gunicorn.conf.py; MIGRATE_ON_START=false to run `manage.py migrate` separately);
+# this lock keeps two runners on one host from overlapping
+MIGRATIONS_LOCK_PATH = os.getenv("MIGRATIONS_LOCK_PATH", os.path.join(os.path.dirname(SHARED_STATE_PATH), "dataforge-migrations.lock"))
+
+# Authenticated-principal cache: "memory" (per worker) or "shared" (SHARED_STATE_PATH)
+PRINCIPAL_CACHE_BACKEND = os.getenv("PRINCIPAL_CACHE_BACKEND", "memory")
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", 60))
+
+# Public share links (shares.py): resolved shares are cached per worker, unknown
+# tokens are remembered so repeats never reach the database, and clients that keep
+# guessing are cut off after SHARE_MAX_MISSES_PER_IP misses
+SHARE_CACHE_SIZE = int(os.getenv("SHARE_CACHE_SIZE", 10000))
+SHARE_CACHE_TTL = float(os.getenv("SHARE_CACHE_TTL", 30))
+SHARE_NEGATIVE_CACHE_SIZE = int(os.getenv("SHARE_NEGATIVE_CACHE_SIZE", 100000))
+SHARE_NEGATIVE_CACHE_TTL = float(os.getenv("SHARE_NEGATIVE_CACHE_TTL", 300))
+SHARE_MAX_MISSES_PER_IP = int(os.getenv("SHARE_MAX_MISSES_PER_IP", 20))
+SHARE_MISS_WINDOW = float(os.getenv("SHARE_MISS_WINDOW", 60))
+SHARE_RATE_LIMIT = os.getenv("SHARE_RATE_LIMIT", "300/minute")  # per client IP
+SHARE_TOKEN_RATE_LIMIT = os.getenv("SHARE_TOKEN_RATE_LIMIT", "1200/minute")  # per share token
+
+# Rate limits (ratelimit.py): token buckets, "shared" between workers through
+# SHARED_STATE_PATH or per-worker "memory". A limit "<n>/<second|minute|hour|day>"
+# allows bursts of n and refills at n per period. API and upload limits are per
+# user, by plan; the rest are per client IP.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "shared")
+RATE_LIMIT_FREE = os.getenv("RATE_LIMIT_FREE", "300/minute")
+RATE_LIMIT_PREMIUM = os.getenv("RATE_LIMIT_PREMIUM", "3000/minute")
+UPLOAD_RATE_LIMIT_FREE = os.getenv("UPLOAD_RATE_LIMIT_FREE", "30/minute")
+UPLOAD_RATE_LIMIT_PREMIUM = os.getenv("UPLOAD_RATE_LIMIT_PREMIUM", "600/minute")
+SIGNUP_RATE_LIMIT = os.getenv("SIGNUP_RATE_LIMIT", "5/minute")
+LOGIN_RATE_LIMIT = os.getenv("LOGIN_RATE_LIMIT", "10/minute")
+
+# Metrics (metrics.py): each worker keeps its own in memory and publishes a
+# snapshot to the shared store every METRICS_FLUSH_INTERVAL seconds; /metrics
+# sums the snapshots of all workers on the host
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 5))
+METRICS_LOOP_LAG_INTERVAL = float(os.getenv("METRICS_LOOP_LAG_INTERVAL", 0.5))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # if set, /metrics requires "Authorization: Bearer <token>"
+
+# Deferred exports are kept on disk for this long after they finish
+EXPORT_TTL_HOURS = int(os.getenv("EXPORT_TTL_HOURS", 24))
+
+# Cache-Control max-age (seconds) for served upload files, per upload type.
+# Upload bytes never change once written, so long lifetimes are safe.
+FILE_CACHE_MAX_AGE = {
+    "image": int(os.getenv("FILE_CACHE_MAX_AGE_IMAGE", 7 * 24 * 3600)),
+    "video": int(os.getenv("FILE_CACHE_MAX_AGE_VIDEO", 7 * 24 * 3600)),
+    "document": int(os.getenv("FILE_CACHE_MAX_AGE_DOCUMENT", 3600)),
+    "default": int(os.getenv("FILE_CACHE_MAX_AGE_DEFAULT", 3600)),
+}
+
+# Background maintenance (maintenance.py). One gunicorn worker per host holds
+# MAINTENANCE_LOCK_PATH and runs the jobs; the others stay on standby.
+MAINTENANCE_ENABLED = os.getenv("MAINTENANCE_ENABLED", "true").lower() in ("1", "true", "yes")
+MAINTENANCE_DRY_RUN = os.getenv("MAINTENANCE_DRY_RUN", "false").lower() in ("1", "true", "yes")
+MAINTENANCE_LOCK_PATH = os.getenv("MAINTENANCE_LOCK_PATH", os.path.join(os.path.dirname(SHARED_STATE_PATH), "dataforge-maintenance.lock"))
+MAINTENANCE_INTERVAL = int(os.getenv("MAINTENANCE_INTERVAL", 600))  # sweeps and deletions
+MAINTENANCE_SCAN_INTERVAL = int(os.getenv("MAINTENANCE_SCAN_INTERVAL", 6 * 3600))  # full orphan/missing-file scans
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", 500))
+MAINTENANCE_BATCH_PAUSE = float(os.getenv("MAINTENANCE_BATCH_PAUSE", 0.2))  # seconds between batches
+MAINTENANCE_ORPHAN_GRACE = int(os.getenv("MAINTENANCE_ORPHAN_GRACE", 3600))  # younger files may belong to in-flight uploads
+MAINTENANCE_RUN_RETENTION_DAYS = int(os.getenv("MAINTENANCE_RUN_RETENTION_DAYS", 30))
+
+# Post-upload media processing (media.py): thumbnails, resized variants and
+# metadata, produced by a process pool in the gunicorn worker holding MEDIA_LOCK_PATH.
+# Pillow is needed for image variants and ffmpeg on PATH for video posters;
+# without them only metadata that can be read from the file headers is extracted.
+MEDIA_ENABLED = os.getenv("MEDIA_ENABLED", "true").lower() in ("1", "true", "yes")
+MEDIA_LOCK_PATH = os.getenv("MEDIA_LOCK_PATH", os.path.join(os.path.dirname(SHARED_STATE_PATH), "dataforge-media.lock"))
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", 2))  # processes, i.e. jobs run at once per host
+MEDIA_POLL_INTERVAL = float(os.getenv("MEDIA_POLL_INTERVAL", 2.0))
+MEDIA_MAX_ATTEMPTS = int(os.getenv("MEDIA_MAX_ATTEMPTS", 3))
+MEDIA_RETRY_BACKOFF = int(os.getenv("MEDIA_RETRY_BACKOFF", 30))  # seconds, doubled on each retry
+MEDIA_JOB_TIMEOUT = int(os.getenv("MEDIA_JOB_TIMEOUT", 600))  # running jobs older than this are assumed lost
+MEDIA_MAX_PIXELS = int(os.getenv("MEDIA_MAX_PIXELS", 80_000_000))  # larger images get metadata only
+MEDIA_VARIANT_FORMAT = os.getenv("MEDIA_VARIANT_FORMAT", "WEBP")
+MEDIA_VARIANT_QUALITY = int(os.getenv("MEDIA_VARIANT_QUALITY", 80))
+MEDIA_VARIANTS = {  # name -> longest edge in pixels
+    "thumb": int(os.getenv("MEDIA_THUMB_SIZE", 256)),
+    "medium": int(os.getenv("MEDIA_MEDIUM_SIZE", 1280)),
+}
+
+# Full-text search over text uploads (search.py). Postgres uses a generated
+# tsvector column with a GIN index, SQLite an FTS5 table kept in sync by triggers.
+SEARCH_TS_CONFIG = os.getenv("SEARCH_TS_CONFIG", "simple")  # Postgres text search configuration; "simple" doesn't stem, so prefixes match as typed
+SEARCH_INDEX_CHARS = int(os.getenv("SEARCH_INDEX_CHARS", 65536))  # Postgres indexes this many leading characters of each upload; fixed when the column is built
+SEARCH_MAX_TERMS = int(os.getenv("SEARCH_MAX_TERMS", 8))
+
+# Live events over the /ws/logs WebSocket (events.py). Each gunicorn worker with
+# open connections binds a datagram socket in WS_RELAY_DIR; publishers send every
+# event to those sockets, so a connection on any worker sees events from all of them.
+WS_RELAY_DIR = os.getenv("WS_RELAY_DIR", os.path.join(os.path.dirname(SHARED_STATE_PATH), "dataforge-ws"))
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", 64))  # events buffered per connection before the oldest are dropped
+WS_MAX_CONNECTIONS = int(os.getenv("WS_MAX_CONNECTIONS", 10000))  # per worker
+WS_MAX_CONNECTIONS_PER_USER = int(os.getenv("WS_MAX_CONNECTIONS_PER_USER", 16))
+# The access_token cookie authenticates a socket only from the app's own origin or
+# one listed here (comma-separated, e.g. "https://app.example.com" behind a proxy
+# that rewrites Host); anything else must pass ?token=
+WS_ALLOWED_ORIGINS = {o.strip().rstrip("/") for o in os.getenv("WS_ALLOWED_ORIGINS", "").split(",") if o.strip()}
+
+# Size-tiered storage for text uploads (textstore.py). Up to TEXT_INLINE_MAX bytes
+# stay in uploads.content; larger texts are compressed into uploads.content_blob,
+# or into the file store when even the compressed bytes exceed TEXT_SPILL_BYTES.
+TEXT_INLINE_MAX = int(os.getenv("TEXT_INLINE_MAX", 4096))
+TEXT_SPILL_BYTES = int(os.getenv("TEXT_SPILL_BYTES", 256 * 1024))
+TEXT_COMPRESSION = os.getenv("TEXT_COMPRESSION", "auto")  # zstd (needs the zstandard package), deflate, or auto: zstd when installed
+TEXT_COMPRESSION_LEVEL = int(os.getenv("TEXT_COMPRESSION_LEVEL", 6))
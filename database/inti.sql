@@ -1,3 +1,12 @@
+-- Full schema for a new Postgres database. Existing databases are brought up to
+-- date by the versioned migrations in migrations/ (python manage.py migrate).
+CREATE TABLE schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name VARCHAR NOT NULL,
+    applied_at TIMESTAMP NOT NULL,
+    duration_ms INTEGER
+);
+
 CREATE TABLE users (
     id SERIAL PRIMARY KEY,
     name VARCHAR,                     -- Add name column
@@ -8,20 +17,63 @@ CREATE TABLE users (
     profile_photo VARCHAR,
     is_premium BOOLEAN DEFAULT FALSE,
     storage_limit BIGINT DEFAULT 1073741824, -- 1GB
+    storage_used BIGINT NOT NULL DEFAULT 0, -- running total of uploads.size_bytes
+    uploads_count INTEGER NOT NULL DEFAULT 0, -- running count of uploads rows
     is_admin BOOLEAN DEFAULT FALSE,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
+CREATE INDEX ix_users_uploads_count_id ON users (uploads_count, id);
+CREATE INDEX ix_users_storage_used_id ON users (storage_used, id);
+
+CREATE TABLE blobs (
+    sha256 VARCHAR(64) PRIMARY KEY,
+    size_bytes BIGINT NOT NULL,
+    path VARCHAR NOT NULL, -- file store key, blobs/<sha256>
+    refcount INTEGER NOT NULL DEFAULT 1, -- number of uploads rows pointing here
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
 
 CREATE TABLE uploads (
     id SERIAL PRIMARY KEY,
     user_id INTEGER REFERENCES users(id),
     type VARCHAR, -- text, image, video, document
     file_url VARCHAR,
-    content TEXT,
-    share_token VARCHAR,
-    share_expires_at TIMESTAMP,
+    content TEXT, -- small texts; larger ones are compressed below
+    content_encoding VARCHAR(16), -- zstd, deflate; NULL when inline in content
+    content_blob BYTEA, -- compressed bytes, unless spilled to the file store
+    content_key VARCHAR, -- file store key texts/<uuid>.<ext> for the largest texts
+    content_length BIGINT, -- UTF-8 bytes before compression
+    content_preview VARCHAR, -- first characters of a compressed text, for listings
+    size_bytes BIGINT NOT NULL DEFAULT 0, -- bytes on disk, counted against quota
+    filename VARCHAR, -- original client filename
+    sha256 VARCHAR(64) REFERENCES blobs(sha256), -- content-addressed blob holding the bytes
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- Filled in by the media worker after upload
+    mime_type VARCHAR, -- sniffed from the bytes, not the client's filename
+    width INTEGER,
+    height INTEGER,
+    duration_ms INTEGER, -- video
+    media_status VARCHAR, -- pending, done, failed; NULL for text
+    search_vector tsvector -- full-text search (search.py), written with the text since compressed texts aren't in content
+);
+-- Already compressed: keep it out of line without another pglz attempt
+ALTER TABLE uploads ALTER COLUMN content_blob SET STORAGE EXTERNAL;
+CREATE INDEX ix_uploads_sha256 ON uploads (sha256);
+-- Keyset pagination of a user's uploads
+CREATE INDEX ix_uploads_user_created_id ON uploads (user_id, created_at, id);
+CREATE INDEX ix_uploads_user_type_created_id ON uploads (user_id, type, created_at, id);
+-- One user's matches per lookup; (user_id, tsvector) needs btree_gin
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+CREATE INDEX ix_uploads_search ON uploads USING GIN (user_id, search_vector) WHERE type = 'text';
+
+CREATE TABLE share_links (
+    token VARCHAR(36) PRIMARY KEY, -- uuid4 from the share URL
+    upload_id INTEGER NOT NULL REFERENCES uploads(id) ON DELETE CASCADE,
+    expires_at TIMESTAMP, -- swept by the maintenance worker
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
+CREATE INDEX ix_share_links_upload_id ON share_links (upload_id);
+CREATE INDEX ix_share_links_expires_at ON share_links (expires_at);
 
 CREATE TABLE analytics (
     id SERIAL PRIMARY KEY,
@@ -30,3 +82,105 @@ CREATE TABLE analytics (
     details TEXT, -- JSON string
     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
+CREATE INDEX ix_analytics_user_timestamp ON analytics (user_id, timestamp);
+
+-- Rollups of analytics, maintained incrementally by the analytics writer
+CREATE TABLE analytics_hourly (
+    user_id INTEGER REFERENCES users(id),
+    event_type VARCHAR,
+    bucket TIMESTAMP, -- start of the hour (UTC)
+    count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, event_type, bucket)
+);
+
+CREATE TABLE analytics_daily (
+    user_id INTEGER REFERENCES users(id),
+    event_type VARCHAR,
+    bucket TIMESTAMP, -- start of the day (UTC)
+    count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, event_type, bucket)
+);
+
+CREATE TABLE upload_sessions (
+    id VARCHAR(36) PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id),
+    type VARCHAR,
+    filename VARCHAR,
+    share BOOLEAN DEFAULT FALSE,
+    ttl_hours INTEGER DEFAULT 24,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP
+);
+CREATE INDEX ix_upload_sessions_user_id ON upload_sessions (user_id);
+CREATE INDEX ix_upload_sessions_expires_at ON upload_sessions (expires_at);
+
+CREATE TABLE upload_parts (
+    session_id VARCHAR(36) REFERENCES upload_sessions(id) ON DELETE CASCADE,
+    part_number INTEGER,
+    size_bytes BIGINT NOT NULL,
+    sha256 VARCHAR(64),
+    received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (session_id, part_number)
+);
+
+CREATE TABLE export_jobs (
+    id VARCHAR(36) PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id),
+    status VARCHAR DEFAULT 'pending', -- pending, running, done, failed
+    path VARCHAR, -- file store key, exports/<id>.zip once done
+    size_bytes BIGINT,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP,
+    expires_at TIMESTAMP -- archive is deleted after this
+);
+CREATE INDEX ix_export_jobs_user_id ON export_jobs (user_id);
+CREATE INDEX ix_export_jobs_expires_at ON export_jobs (expires_at);
+
+-- Queue of post-upload processing, drained by the media worker
+CREATE TABLE media_jobs (
+    id SERIAL PRIMARY KEY,
+    upload_id INTEGER NOT NULL REFERENCES uploads(id) ON DELETE CASCADE,
+    status VARCHAR NOT NULL DEFAULT 'queued', -- queued, running, failed (finished jobs are deleted)
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, -- retries back off by pushing this out
+    locked_at TIMESTAMP, -- set while running; stale locks are retried
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+CREATE INDEX ix_media_jobs_upload_id ON media_jobs (upload_id);
+CREATE INDEX ix_media_jobs_status_run_after ON media_jobs (status, run_after);
+
+-- Derived renditions of an upload (thumbnails, resized copies, video posters)
+CREATE TABLE media_variants (
+    id SERIAL PRIMARY KEY,
+    upload_id INTEGER NOT NULL REFERENCES uploads(id) ON DELETE CASCADE,
+    name VARCHAR NOT NULL, -- thumb, medium, poster
+    key VARCHAR NOT NULL, -- file store key, variants/<upload id>_<name>.<ext>
+    mime_type VARCHAR NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    size_bytes BIGINT NOT NULL DEFAULT 0, -- not counted against the owner's quota
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT uq_media_variants_upload_name UNIQUE (upload_id, name)
+);
+
+CREATE TABLE pending_deletions (
+    id SERIAL PRIMARY KEY,
+    path VARCHAR NOT NULL, -- file removed by the maintenance worker, outside any request
+    reason VARCHAR, -- user_deleted, ...
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE maintenance_runs (
+    id SERIAL PRIMARY KEY,
+    job VARCHAR NOT NULL,
+    dry_run BOOLEAN DEFAULT FALSE,
+    status VARCHAR DEFAULT 'running', -- running, ok, failed
+    stats TEXT, -- JSON counters reported by the job
+    error TEXT,
+    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+CREATE INDEX ix_maintenance_runs_job_started_at ON maintenance_runs (job, started_at);
@@ -0,0 +1,241 @@
+from collections import deque
+from datetime import datetime
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from config import WS_RELAY_DIR, WS_QUEUE_SIZE, WS_MAX_CONNECTIONS, WS_MAX_CONNECTIONS_PER_USER
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+# Per-user live events for dashboards (/ws/logs, routes/ws.py).
+#
+# publish() may be called from any thread of any gunicorn worker. It sends the
+# event as one datagram to the relay socket of every worker that currently has
+# connections (<pid>.sock in WS_RELAY_DIR, bound on the worker's first
+# connection and removed after its last), so workers without connections
+# receive nothing. A receiving worker reads datagrams from its event loop
+# (add_reader, no polling thread) and hands each event to that user's
+# connections. Nothing here touches the database.
+#
+# Each connection buffers at most WS_QUEUE_SIZE events. Consecutive api_call
+# events are merged into one with a count; when the buffer is full the oldest
+# event is dropped and the client is told how many it missed.
+
+COALESCED = {"api_call"}
+MAX_DATAGRAM = 16 * 1024
+PEER_REFRESH = 1.0  # seconds between relay directory listings; a new worker is seen within this
+
+WS_CONNECTIONS = Gauge("ws_connections", "Open event WebSocket connections")
+WS_EVENTS = Counter("ws_events_total", "Events queued for WebSocket connections", ("type",))
+WS_DROPPED = Counter("ws_events_dropped_total", "Events dropped before reaching a WebSocket connection", ("reason",))
+
+class TooManyConnections(Exception):
+    pass
+
+class Subscription:
+    """One connection's bounded buffer of pending events. Used on the event loop only."""
+
+    __slots__ = ("user_id", "queue", "dropped", "closed", "_ready")
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.queue = deque()
+        self.dropped = 0
+        self.closed = False
+        self._ready = asyncio.Event()
+
+    def put(self, event: dict):
+        queue = self.queue
+        if event["type"] in COALESCED and queue and queue[-1]["type"] == event["type"]:
+            last = queue[-1]
+            last["count"] = last.get("count", 1) + 1
+            last["data"], last["ts"] = event["data"], event["ts"]
+        else:
+            if len(queue) >= WS_QUEUE_SIZE:
+                queue.popleft()
+                self.dropped += 1
+                WS_DROPPED.inc(("slow_consumer",))
+            queue.append(dict(event))
+        self._ready.set()
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+    async def get(self):
+        """Wait for events and return all pending ones, or None once closed."""
+        while not self.queue and not self.closed:
+            self._ready.clear()
+            await self._ready.wait()
+        if self.closed:
+            return None
+        events = list(self.queue)
+        self.queue.clear()
+        if self.dropped:
+            events.insert(0, {"type": "dropped", "count": self.dropped})
+            self.dropped = 0
+        return events
+
+class EventHub:
+    def __init__(self, relay_dir: str = WS_RELAY_DIR):
+        self.relay_dir = relay_dir
+        self.channels = {}  # user_id -> set of Subscription
+        self.connections = 0
+        self.published = 0
+        self.received = 0
+        self._sock = None
+        self._path = None
+        self._loop = None
+        self._sender = None
+        self._sender_lock = threading.Lock()
+        self._peers = ()
+        self._peers_at = 0.0
+
+    # Publishing (any thread)
+
+    def _peer_paths(self):
+        now = time.monotonic()
+        if now - self._peers_at > PEER_REFRESH:
+            try:
+                self._peers = tuple(
+                    entry.path for entry in os.scandir(self.relay_dir) if entry.name.endswith(".sock")
+                )
+            except FileNotFoundError:
+                self._peers = ()
+            self._peers_at = now
+        return self._peers
+
+    def _sending_socket(self):
+        if self._sender is None:
+            with self._sender_lock:
+                if self._sender is None:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                    sock.setblocking(False)
+                    self._sender = sock
+        return self._sender
+
+    def publish(self, user_id: int, type_: str, data: dict = None):
+        """Send an event to user_id's open connections on every worker. Never blocks."""
+        if user_id is None:
+            return
+        peers = self._peer_paths()
+        if not peers:
+            return
+        payload = json.dumps(
+            {"u": user_id, "type": type_, "data": data or {}, "ts": datetime.utcnow().isoformat()}, default=str
+        ).encode()
+        if len(payload) > MAX_DATAGRAM:
+            WS_DROPPED.inc(("too_large",))
+            return
+        sock = self._sending_socket()
+        for path in peers:
+            try:
+                sock.sendto(payload, path)
+            except BlockingIOError:
+                # The receiving worker is behind; its clients would drop this anyway
+                WS_DROPPED.inc(("relay_full",))
+            except (ConnectionRefusedError, FileNotFoundError):
+                self._remove_stale(path)
+            except OSError as e:
+                logger.debug("Event relay to %s failed: %s", path, e)
+        self.published += 1
+
+    def _remove_stale(self, path: str):
+        # Left behind by a worker that died without unbinding
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        self._peers_at = 0.0
+
+    # Receiving (event loop)
+
+    def _bind(self):
+        os.makedirs(self.relay_dir, exist_ok=True)
+        path = os.path.join(self.relay_dir, f"{os.getpid()}.sock")
+        if os.path.exists(path):
+            os.remove(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock.setblocking(False)
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(sock.fileno(), self._on_readable)
+        self._sock, self._path = sock, path
+        self._peers_at = 0.0
+
+    def _unbind(self):
+        if self._sock is None:
+            return
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+        self._sock = self._path = None
+        self._peers_at = 0.0
+
+    def _on_readable(self):
+        for _ in range(256):  # then yield to the loop; the reader fires again if more are waiting
+            try:
+                payload = self._sock.recv(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                event = json.loads(payload)
+                subscribers = self.channels.get(event.pop("u"))
+            except (ValueError, KeyError, TypeError):
+                continue
+            self.received += 1
+            if subscribers:
+                WS_EVENTS.inc((event["type"],), len(subscribers))
+                for sub in subscribers:
+                    sub.put(event)
+
+    def subscribe(self, user_id: int) -> Subscription:
+        channel = self.channels.get(user_id, ())
+        if self.connections >= WS_MAX_CONNECTIONS or len(channel) >= WS_MAX_CONNECTIONS_PER_USER:
+            raise TooManyConnections()
+        if self._sock is None:
+            self._bind()
+        sub = Subscription(user_id)
+        self.channels.setdefault(user_id, set()).add(sub)
+        self.connections += 1
+        WS_CONNECTIONS.inc()
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        channel = self.channels.get(sub.user_id)
+        if channel is None or sub not in channel:
+            return
+        channel.discard(sub)
+        if not channel:
+            del self.channels[sub.user_id]
+        self.connections -= 1
+        WS_CONNECTIONS.dec()
+        if not self.connections:
+            self._unbind()
+
+    def stop(self):
+        for channel in list(self.channels.values()):
+            for sub in list(channel):
+                sub.close()
+        self._unbind()
+
+    def status(self):
+        return {
+            "pid": os.getpid(),
+            "connections": self.connections,
+            "users": len(self.channels),
+            "relay_socket": self._path,
+            "peers": len(self._peer_paths()),
+            "published": self.published,
+            "received": self.received,
+        }
+
+event_hub = EventHub()
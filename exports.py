@@ -0,0 +1,146 @@
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+import os
+import zipfile
+import logging
+from config import UPLOAD_CHUNK_SIZE, EXPORT_TTL_HOURS
+from database import SessionLocal
+from models import Upload, ExportJob
+from filestore import file_store
+from storage import temp_path
+from textstore import TEXT_COLUMNS, iter_stored, iter_decompress
+
+logger = logging.getLogger(__name__)
+
+# Formats that are already compressed; deflating them again burns CPU for nothing
+STORED_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif", ".heic",
+    ".mp4", ".mov", ".m4v", ".mkv", ".webm", ".avi", ".mp3", ".m4a", ".ogg", ".flac",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar", ".zst", ".pdf", ".docx", ".xlsx", ".pptx",
+}
+
+class _Sink:
+    # Write-only, non-seekable target: zipfile then emits data descriptors and never seeks back
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def _entry_name(upload) -> str:
+    if upload.type == "text":
+        return f"{upload.id}.txt"
+    return f"{upload.id}{os.path.splitext(upload.filename or upload.file_url)[1]}"
+
+def iter_export(user_id: int):
+    """Yield a ZIP of the user's uploads piece by piece, reading files in chunks.
+
+    Memory use is bounded by UPLOAD_CHUNK_SIZE regardless of archive size,
+    and the first bytes go out as soon as the first entry is read.
+    """
+    db = SessionLocal()
+    sink = _Sink()
+    try:
+        uploads = db.execute(
+            select(Upload.id, Upload.type, Upload.file_url, Upload.filename, Upload.created_at, *TEXT_COLUMNS)
+            .where(Upload.user_id == user_id)
+            .order_by(Upload.id)
+            .execution_options(yield_per=100)
+        )
+        with zipfile.ZipFile(sink, "w", allowZip64=True) as zf:
+            for upload in uploads:
+                name = _entry_name(upload)
+                date_time = (upload.created_at or datetime.utcnow()).timetuple()[:6]
+                zinfo = zipfile.ZipInfo(name, date_time=date_time)
+                if upload.content is not None:
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                    zf.writestr(zinfo, upload.content)
+                elif upload.content_encoding:
+                    # Compressed texts are inflated as they stream into the archive
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                    with zf.open(zinfo, "w") as dest:
+                        for chunk in iter_decompress(iter_stored(upload), upload.content_encoding):
+                            dest.write(chunk)
+                            data = sink.drain()
+                            if data:
+                                yield data
+                elif upload.file_url:
+                    try:
+                        size, _ = file_store.stat(upload.file_url)
+                    except FileNotFoundError:
+                        continue
+                    ext = os.path.splitext(name)[1].lower()
+                    zinfo.compress_type = zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                    zinfo.file_size = size  # lets zipfile pick zip64 up front
+                    with file_store.open(upload.file_url) as src, zf.open(zinfo, "w") as dest:
+                        while True:
+                            chunk = src.read(UPLOAD_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            data = sink.drain()
+                            if data:
+                                yield data
+                data = sink.drain()
+                if data:
+                    yield data
+        yield sink.drain()
+    finally:
+        db.close()
+
+# Deferred exports: built in the background into a temp file, then kept in the
+# file store under exports/<job id>.zip until downloaded or expired
+
+def build_export(job_id: str):
+    db = SessionLocal()
+    try:
+        job = db.get(ExportJob, job_id)
+        if job is None:
+            return
+        job.status = "running"
+        db.commit()
+        key = f"exports/{job_id}.zip"
+        tmp = temp_path()
+        size = 0
+        try:
+            with open(tmp, "wb") as out:
+                for data in iter_export(job.user_id):
+                    out.write(data)
+                    size += len(data)
+            file_store.put(key, tmp)
+        except Exception as e:
+            logger.exception("Export %s failed", job_id)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            job.status = "failed"
+            job.error = str(e)
+        else:
+            job.status = "done"
+            job.path = key
+            job.size_bytes = size
+        job.finished_at = datetime.utcnow()
+        job.expires_at = job.finished_at + timedelta(hours=EXPORT_TTL_HOURS)
+        db.commit()
+    finally:
+        db.close()
+
+def gc_export_jobs(db: Session, now: datetime = None) -> int:
+    """Delete expired export jobs and their archives, returning how many were removed."""
+    now = now or datetime.utcnow()
+    jobs = db.query(ExportJob).filter(ExportJob.expires_at < now).all()
+    for job in jobs:
+        if job.path:
+            file_store.delete(job.path)
+        db.delete(job)
+    db.commit()
+    return len(jobs)
@@ -0,0 +1,241 @@
+from datetime import datetime, timezone
+import hashlib
+import os
+import re
+import shutil
+from config import (
+    UPLOAD_CHUNK_SIZE, STORAGE_BACKEND, STORAGE_LOCAL_ROOT, STORAGE_READ_FALLBACK,
+    STORAGE_S3_BUCKET, STORAGE_S3_PREFIX, STORAGE_S3_ENDPOINT_URL, STORAGE_S3_REGION
+)
+
+# Where stored bytes live: blobs, profile photos and finished export archives.
+# Rows hold backend-neutral keys, "<namespace>/<name>" (blobs/<sha256>,
+# photos/<uuid>.jpg, exports/<job id>.zip), and the configured backend maps a
+# key to a sharded path on local disk or to an object in an S3-compatible bucket.
+# Scratch files (uploads/tmp, multipart parts) are always local to the worker.
+#
+# Rows written before keys existed hold paths such as uploads/123_4.png or
+# uploads/blobs/ab/cd/<sha256>; the local backend still reads them, and
+# `python manage.py migrate-storage` rewrites them as keys.
+
+LEGACY_PREFIX = "uploads/"
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+def is_legacy_path(key: str) -> bool:
+    return key.startswith(LEGACY_PREFIX)
+
+def shard(name: str) -> str:
+    # Two levels of 256 directories, from the content hash when the name is one
+    digest = name if _SHA256_RE.match(name) else hashlib.sha256(name.encode()).hexdigest()
+    return os.path.join(digest[:2], digest[2:4], name)
+
+class LocalBackend:
+    name = "local"
+
+    def __init__(self, root: str = STORAGE_LOCAL_ROOT):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        if is_legacy_path(key):
+            return key
+        namespace, name = key.split("/", 1)
+        return os.path.join(self.root, namespace, shard(name))
+
+    def put(self, key: str, src_path: str):
+        """Move the finished local file src_path into the store under key."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(src_path, path)
+
+    def open(self, key: str):
+        return open(self.path(key), "rb")
+
+    def local_path(self, key: str):
+        return self.path(key)
+
+    def iter_range(self, key: str, start: int, length: int):
+        with open(self.path(key), "rb") as f:
+            f.seek(start)
+            remaining = length
+            while remaining > 0:
+                chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def stat(self, key: str):
+        """(size, mtime as a UTC datetime); raises FileNotFoundError."""
+        st = os.stat(self.path(key))
+        return st.st_size, datetime.fromtimestamp(st.st_mtime, tz=timezone.utc)
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self.path(key))
+
+    def delete(self, key: str) -> bool:
+        try:
+            os.remove(self.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def list(self, namespace: str):
+        """Yield (key, size, mtime timestamp) for everything stored under namespace."""
+        base = os.path.join(self.root, namespace)
+        for dirpath, _, filenames in os.walk(base):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if path != os.path.join(base, shard(name)):
+                    continue  # not written through the store (e.g. a pre-sharding export archive)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield f"{namespace}/{name}", st.st_size, st.st_mtime
+
+class S3Backend:
+    # Any S3-compatible service; point STORAGE_S3_ENDPOINT_URL at MinIO (or moto_server) to run locally.
+    # Credentials come from the usual AWS_* environment variables.
+    name = "s3"
+
+    def __init__(self, bucket: str = STORAGE_S3_BUCKET, prefix: str = STORAGE_S3_PREFIX,
+                 endpoint_url: str = STORAGE_S3_ENDPOINT_URL, region: str = STORAGE_S3_REGION):
+        import boto3  # optional dependency, only needed for STORAGE_BACKEND=s3
+        from botocore.exceptions import ClientError
+
+        if not bucket:
+            raise RuntimeError("STORAGE_S3_BUCKET must be set for the s3 storage backend")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url or None, region_name=region or None)
+        self._client_error = ClientError
+
+    def _missing(self, e) -> bool:
+        return e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def put(self, key: str, src_path: str):
+        self.client.upload_file(src_path, self.bucket, self.prefix + key)
+        os.remove(src_path)
+
+    def local_path(self, key: str):
+        return None
+
+    def open(self, key: str):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)["Body"]
+        except self._client_error as e:
+            if self._missing(e):
+                raise FileNotFoundError(key)
+            raise
+
+    def iter_range(self, key: str, start: int, length: int):
+        if length <= 0:
+            return
+        body = self.client.get_object(
+            Bucket=self.bucket, Key=self.prefix + key, Range=f"bytes={start}-{start + length - 1}"
+        )["Body"]
+        try:
+            yield from body.iter_chunks(UPLOAD_CHUNK_SIZE)
+        finally:
+            body.close()
+
+    def stat(self, key: str):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except self._client_error as e:
+            if self._missing(e):
+                raise FileNotFoundError(key)
+            raise
+        return head["ContentLength"], head["LastModified"]
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.stat(key)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def delete(self, key: str) -> bool:
+        # S3 deletes are idempotent and don't say whether the object existed
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+        return True
+
+    def list(self, namespace: str):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}{namespace}/"):
+            for obj in page.get("Contents", ()):
+                yield obj["Key"][len(self.prefix):], obj["Size"], obj["LastModified"].timestamp()
+
+class FallbackBackend:
+    """Writes go to primary; reads that miss there are retried on secondary.
+
+    Used while `manage.py migrate-storage --to ...` copies objects to a new
+    backend: switch the app to the new backend with the old one as
+    STORAGE_READ_FALLBACK, run the copy, then drop the fallback.
+    """
+
+    def __init__(self, primary, secondary):
+        self.primary = primary
+        self.secondary = secondary
+        self.name = f"{primary.name}+{secondary.name}"
+
+    def _read(self, method: str, key: str, *args):
+        if is_legacy_path(key) and isinstance(self.secondary, LocalBackend):
+            return getattr(self.secondary, method)(key, *args)
+        try:
+            return getattr(self.primary, method)(key, *args)
+        except FileNotFoundError:
+            return getattr(self.secondary, method)(key, *args)
+
+    def put(self, key: str, src_path: str):
+        self.primary.put(key, src_path)
+
+    def open(self, key: str):
+        return self._read("open", key)
+
+    def local_path(self, key: str):
+        return self.primary.local_path(key) or self.secondary.local_path(key)
+
+    def iter_range(self, key: str, start: int, length: int):
+        # Generators only fail once iterated, so pick the backend up front
+        backend = self.primary if self.primary.exists(key) else self.secondary
+        return backend.iter_range(key, start, length)
+
+    def stat(self, key: str):
+        return self._read("stat", key)
+
+    def exists(self, key: str) -> bool:
+        return self.primary.exists(key) or self.secondary.exists(key)
+
+    def delete(self, key: str) -> bool:
+        removed = self.primary.delete(key)
+        return self.secondary.delete(key) or removed
+
+    def list(self, namespace: str):
+        seen = set()
+        for backend in (self.primary, self.secondary):
+            for key, size, mtime in backend.list(namespace):
+                if key not in seen:
+                    seen.add(key)
+                    yield key, size, mtime
+
+BACKENDS = {"local": LocalBackend, "s3": S3Backend}
+
+def make_backend(name: str):
+    if name not in BACKENDS:
+        raise RuntimeError(f"Unknown storage backend {name!r} (expected one of {', '.join(BACKENDS)})")
+    return BACKENDS[name]()
+
+file_store = make_backend(STORAGE_BACKEND)
+if STORAGE_READ_FALLBACK:
+    file_store = FallbackBackend(file_store, make_backend(STORAGE_READ_FALLBACK))
+
+# profile_<id>.<ext>, as written at signup (the extension comes from the client's filename)
+PHOTO_NAME_RE = re.compile(r"^profile_\d+\.[A-Za-z0-9_-]{1,16}$")
+
+def photo_url(value: str):
+    # Photos stored at signup are served by GET /api/photos/{name}; legacy paths and
+    # URLs given to the JSON signup are returned as they were stored
+    if value and value.startswith("photos/"):
+        return "/api/" + value
+    return value
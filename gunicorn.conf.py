@@ -0,0 +1,18 @@
+import os
+import subprocess
+import sys
+
+# Gunicorn settings (Procfile: gunicorn -c gunicorn.conf.py app:app)
+workers = int(os.getenv("WEB_CONCURRENCY", 4))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+def on_starting(server):
+    # Once per deploy, in the master before any worker forks. A separate process,
+    # so the master never holds database connections or app state that the
+    # workers would inherit; a failed migration stops the deploy here.
+    if os.getenv("MIGRATE_ON_START", "true").lower() not in ("1", "true", "yes"):
+        return
+    root = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, os.path.join(root, "manage.py"), "migrate"], cwd=root)
+    if result.returncode != 0:
+        raise RuntimeError(f"Schema migration failed (exit {result.returncode})")
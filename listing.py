@@ -0,0 +1,81 @@
+from sqlalchemy import select, func, tuple_, or_
+from sqlalchemy.orm import Session
+from datetime import datetime
+from models import Upload, ShareLink, MediaVariant
+from admin_stats import encode_cursor, decode_cursor
+from textstore import PREVIEW_CHARS
+
+# Upload listings for GET /api/uploads and the dashboard
+
+def list_uploads(
+    db: Session, user_id: int, limit: int = 50, cursor: str = None,
+    type_: str = None, start: datetime = None, end: datetime = None
+):
+    """One page of a user's uploads, newest first, plus the cursor for the next page.
+
+    Pages are addressed by keyset (created_at, id) within the user, served by
+    ix_uploads_user_created_id (ix_uploads_user_type_created_id when filtering
+    by type), so page 1000 costs the same as page 1. Only metadata and a short
+    preview of text content are read; full content is fetched by id.
+    """
+    stmt = (
+        select(
+            Upload.id, Upload.type, Upload.filename, Upload.size_bytes, Upload.sha256, Upload.created_at,
+            Upload.mime_type, Upload.width, Upload.height, Upload.duration_ms,
+            # Compressed texts carry their preview; inline ones are cut from content
+            func.coalesce(Upload.content_preview, func.substr(Upload.content, 1, PREVIEW_CHARS + 1)).label("preview"),
+        )
+        .where(Upload.user_id == user_id)
+    )
+    if type_:
+        stmt = stmt.where(Upload.type == type_)
+    if start:
+        stmt = stmt.where(Upload.created_at >= start)
+    if end:
+        stmt = stmt.where(Upload.created_at < end)
+    if cursor:
+        value, last_id = decode_cursor(cursor)
+        stmt = stmt.where(tuple_(Upload.created_at, Upload.id) < tuple_(datetime.fromisoformat(value), last_id))
+    stmt = stmt.order_by(Upload.created_at.desc(), Upload.id.desc()).limit(limit + 1)
+
+    rows = db.execute(stmt).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+
+    links, variants = {}, {}
+    if rows:
+        ids = [r.id for r in rows]
+        for upload_id, name, width, height in db.execute(
+            select(MediaVariant.upload_id, MediaVariant.name, MediaVariant.width, MediaVariant.height)
+            .where(MediaVariant.upload_id.in_(ids))
+        ):
+            variants.setdefault(upload_id, {})[name] = {"width": width, "height": height}
+        now = datetime.utcnow()
+        for upload_id, token, expires_at in db.execute(
+            select(ShareLink.upload_id, ShareLink.token, ShareLink.expires_at)
+            .where(ShareLink.upload_id.in_(ids))
+            .where(or_(ShareLink.expires_at.is_(None), ShareLink.expires_at > now))
+        ):
+            links.setdefault(upload_id, []).append({"token": token, "expires_at": expires_at})
+
+    items = []
+    for r in rows:
+        item = {
+            "id": r.id,
+            "type": r.type,
+            "filename": r.filename,
+            "size": r.size_bytes,
+            "sha256": r.sha256,
+            "created_at": r.created_at,
+            "share_links": links.get(r.id, []),
+        }
+        if r.type == "text":
+            item["preview"] = (r.preview or "")[:PREVIEW_CHARS]
+            item["truncated"] = len(r.preview or "") > PREVIEW_CHARS
+        else:
+            item.update(mime_type=r.mime_type, width=r.width, height=r.height, duration_ms=r.duration_ms)
+            item["variants"] = variants.get(r.id, {})
+        items.append(item)
+    return items, next_cursor
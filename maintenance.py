@@ -0,0 +1,429 @@
+from sqlalchemy import select, delete, func
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from config import (
+    MAINTENANCE_ENABLED, MAINTENANCE_DRY_RUN, MAINTENANCE_LOCK_PATH, MAINTENANCE_INTERVAL,
+    MAINTENANCE_SCAN_INTERVAL, MAINTENANCE_BATCH_SIZE, MAINTENANCE_BATCH_PAUSE,
+    MAINTENANCE_ORPHAN_GRACE, MAINTENANCE_RUN_RETENTION_DAYS
+)
+from database import SessionLocal
+from models import User, Upload, Blob, UploadSession, ExportJob, ShareLink, PendingDeletion, MaintenanceRun, MediaVariant
+from storage import reclaim_blobs, remove_session_files, gc_upload_sessions, session_dir
+from exports import gc_export_jobs
+from filestore import file_store
+from textstore import compress_existing
+
+logger = logging.getLogger(__name__)
+
+# Background maintenance, run outside request handlers.
+# Every job takes (db, dry_run, stats): it works in batches of MAINTENANCE_BATCH_SIZE
+# with MAINTENANCE_BATCH_PAUSE between them, only counts when dry_run is set, and
+# reports what it did into stats, which is stored on a MaintenanceRun row.
+
+MAX_SAMPLES = 50  # ids / paths listed per stats key
+
+def _pause():
+    if MAINTENANCE_BATCH_PAUSE > 0:
+        time.sleep(MAINTENANCE_BATCH_PAUSE)
+
+def _sample(stats: dict, key: str, value):
+    samples = stats.setdefault(key, [])
+    if len(samples) < MAX_SAMPLES:
+        samples.append(value)
+
+def _remove_path(path: str) -> bool:
+    try:
+        if os.path.isdir(path):
+            remove_session_files(os.path.basename(path))
+        else:
+            os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+# Jobs
+
+def expire_shares(db: Session, dry_run: bool, stats: dict):
+    """Delete share links past their expiry. The uploads themselves stay with their owners."""
+    expired = ShareLink.expires_at < datetime.utcnow()  # served by ix_share_links_expires_at
+    if dry_run:
+        stats["expired_shares"] = db.execute(select(func.count(ShareLink.token)).where(expired)).scalar()
+        return
+    stats["expired_shares"] = 0
+    while True:
+        tokens = db.execute(
+            select(ShareLink.token).where(expired).order_by(ShareLink.expires_at).limit(MAINTENANCE_BATCH_SIZE)
+        ).scalars().all()
+        if not tokens:
+            break
+        db.execute(delete(ShareLink).where(ShareLink.token.in_(tokens)))
+        db.commit()
+        stats["expired_shares"] += len(tokens)
+        _pause()
+
+def process_deletions(db: Session, dry_run: bool, stats: dict):
+    """Remove files queued by schedule_file_deletion (e.g. by user deletion)."""
+    if dry_run:
+        stats["queued"] = db.execute(select(func.count(PendingDeletion.id))).scalar()
+        for path in db.execute(select(PendingDeletion.path).order_by(PendingDeletion.id).limit(MAX_SAMPLES)).scalars():
+            _sample(stats, "paths", path)
+        return
+    stats.update(removed=0, already_missing=0)
+    while True:
+        rows = db.execute(
+            select(PendingDeletion.id, PendingDeletion.path).order_by(PendingDeletion.id).limit(MAINTENANCE_BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        for _, path in rows:
+            # Multipart part directories are local scratch space, not file store keys
+            removed = _remove_path(path) if path.startswith(session_dir("")) else file_store.delete(path)
+            if removed:
+                stats["removed"] += 1
+            else:
+                stats["already_missing"] += 1
+        db.execute(delete(PendingDeletion).where(PendingDeletion.id.in_([r.id for r in rows])))
+        db.commit()
+        _pause()
+
+def reclaim_unreferenced_blobs(db: Session, dry_run: bool, stats: dict):
+    """Delete blobs whose refcount dropped to zero without being reclaimed by the request."""
+    stats.update(zero_ref_blobs=0, reclaimed=0)
+    last = ""
+    while True:
+        shas = db.execute(
+            select(Blob.sha256).where(Blob.sha256 > last, Blob.refcount <= 0).order_by(Blob.sha256).limit(MAINTENANCE_BATCH_SIZE)
+        ).scalars().all()
+        if not shas:
+            break
+        last = shas[-1]
+        stats["zero_ref_blobs"] += len(shas)
+        if not dry_run:
+            stats["reclaimed"] += reclaim_blobs(db, shas)
+            _pause()
+
+def expire_upload_sessions(db: Session, dry_run: bool, stats: dict):
+    if dry_run:
+        stats["expired_sessions"] = db.execute(
+            select(func.count(UploadSession.id)).where(UploadSession.expires_at < datetime.utcnow())
+        ).scalar()
+        return
+    stats["expired_sessions"] = gc_upload_sessions(db, batch_size=MAINTENANCE_BATCH_SIZE)
+
+def expire_exports(db: Session, dry_run: bool, stats: dict):
+    if dry_run:
+        stats["expired_exports"] = db.execute(
+            select(func.count(ExportJob.id)).where(ExportJob.expires_at < datetime.utcnow())
+        ).scalar()
+        return
+    stats["expired_exports"] = gc_export_jobs(db)
+
+def compress_texts(db: Session, dry_run: bool, stats: dict):
+    """Move text rows written before size tiering into their tier (textstore.py).
+
+    Those rows are the ones without content_length; each is visited once,
+    since it gets one whether or not it ends up compressed.
+    """
+    stats.update(legacy_texts=0, compressed=0)
+    last_id = 0
+    while True:
+        ids = db.execute(
+            select(Upload.id)
+            .where(Upload.id > last_id, Upload.type == "text", Upload.content_length.is_(None), Upload.content.isnot(None))
+            .order_by(Upload.id)
+            .limit(MAINTENANCE_BATCH_SIZE)
+        ).scalars().all()
+        if not ids:
+            db.rollback()
+            break
+        last_id = ids[-1]
+        stats["legacy_texts"] += len(ids)
+        if dry_run:
+            db.rollback()
+            continue
+        for upload_id in ids:
+            if compress_existing(db, upload_id):
+                stats["compressed"] += 1
+        db.commit()
+        _pause()
+
+# Orphan files: anything stored that no row refers to. Only files older than
+# MAINTENANCE_ORPHAN_GRACE are considered, since an upload in flight writes its
+# bytes (tmp file, blob, part, archive) before the row that owns them commits.
+# Kinds in STORED_KINDS are file store keys; the rest are paths in the local
+# scratch space under uploads/.
+
+STORED_KINDS = {"blob": "blobs", "photo": "photos", "export": "exports", "variant": "variants", "text": "texts"}
+
+def _walk_uploads():
+    """Yield (kind, path or key, size, mtime) for everything the app writes."""
+    for kind, namespace in STORED_KINDS.items():
+        for key, size, mtime in file_store.list(namespace):
+            yield kind, key, size, mtime
+    root = "uploads"
+    local = []
+    for entry in os.scandir(root):
+        if entry.is_file() and not entry.name.startswith("."):
+            local.append(("root", entry))
+    for kind, sub in (("tmp", "tmp"), ("legacy_export", "exports")):
+        path = os.path.join(root, sub)
+        if os.path.isdir(path):
+            local.extend((kind, entry) for entry in os.scandir(path) if entry.is_file())
+    parts = os.path.join(root, ".parts")
+    if os.path.isdir(parts):
+        local.extend(("parts", entry) for entry in os.scandir(parts) if entry.is_dir())
+    for kind, entry in local:
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        yield kind, entry.path, st.st_size if kind != "parts" else 0, st.st_mtime
+
+def _referenced(db: Session, kind: str, paths) -> set:
+    if kind == "tmp":
+        return set()
+    if kind == "blob":
+        # Blob rows may still hold a pre-migration path, so match on the hash
+        by_sha = {os.path.basename(p): p for p in paths}
+        return {by_sha[s] for s in db.execute(select(Blob.sha256).where(Blob.sha256.in_(list(by_sha)))).scalars()}
+    if kind == "parts":
+        by_id = {os.path.basename(p): p for p in paths}
+        return {by_id[i] for i in db.execute(select(UploadSession.id).where(UploadSession.id.in_(list(by_id)))).scalars()}
+    if kind in ("export", "legacy_export"):
+        # <job id>.zip, or <job id>.zip.tmp for archives built before the file store
+        by_id = {}
+        for p in paths:
+            by_id.setdefault(os.path.basename(p).split(".", 1)[0], []).append(p)
+        found = db.execute(select(ExportJob.id).where(ExportJob.id.in_(list(by_id)))).scalars()
+        return {p for i in found for p in by_id[i]}
+    if kind == "variant":
+        return set(db.execute(select(MediaVariant.key).where(MediaVariant.key.in_(paths))).scalars())
+    if kind == "text":
+        return set(db.execute(select(Upload.content_key).where(Upload.content_key.in_(paths))).scalars())
+    if kind == "photo":
+        return set(db.execute(select(User.profile_photo).where(User.profile_photo.in_(paths))).scalars())
+    # Flat files in uploads/: legacy uploads and profile photos
+    return set(db.execute(select(Upload.file_url).where(Upload.file_url.in_(paths))).scalars()) | set(
+        db.execute(select(User.profile_photo).where(User.profile_photo.in_(paths))).scalars()
+    )
+
+def remove_orphan_files(db: Session, dry_run: bool, stats: dict):
+    stats.update(scanned=0, orphans=0, orphan_bytes=0, removed=0)
+    cutoff = time.time() - MAINTENANCE_ORPHAN_GRACE
+    batches = {}
+
+    def check(kind, batch):
+        sizes = dict(batch)
+        orphans = set(sizes) - _referenced(db, kind, list(sizes))
+        db.rollback()  # don't hold a read transaction open across the batch
+        for path in sorted(orphans):
+            stats["orphans"] += 1
+            stats["orphan_bytes"] += sizes[path]
+            _sample(stats, "orphan_paths", path)
+            if dry_run:
+                continue
+            if file_store.delete(path) if kind in STORED_KINDS else _remove_path(path):
+                stats["removed"] += 1
+        if orphans and not dry_run:
+            _pause()
+
+    for kind, path, size, mtime in _walk_uploads():
+        if mtime > cutoff:
+            continue
+        stats["scanned"] += 1
+        batch = batches.setdefault(kind, [])
+        batch.append((path, size))
+        if len(batch) >= MAINTENANCE_BATCH_SIZE:
+            check(kind, batches.pop(kind))
+    for kind, batch in batches.items():
+        check(kind, batch)
+
+def find_missing_files(db: Session, dry_run: bool, stats: dict):
+    """Report Upload and Blob rows whose file is gone. Detection only: rows are never deleted here."""
+    stats.update(uploads_checked=0, uploads_missing=0, blobs_checked=0, blobs_missing=0)
+    last_id = 0
+    stored = func.coalesce(Upload.file_url, Upload.content_key)  # spilled texts live in the file store too
+    while True:
+        rows = db.execute(
+            select(Upload.id, stored)
+            .where(Upload.id > last_id, stored.isnot(None))
+            .order_by(Upload.id)
+            .limit(MAINTENANCE_BATCH_SIZE)
+        ).all()
+        db.rollback()
+        if not rows:
+            break
+        for upload_id, file_url in rows:
+            stats["uploads_checked"] += 1
+            if not file_store.exists(file_url):
+                stats["uploads_missing"] += 1
+                _sample(stats, "missing_upload_ids", upload_id)
+        last_id = rows[-1].id
+    last = ""
+    while True:
+        rows = db.execute(
+            select(Blob.sha256, Blob.path).where(Blob.sha256 > last).order_by(Blob.sha256).limit(MAINTENANCE_BATCH_SIZE)
+        ).all()
+        db.rollback()
+        if not rows:
+            break
+        for sha256, path in rows:
+            stats["blobs_checked"] += 1
+            if not file_store.exists(path):
+                stats["blobs_missing"] += 1
+                _sample(stats, "missing_blobs", sha256)
+        last = rows[-1].sha256
+
+# name -> (job, how often the scheduler runs it, in seconds)
+JOBS = {
+    "expired_shares": (expire_shares, MAINTENANCE_INTERVAL),
+    "pending_deletions": (process_deletions, MAINTENANCE_INTERVAL),
+    "unreferenced_blobs": (reclaim_unreferenced_blobs, MAINTENANCE_INTERVAL),
+    "upload_sessions": (expire_upload_sessions, MAINTENANCE_INTERVAL),
+    "exports": (expire_exports, MAINTENANCE_INTERVAL),
+    "orphan_files": (remove_orphan_files, MAINTENANCE_SCAN_INTERVAL),
+    "missing_files": (find_missing_files, MAINTENANCE_SCAN_INTERVAL),
+    "compress_text": (compress_texts, MAINTENANCE_SCAN_INTERVAL),
+}
+
+def run_job(name: str, dry_run: bool = False) -> dict:
+    """Run one job now and record it as a MaintenanceRun, returning the run as a dict."""
+    job, _ = JOBS[name]
+    db = SessionLocal()
+    try:
+        run = MaintenanceRun(job=name, dry_run=dry_run, status="running", started_at=datetime.utcnow())
+        db.add(run)
+        db.commit()
+        stats = {}
+        try:
+            job(db, dry_run, stats)
+            run.status = "ok"
+        except Exception as e:
+            db.rollback()
+            logger.exception("Maintenance job %s failed", name)
+            run.status = "failed"
+            run.error = str(e)
+        run.stats = json.dumps(stats)
+        run.finished_at = datetime.utcnow()
+        db.commit()
+        return run_info(run)
+    finally:
+        db.close()
+
+def run_info(run: MaintenanceRun) -> dict:
+    return {
+        "id": run.id,
+        "job": run.job,
+        "dry_run": run.dry_run,
+        "status": run.status,
+        "started_at": run.started_at.isoformat() if run.started_at else None,
+        "finished_at": run.finished_at.isoformat() if run.finished_at else None,
+        "duration_ms": round((run.finished_at - run.started_at).total_seconds() * 1000, 1) if run.finished_at else None,
+        "stats": json.loads(run.stats) if run.stats else {},
+        "error": run.error,
+    }
+
+def recent_runs(db: Session, job: str = None, limit: int = 20):
+    query = db.query(MaintenanceRun)
+    if job:
+        query = query.filter(MaintenanceRun.job == job)
+    return [run_info(r) for r in query.order_by(MaintenanceRun.started_at.desc(), MaintenanceRun.id.desc()).limit(limit)]
+
+def prune_runs(db: Session):
+    cutoff = datetime.utcnow() - timedelta(days=MAINTENANCE_RUN_RETENTION_DAYS)
+    db.execute(delete(MaintenanceRun).where(MaintenanceRun.started_at < cutoff))
+    db.commit()
+
+class MaintenanceScheduler:
+    """Runs each job in JOBS on its interval from a background thread.
+
+    Every gunicorn worker starts one, but only the worker holding an
+    exclusive flock on MAINTENANCE_LOCK_PATH runs jobs; if it dies the
+    kernel drops the lock and another worker takes over on its next tick.
+    """
+
+    def __init__(self, dry_run: bool = MAINTENANCE_DRY_RUN, lock_path: str = MAINTENANCE_LOCK_PATH, tick: float = 30.0):
+        self.dry_run = dry_run
+        self.lock_path = lock_path
+        self.tick = min(tick, MAINTENANCE_INTERVAL)
+        self._lock_file = None
+        self._last_run = {}
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._lock_file is not None
+
+    def _acquire(self) -> bool:
+        if self._lock_file is None:
+            f = open(self.lock_path, "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+            self._lock_file = f
+        return True
+
+    def _release(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def run_due_jobs(self):
+        now = time.monotonic()
+        for name, (_, interval) in JOBS.items():
+            if self._stopping:
+                break
+            last = self._last_run.get(name)
+            if last is None or now - last >= interval:
+                self._last_run[name] = time.monotonic()
+                run_job(name, dry_run=self.dry_run)
+        db = SessionLocal()
+        try:
+            prune_runs(db)
+        finally:
+            db.close()
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                if self._acquire():
+                    self.run_due_jobs()
+            except Exception:
+                logger.exception("Maintenance tick failed")
+            self._wake.wait(self.tick)
+
+    def start(self):
+        if MAINTENANCE_ENABLED and self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping = True
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+        self._release()
+
+    def status(self):
+        return {
+            "enabled": MAINTENANCE_ENABLED,
+            "running": self._thread is not None,
+            "leader": self.is_leader,
+            "pid": os.getpid(),
+            "dry_run": self.dry_run,
+            "jobs": {name: interval for name, (_, interval) in JOBS.items()},
+        }
+
+maintenance = MaintenanceScheduler()
@@ -0,0 +1,171 @@
+import argparse
+from database import SessionLocal, engine
+from storage import reconcile_storage, gc_upload_sessions, migrate_legacy_files, rekey_legacy_paths, copy_store
+from filestore import make_backend, BACKENDS
+from analytics import rebuild_rollups
+from exports import gc_export_jobs
+from maintenance import JOBS, run_job
+from shares import migrate_legacy_share_tokens
+from media import backfill, retry_failed
+from search import build_search_index
+from migrations import migrate, status as migration_status
+
+# Maintenance commands: python manage.py <command>
+
+def cmd_reconcile_storage(args):
+    db = SessionLocal()
+    try:
+        updated = reconcile_storage(db, batch_size=args.batch_size)
+        print(f"Reconciled storage counters ({updated} upload sizes corrected)")
+    finally:
+        db.close()
+
+def cmd_gc_upload_sessions(args):
+    db = SessionLocal()
+    try:
+        removed = gc_upload_sessions(db)
+        print(f"Removed {removed} expired upload sessions")
+    finally:
+        db.close()
+
+def cmd_migrate_blobs(args):
+    db = SessionLocal()
+    try:
+        migrated = migrate_legacy_files(db, batch_size=args.batch_size)
+        print(f"Moved {migrated} legacy files into the blob store")
+    finally:
+        db.close()
+
+def cmd_rebuild_rollups(args):
+    db = SessionLocal()
+    try:
+        processed = rebuild_rollups(db, batch_size=args.batch_size)
+        print(f"Rebuilt analytics rollups from {processed} events")
+    finally:
+        db.close()
+
+def cmd_gc_exports(args):
+    db = SessionLocal()
+    try:
+        removed = gc_export_jobs(db)
+        print(f"Removed {removed} expired export archives")
+    finally:
+        db.close()
+
+def cmd_migrate_share_links(args):
+    db = SessionLocal()
+    try:
+        migrated = migrate_legacy_share_tokens(db, batch_size=args.batch_size)
+        print(f"Copied {migrated} share tokens into share_links; uploads.share_token and share_expires_at can now be dropped")
+    finally:
+        db.close()
+
+def cmd_migrate_storage(args):
+    # Safe to run against a live app, and to re-run: every step skips what is already done
+    db = SessionLocal()
+    try:
+        migrated = migrate_legacy_files(db, batch_size=args.batch_size)
+        print(f"Moved {migrated} legacy upload files into the blob store")
+        stats = rekey_legacy_paths(db, batch_size=args.batch_size, pause=args.pause)
+        print(f"Re-keyed {stats['blobs']} blobs and {stats['photos']} profile photos ({stats['missing']} files missing)")
+    finally:
+        db.close()
+    if args.to:
+        source, target = make_backend(args.source), make_backend(args.to)
+        stats = copy_store(source, target, batch_size=args.batch_size, pause=args.pause)
+        print(f"Copied {stats['copied']} files ({stats['bytes']} bytes) from {source.name} to {target.name}, {stats['skipped']} already there")
+
+def cmd_media_backfill(args):
+    db = SessionLocal()
+    try:
+        queued = backfill(db, batch_size=args.batch_size)
+        print(f"Queued media processing for {queued} uploads")
+    finally:
+        db.close()
+
+def cmd_media_retry(args):
+    db = SessionLocal()
+    try:
+        print(f"Re-queued {retry_failed(db)} failed media jobs")
+    finally:
+        db.close()
+
+def cmd_search_index(args):
+    print(f"Search index ready: {build_search_index(engine)}")
+
+def cmd_migrate(args):
+    if args.status:
+        for m in migration_status(engine):
+            print(f"{m['version']:04d} {m['name']:<12} {m['applied_at'] or 'pending'}  {m['description']}")
+        return
+    applied = migrate(engine, target=args.target)
+    for version, name, seconds in applied:
+        print(f"Applied {version:04d} {name} in {seconds:.2f}s")
+    if not applied:
+        print("Schema up to date")
+
+def cmd_maintenance(args):
+    for name in args.job or JOBS:
+        run = run_job(name, dry_run=args.dry_run)
+        print(f"{name}: {run['status']}{' (dry run)' if args.dry_run else ''} in {run['duration_ms']} ms {run['stats']}")
+        if run["error"]:
+            print(f"  error: {run['error']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="DataForge maintenance commands")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("migrate", help="Apply pending schema migrations (gunicorn runs this before starting workers)")
+    p.add_argument("--status", action="store_true", help="List migrations and when each was applied")
+    p.add_argument("--target", type=int, help="Stop after this version")
+    p.set_defaults(func=cmd_migrate)
+
+    p = sub.add_parser("reconcile-storage", help="Rebuild per-user storage counters from uploads/ on disk")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=cmd_reconcile_storage)
+
+    p = sub.add_parser("gc-upload-sessions", help="Delete abandoned multipart upload sessions and their parts")
+    p.set_defaults(func=cmd_gc_upload_sessions)
+
+    p = sub.add_parser("migrate-blobs", help="Move flat uploads/ files into the content-addressed blob store")
+    p.add_argument("--batch-size", type=int, default=100)
+    p.set_defaults(func=cmd_migrate_blobs)
+
+    p = sub.add_parser("rebuild-rollups", help="Recompute the hourly and daily analytics rollups from raw events")
+    p.add_argument("--batch-size", type=int, default=5000)
+    p.set_defaults(func=cmd_rebuild_rollups)
+
+    p = sub.add_parser("gc-exports", help="Delete expired deferred export archives")
+    p.set_defaults(func=cmd_gc_exports)
+
+    p = sub.add_parser("migrate-share-links", help="Copy share tokens from the old uploads columns into share_links (migration 0006 does this too)")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=cmd_migrate_share_links)
+
+    p = sub.add_parser("migrate-storage", help="Move stored files into the sharded key layout, optionally copying them to another backend")
+    p.add_argument("--to", choices=list(BACKENDS), help="Also copy every stored file to this backend")
+    p.add_argument("--from", dest="source", choices=list(BACKENDS), default="local", help="Backend to copy from (default: local)")
+    p.add_argument("--batch-size", type=int, default=100)
+    p.add_argument("--pause", type=float, default=0.1, help="Seconds to sleep between batches, to leave I/O for requests")
+    p.set_defaults(func=cmd_migrate_storage)
+
+    p = sub.add_parser("media-backfill", help="Queue thumbnail and metadata processing for uploads that never had it")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=cmd_media_backfill)
+
+    p = sub.add_parser("media-retry", help="Re-queue media jobs that used up their attempts")
+    p.set_defaults(func=cmd_media_retry)
+
+    p = sub.add_parser("search-index", help="Build the full-text search column and index and index existing texts (safe to re-run)")
+    p.set_defaults(func=cmd_search_index)
+
+    p = sub.add_parser("maintenance", help="Run background maintenance jobs now (all of them unless --job is given)")
+    p.add_argument("--job", action="append", choices=list(JOBS))
+    p.add_argument("--dry-run", action="store_true", help="Only report what would be removed")
+    p.set_defaults(func=cmd_maintenance)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
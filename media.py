@@ -0,0 +1,493 @@
+from sqlalchemy import select, update, func, or_, and_
+from sqlalchemy.orm import Session
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+import fcntl
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import struct
+import subprocess
+import threading
+from config import (
+    MEDIA_ENABLED, MEDIA_LOCK_PATH, MEDIA_WORKERS, MEDIA_POLL_INTERVAL, MEDIA_MAX_ATTEMPTS,
+    MEDIA_RETRY_BACKOFF, MEDIA_JOB_TIMEOUT, MEDIA_MAX_PIXELS, MEDIA_VARIANT_FORMAT,
+    MEDIA_VARIANT_QUALITY, MEDIA_VARIANTS
+)
+from database import SessionLocal
+from models import Upload, MediaJob, MediaVariant
+from filestore import file_store
+from storage import temp_path, copy_stream, enqueue_media_jobs, schedule_file_deletion
+
+logger = logging.getLogger(__name__)
+
+# Post-upload media processing. create_upload queues a MediaJob in the same
+# transaction as the Upload; the worker below claims queued jobs, runs
+# process_media in a process pool (CPU-heavy decoding never touches the event
+# loop or the GIL of a request worker), then stores the variants and writes
+# the metadata back onto the Upload row.
+
+# Bytes -> MIME type, by magic number rather than the client's file name
+
+_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"%PDF-", "application/pdf"),
+    (b"PK\x03\x04", "application/zip"),
+    (b"\x1f\x8b", "application/gzip"),
+    (b"OggS", "application/ogg"),
+    (b"ID3", "audio/mpeg"),
+    (b"fLaC", "audio/flac"),
+]
+_FTYP_BRANDS = {
+    b"heic": "image/heic", b"heix": "image/heic", b"mif1": "image/heif", b"avif": "image/avif",
+    b"qt  ": "video/quicktime", b"M4A ": "audio/mp4",
+}
+
+def sniff_mime(head: bytes) -> str:
+    for magic, mime in _SIGNATURES:
+        if head.startswith(magic):
+            return mime
+    if head[:4] == b"RIFF":
+        return {b"WEBP": "image/webp", b"AVI ": "video/x-msvideo", b"WAVE": "audio/wav"}.get(head[8:12], "application/octet-stream")
+    if head[4:8] == b"ftyp":
+        return _FTYP_BRANDS.get(head[8:12], "video/mp4")
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "video/webm" if b"webm" in head[:64] else "video/x-matroska"
+    return "application/octet-stream"
+
+def _find_box(f, start: int, end: int, kind: bytes):
+    # ISO BMFF (MP4/MOV) box scan; returns (payload start, box end)
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        size, box = struct.unpack(">I4s", header)
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return None
+        if box == kind:
+            return pos + header, pos + size
+        pos += size
+    return None
+
+def mp4_duration_ms(path: str):
+    """Duration from the movie header, without decoding anything."""
+    with open(path, "rb") as f:
+        moov = _find_box(f, 0, os.fstat(f.fileno()).st_size, b"moov")
+        mvhd = moov and _find_box(f, moov[0], moov[1], b"mvhd")
+        if not mvhd:
+            return None
+        f.seek(mvhd[0])
+        version = f.read(4)[0]
+        if version == 1:
+            f.seek(16, os.SEEK_CUR)
+            timescale, duration = struct.unpack(">IQ", f.read(12))
+        else:
+            f.seek(8, os.SEEK_CUR)
+            timescale, duration = struct.unpack(">II", f.read(8))
+        return int(duration * 1000 / timescale) if timescale else None
+
+def _probe_video(path: str) -> dict:
+    # ffprobe when available; otherwise only the MP4/MOV duration
+    if shutil.which("ffprobe"):
+        out = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries",
+             "stream=width,height:format=duration", "-of", "json", path],
+            capture_output=True, timeout=60, check=True,
+        ).stdout
+        info = json.loads(out)
+        stream = (info.get("streams") or [{}])[0]
+        duration = info.get("format", {}).get("duration")
+        return {
+            "width": stream.get("width"),
+            "height": stream.get("height"),
+            "duration_ms": int(float(duration) * 1000) if duration else None,
+        }
+    return {"duration_ms": mp4_duration_ms(path)}
+
+def _poster_frame(path: str, out_dir: str, duration_ms):
+    # One frame, a second in (or at the start of short clips), as a lossless PNG for Pillow to resize
+    if not shutil.which("ffmpeg"):
+        return None
+    out = os.path.join(out_dir, "poster.png")
+    at = "1" if not duration_ms or duration_ms > 2000 else "0"
+    subprocess.run(
+        ["ffmpeg", "-v", "error", "-y", "-ss", at, "-i", path, "-frames:v", "1", out],
+        capture_output=True, timeout=120, check=True,
+    )
+    return out if os.path.exists(out) else None
+
+def _image_variants(path: str, out_dir: str) -> dict:
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return {}
+    Image.MAX_IMAGE_PIXELS = None  # checked below, before anything is decoded
+    with Image.open(path) as im:
+        width, height = im.size
+        if im.getexif().get(0x0112) in (5, 6, 7, 8):  # EXIF orientation rotated by 90 degrees
+            width, height = height, width
+        result = {"width": width, "height": height, "variants": []}
+        if width * height > MEDIA_MAX_PIXELS:
+            return result
+        # JPEG can decode straight to a reduced scale, which is most of the work saved
+        largest = max(MEDIA_VARIANTS.values())
+        im.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(im)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if image.mode in ("LA", "PA", "P") or "transparency" in image.info else "RGB")
+        # Largest first, each one downscaled from the previous
+        ext = MEDIA_VARIANT_FORMAT.lower()
+        for name, edge in sorted(MEDIA_VARIANTS.items(), key=lambda item: -item[1]):
+            if max(image.size) > edge:
+                image = image.copy()
+                image.thumbnail((edge, edge), Image.LANCZOS)
+            out = os.path.join(out_dir, f"{name}.{ext}")
+            image.save(out, MEDIA_VARIANT_FORMAT, quality=MEDIA_VARIANT_QUALITY, method=4 if ext == "webp" else 0)
+            result["variants"].append({
+                "name": name, "path": out, "width": image.size[0], "height": image.size[1],
+                "mime_type": Image.MIME.get(MEDIA_VARIANT_FORMAT.upper(), "application/octet-stream"),
+                "size_bytes": os.path.getsize(out),
+            })
+    return result
+
+def process_media(task: dict) -> dict:
+    """Runs in the pool: read task["path"], write variants into task["out_dir"], return metadata."""
+    path, out_dir = task["path"], task["out_dir"]
+    with open(path, "rb") as f:
+        head = f.read(64)
+    meta = {"mime_type": sniff_mime(head), "variants": []}
+    mime = meta["mime_type"]
+    if mime.startswith("image/"):
+        try:
+            meta.update(_image_variants(path, out_dir))
+        except Exception as e:
+            # Truncated or unsupported image: keep the sniffed type, skip variants
+            meta["warning"] = f"{type(e).__name__}: {e}"
+    elif mime.startswith("video/"):
+        meta.update(_probe_video(path))
+        poster = _poster_frame(path, out_dir, meta.get("duration_ms"))
+        if poster:
+            frame = _image_variants(poster, out_dir)
+            if not meta.get("width"):
+                meta["width"], meta["height"] = frame.get("width"), frame.get("height")
+            meta["variants"] = frame.get("variants", [])
+    return meta
+
+def _lower_priority():
+    # Pool processes yield the CPU to request handling
+    try:
+        os.nice(10)
+    except OSError:
+        pass
+
+# Queue
+
+def claim_jobs(db: Session, limit: int) -> list:
+    """Mark up to limit due jobs running and return their ids.
+
+    Each claim is a conditional UPDATE, so concurrent workers (on this host
+    or others) never run the same job; running jobs whose lock is older
+    than MEDIA_JOB_TIMEOUT are taken over as lost.
+    """
+    now = datetime.utcnow()
+    due = or_(
+        and_(MediaJob.status == "queued", MediaJob.run_after <= now),
+        and_(MediaJob.status == "running", MediaJob.locked_at < now - timedelta(seconds=MEDIA_JOB_TIMEOUT)),
+    )
+    candidates = db.execute(
+        select(MediaJob.id).where(due).order_by(MediaJob.run_after).limit(limit * 2)
+    ).scalars().all()
+    claimed = []
+    for job_id in candidates:
+        result = db.execute(
+            update(MediaJob)
+            .where(MediaJob.id == job_id, due)
+            .values(status="running", locked_at=now, attempts=MediaJob.attempts + 1)
+        )
+        if result.rowcount == 1:
+            claimed.append(job_id)
+            if len(claimed) >= limit:
+                break
+    db.commit()
+    return claimed
+
+def _source_path(key: str):
+    """A local path holding the upload's bytes, and whether it is a temp copy to remove afterwards."""
+    local = file_store.local_path(key)
+    if local and os.path.exists(local):
+        return os.path.abspath(local), False
+    tmp = os.path.abspath(temp_path())
+    with file_store.open(key) as src:
+        copy_stream(src, tmp)
+    return tmp, True
+
+def save_results(db: Session, upload_id: int, meta: dict):
+    """Store the variants written by process_media and record them on the Upload."""
+    upload = db.get(Upload, upload_id)
+    if upload is None:
+        return False
+    old = {v.name: v for v in upload.variants}
+    replaced = []  # stored files no variant points at any more
+    for item in meta.get("variants", []):
+        ext = os.path.splitext(item["path"])[1]
+        key = f"variants/{upload_id}_{item['name']}{ext}"
+        file_store.put(key, item["path"])
+        variant = old.pop(item["name"], None) or MediaVariant(upload_id=upload_id, name=item["name"])
+        if variant.key and variant.key != key:
+            replaced.append(variant.key)
+        variant.key = key
+        variant.mime_type = item["mime_type"]
+        variant.width = item["width"]
+        variant.height = item["height"]
+        variant.size_bytes = item["size_bytes"]
+        variant.created_at = datetime.utcnow()
+        db.add(variant)
+    for variant in old.values():
+        db.delete(variant)
+    schedule_file_deletion(db, replaced + [v.key for v in old.values()], reason="variant_replaced")
+    upload.mime_type = meta.get("mime_type")
+    upload.width = meta.get("width")
+    upload.height = meta.get("height")
+    upload.duration_ms = meta.get("duration_ms")
+    upload.media_status = "done"
+    return True
+
+def finish_job(db: Session, job_id: int, meta: dict = None, error: str = None):
+    job = db.get(MediaJob, job_id)
+    if job is None:
+        return
+    if error is None:
+        # Done jobs are dropped (so are jobs whose upload was deleted meanwhile):
+        # the queue only keeps work still to do, and failures to look at
+        save_results(db, job.upload_id, meta)
+        db.delete(job)
+        db.commit()
+        return
+    job.error = error[:2000]
+    if job.attempts >= MEDIA_MAX_ATTEMPTS:
+        job.status = "failed"
+        job.finished_at = datetime.utcnow()
+        db.execute(update(Upload).where(Upload.id == job.upload_id).values(media_status="failed"))
+    else:
+        job.status = "queued"
+        job.locked_at = None
+        job.run_after = datetime.utcnow() + timedelta(seconds=MEDIA_RETRY_BACKOFF * 2 ** (job.attempts - 1))
+    db.commit()
+
+def queue_stats(db: Session) -> dict:
+    counts = dict(db.execute(select(MediaJob.status, func.count(MediaJob.id)).group_by(MediaJob.status)).all())
+    oldest = db.execute(select(func.min(MediaJob.run_after)).where(MediaJob.status == "queued")).scalar()
+    return {"jobs": counts, "oldest_queued": oldest.isoformat() if oldest else None}
+
+def retry_failed(db: Session) -> int:
+    result = db.execute(
+        update(MediaJob).where(MediaJob.status == "failed")
+        .values(status="queued", attempts=0, run_after=datetime.utcnow(), locked_at=None, error=None)
+    )
+    db.commit()
+    return result.rowcount
+
+def backfill(db: Session, batch_size: int = 1000) -> int:
+    """Queue jobs for file uploads that have never been processed (e.g. from before this worker existed)."""
+    queued = 0
+    last_id = 0
+    while True:
+        ids = db.execute(
+            select(Upload.id)
+            .where(Upload.id > last_id, Upload.file_url.isnot(None), Upload.media_status.is_(None))
+            .order_by(Upload.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        enqueue_media_jobs(db, ids)
+        db.execute(update(Upload).where(Upload.id.in_(ids)).values(media_status="pending"))
+        db.commit()
+        queued += len(ids)
+        last_id = ids[-1]
+    return queued
+
+class MediaWorker:
+    """Feeds queued MediaJobs to a process pool from a background thread.
+
+    Like the maintenance scheduler, every gunicorn worker starts one but only
+    the holder of an flock on MEDIA_LOCK_PATH runs jobs, so a host never has
+    more than MEDIA_WORKERS media processes.
+    """
+
+    def __init__(self, workers: int = MEDIA_WORKERS, lock_path: str = MEDIA_LOCK_PATH, poll: float = MEDIA_POLL_INTERVAL):
+        self.workers = workers
+        self.lock_path = lock_path
+        self.poll = poll
+        self._lock_file = None
+        self._pool = None
+        self._in_flight = {}  # future -> (job id, temp paths to remove)
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self.processed = 0
+        self.failed = 0
+
+    @property
+    def is_leader(self) -> bool:
+        return self._lock_file is not None
+
+    def _acquire(self) -> bool:
+        if self._lock_file is None:
+            f = open(self.lock_path, "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+            self._lock_file = f
+        return True
+
+    def _release(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _submit(self, db: Session, job_id: int):
+        row = db.execute(
+            select(Upload.id, Upload.file_url).join(MediaJob, MediaJob.upload_id == Upload.id).where(MediaJob.id == job_id)
+        ).first()
+        db.rollback()
+        if row is None or not row.file_url:
+            finish_job(db, job_id, error="Upload has no stored file")
+            return
+        # Absolute paths: pool processes don't share the app's working directory
+        out_dir = os.path.abspath(temp_path())
+        os.makedirs(out_dir)
+        cleanup = [out_dir]
+        try:
+            path, is_copy = _source_path(row.file_url)
+        except FileNotFoundError:
+            shutil.rmtree(out_dir, ignore_errors=True)
+            finish_job(db, job_id, error="File missing from storage")
+            return
+        if is_copy:
+            cleanup.append(path)
+        try:
+            future = self._pool.submit(process_media, {"upload_id": row.id, "path": path, "out_dir": out_dir})
+        except BrokenProcessPool:
+            self._reset_pool()
+            future = self._pool.submit(process_media, {"upload_id": row.id, "path": path, "out_dir": out_dir})
+        self._in_flight[future] = (job_id, cleanup)
+        future.add_done_callback(lambda _: self._wake.set())
+
+    def _ensure_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_lower_priority
+            )
+
+    def _reset_pool(self):
+        # A child that died (OOM kill, segfault in a decoder) breaks the whole pool
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = None
+        self._ensure_pool()
+
+    def _collect(self, db: Session):
+        broken = False
+        for future in [f for f in self._in_flight if f.done()]:
+            job_id, cleanup = self._in_flight.pop(future)
+            try:
+                meta = future.result()
+            except BrokenProcessPool as e:
+                logger.warning("Media job %s lost its worker process: %s", job_id, e)
+                finish_job(db, job_id, error=f"Worker process died: {e}")
+                self.failed += 1
+                broken = True
+            except Exception as e:
+                logger.warning("Media job %s failed: %s", job_id, e)
+                finish_job(db, job_id, error=f"{type(e).__name__}: {e}")
+                self.failed += 1
+            else:
+                try:
+                    finish_job(db, job_id, meta)
+                    self.processed += 1
+                except Exception as e:
+                    db.rollback()
+                    logger.exception("Saving media job %s failed", job_id)
+                    finish_job(db, job_id, error=f"{type(e).__name__}: {e}")
+                    self.failed += 1
+            for path in cleanup:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.remove(path)
+        if broken and not self._in_flight:
+            self._reset_pool()
+
+    def run_once(self):
+        self._ensure_pool()
+        db = SessionLocal()
+        try:
+            self._collect(db)
+            free = self.workers - len(self._in_flight)
+            if free > 0 and not self._stopping:
+                for job_id in claim_jobs(db, free):
+                    self._submit(db, job_id)
+        finally:
+            db.close()
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                if self._acquire():
+                    self.run_once()
+            except Exception:
+                logger.exception("Media worker tick failed")
+            self._wake.wait(self.poll)
+            self._wake.clear()
+
+    def start(self):
+        if MEDIA_ENABLED and self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="media", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping = True
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            # Jobs still running are picked up again once their lock goes stale
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+            self._in_flight.clear()
+        self._release()
+
+    def status(self):
+        return {
+            "enabled": MEDIA_ENABLED,
+            "running": self._thread is not None,
+            "leader": self.is_leader,
+            "pid": os.getpid(),
+            "workers": self.workers,
+            "in_flight": len(self._in_flight),
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+media_worker = MediaWorker()
@@ -0,0 +1,337 @@
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from bisect import bisect_left
+from collections import defaultdict
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from config import METRICS_ENABLED, METRICS_FLUSH_INTERVAL, METRICS_LOOP_LAG_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Prometheus-style metrics without a client library.
+# Recording is an in-memory dict update under a per-metric lock. Each worker
+# publishes a JSON snapshot to the shared store (shared_state.py) every
+# METRICS_FLUSH_INTERVAL seconds and /metrics merges the snapshots of every
+# worker on the host, so a scrape sees all gunicorn workers, not just one.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = defaultdict(float)
+
+    def inc(self, labels=(), amount: float = 1.0):
+        with self._lock:
+            self.values[labels] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(k): v for k, v in self.values.items()}
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), aggregate: str = "sum"):
+        super().__init__(name, help, labels)
+        self.aggregate = aggregate  # how workers combine: "sum" or "max"
+        self.values = defaultdict(float)
+
+    def set(self, value: float, labels=()):
+        with self._lock:
+            self.values[labels] = value
+
+    def inc(self, labels=(), amount: float = 1.0):
+        with self._lock:
+            self.values[labels] += amount
+
+    def dec(self, labels=(), amount: float = 1.0):
+        self.inc(labels, -amount)
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(k): v for k, v in self.values.items()}
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # labels -> per-bucket counts (not cumulative), +Inf count, then sum
+        self.values = {}
+
+    def observe(self, value: float, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            row = self.values.get(labels)
+            if row is None:
+                row = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[index] += 1
+            row[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(k): list(v) for k, v in self.values.items()}
+
+REGISTRY = {}
+
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "Request latency by route template and status", ("method", "route", "status"))
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests currently being served")
+UPLOAD_BYTES = Counter("upload_bytes_total", "Bytes received for uploads", ("source",))
+UPLOAD_SECONDS = Counter("upload_receive_seconds_total", "Time spent receiving upload bytes", ("source",))
+UPLOAD_THROUGHPUT = Histogram(
+    "upload_throughput_bytes_per_second", "Receive throughput of individual uploads", ("source",),
+    buckets=(64 * 1024, 256 * 1024, 1 << 20, 4 << 20, 16 << 20, 64 << 20, 256 << 20, 1 << 30),
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request", "Database queries issued while serving one request", ("route",),
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100),
+)
+DB_TIME_PER_REQUEST = Histogram("db_time_per_request_seconds", "Time spent in database queries per request", ("route",))
+DB_QUERY_DURATION = Histogram("db_query_duration_seconds", "Duration of individual database queries")
+LOOP_LAG = Histogram(
+    "event_loop_lag_seconds", "How late a periodic event-loop timer fires",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+LOOP_LAG_LAST = Gauge("event_loop_lag_last_seconds", "Most recent event-loop lag sample (max over workers)", aggregate="max")
+
+# Per-request accounting. The middleware puts a RequestStats in a context var;
+# threadpool calls and SQLAlchemy's async greenlets inherit the context, so the
+# cursor hooks below find the request they are running for.
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+_request_stats = contextvars.ContextVar("request_stats", default=None)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_started = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_metrics_started", None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    DB_QUERY_DURATION.observe(elapsed)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+
+def observe_upload(source: str, size: int, seconds: float):
+    UPLOAD_BYTES.inc((source,), size)
+    UPLOAD_SECONDS.inc((source,), seconds)
+    if seconds > 0 and size:
+        UPLOAD_THROUGHPUT.observe(size / seconds, (source,))
+
+def route_template(scope) -> str:
+    # The matched route's path template (/api/v2/{username}), never the raw path,
+    # so label cardinality stays bounded
+    route = scope.get("route")
+    if route is not None and getattr(route, "path", None):
+        return route.path
+    return "unmatched"
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_IN_FLIGHT.dec()
+            _request_stats.reset(token)
+            route = route_template(scope)
+            HTTP_LATENCY.observe(elapsed, (scope["method"], route, str(status)))
+            DB_QUERIES_PER_REQUEST.observe(stats.queries, (route,))
+            DB_TIME_PER_REQUEST.observe(stats.db_seconds, (route,))
+
+# Cross-worker aggregation
+
+def snapshot() -> dict:
+    return {name: metric.snapshot() for name, metric in REGISTRY.items()}
+
+def merge(snapshots) -> dict:
+    merged = {}
+    for snap in snapshots:
+        for name, series in snap.items():
+            metric = REGISTRY.get(name)
+            if metric is None:
+                continue
+            target = merged.setdefault(name, {})
+            for key, value in series.items():
+                if key not in target:
+                    target[key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    target[key] = [a + b for a, b in zip(target[key], value)]
+                elif metric.kind == "gauge" and metric.aggregate == "max":
+                    target[key] = max(target[key], value)
+                else:
+                    target[key] += value
+    return merged
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(10), chr(92) + "n").replace(chr(34), chr(92) + chr(34))}"'
+        for k, v in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+def render(merged: dict, workers: int = 1) -> str:
+    """Text exposition format (version 0.0.4)."""
+    lines = [
+        "# HELP metrics_workers Workers whose snapshot is included in this scrape",
+        "# TYPE metrics_workers gauge",
+        f"metrics_workers {workers}",
+    ]
+    for name, metric in REGISTRY.items():
+        series = merged.get(name)
+        if not series:
+            continue
+        lines.append(f"# HELP {name} {metric.help}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for key in sorted(series):
+            labels = tuple(json.loads(key))
+            value = series[key]
+            if metric.kind != "histogram":
+                lines.append(f"{name}{_format_labels(metric.labels, labels)} {_format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float("inf"),), value[:-1]):
+                cumulative += count
+                le = _format_value(bound) if bound != float("inf") else "+Inf"
+                lines.append(f"{name}_bucket{_format_labels(metric.labels, labels, [('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(metric.labels, labels)} {_format_value(value[-1])}")
+            lines.append(f"{name}_count{_format_labels(metric.labels, labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+RETIRED_TTL = 7 * 24 * 3600
+
+class MetricsExporter:
+    """Publishes this worker's snapshot and samples event-loop lag."""
+
+    def __init__(self, flush_interval: float = METRICS_FLUSH_INTERVAL, lag_interval: float = METRICS_LOOP_LAG_INTERVAL):
+        self.flush_interval = flush_interval
+        self.lag_interval = lag_interval
+        self._key = f"metrics:{os.getpid()}"
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._lag_task = None
+
+    def publish(self):
+        from shared_state import get_shared_store
+        # Kept a few intervals past the last flush so a dead worker drops out of the totals
+        get_shared_store().set(self._key, json.dumps(snapshot()), self.flush_interval * 6)
+
+    def retire(self):
+        """Fold this worker's counters into metrics:retired so totals don't drop when it exits."""
+        from shared_state import get_shared_store
+        store = get_shared_store()
+        mine = {name: series for name, series in snapshot().items() if REGISTRY[name].kind != "gauge"}
+        store.conn.execute("BEGIN IMMEDIATE")
+        try:
+            previous = store.get("metrics:retired")
+            combined = merge([json.loads(previous), mine]) if previous else mine
+            store.set("metrics:retired", json.dumps(combined), RETIRED_TTL)
+            store.conn.execute("COMMIT")
+        except BaseException:
+            store.conn.execute("ROLLBACK")
+            raise
+        store.delete(self._key)
+
+    def collect(self) -> str:
+        from shared_state import get_shared_store
+        self.publish()
+        rows = get_shared_store().scan("metrics:")
+        workers = sum(1 for key, _ in rows if key != "metrics:retired")
+        return render(merge(json.loads(value) for _, value in rows), workers=workers)
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            try:
+                self.publish()
+            except Exception:
+                logger.exception("Publishing metrics snapshot failed")
+
+    async def _sample_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            lag = max(loop.time() - started - self.lag_interval, 0.0)
+            LOOP_LAG.observe(lag)
+            LOOP_LAG_LAST.set(lag)
+
+    def start(self):
+        # Called from the app's startup hook, i.e. on the worker's event loop
+        if not METRICS_ENABLED or self._thread is not None:
+            return
+        self._key = f"metrics:{os.getpid()}"  # gunicorn forks after import
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="metrics-publisher", daemon=True)
+        self._thread.start()
+        self._lag_task = asyncio.get_running_loop().create_task(self._sample_loop_lag())
+
+    def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._thread is not None:
+            self._stopping = True
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+            self.retire()
+
+metrics_exporter = MetricsExporter()
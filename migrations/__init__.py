@@ -0,0 +1,100 @@
+from sqlalchemy import text
+from contextlib import contextmanager
+from datetime import datetime
+import fcntl
+import importlib
+import logging
+import os
+import pkgutil
+import re
+import time
+from config import MIGRATIONS_LOCK_PATH
+
+logger = logging.getLogger("dataforge.migrations")
+
+# Versioned schema migrations, applied once per deploy before any web worker
+# starts (gunicorn.conf.py runs `python manage.py migrate` from the master), so
+# workers boot without creating or inspecting the schema.
+#
+# A migration is a module mNNNN_<name>.py in this package with an
+# upgrade(engine) function. It opens its own connections, so index builds can
+# run outside a transaction (CREATE INDEX CONCURRENTLY on Postgres). Applied
+# versions are recorded in schema_migrations.
+#
+# Migrations must be safe to re-run (IF NOT EXISTS and the like): m0001 creates
+# missing tables from the current models, so on a new database the later ones
+# find their work already done, and one interrupted halfway is simply run again.
+#
+# One runner at a time: a file lock on this host, plus a Postgres advisory lock
+# for deploys that start several hosts at once.
+
+ADVISORY_LOCK_ID = 0x64666D67  # any constant, shared by every runner
+_MODULE_RE = re.compile(r"^m(\d{4})_(\w+)$")
+
+LEDGER_DDL = (
+    "CREATE TABLE IF NOT EXISTS schema_migrations "
+    "(version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at TIMESTAMP NOT NULL, duration_ms INTEGER)"
+)
+
+def discover():
+    """[(version, name, module)] for every migration in this package, in version order."""
+    found = []
+    for info in pkgutil.iter_modules(__path__):
+        match = _MODULE_RE.match(info.name)
+        if match:
+            found.append((int(match.group(1)), match.group(2), importlib.import_module(f"{__name__}.{info.name}")))
+    found.sort(key=lambda m: m[0])
+    versions = [version for version, _, _ in found]
+    if len(set(versions)) != len(versions):
+        raise RuntimeError(f"Duplicate migration versions in {versions}")
+    return found
+
+def applied_versions(engine) -> dict:
+    with engine.begin() as conn:
+        conn.execute(text(LEDGER_DDL))
+        return dict(conn.execute(text("SELECT version, applied_at FROM schema_migrations")).all())
+
+@contextmanager
+def _runner_lock(engine):
+    os.makedirs(os.path.dirname(MIGRATIONS_LOCK_PATH) or ".", exist_ok=True)
+    with open(MIGRATIONS_LOCK_PATH, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        conn = None
+        try:
+            if engine.dialect.name == "postgresql":
+                conn = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+                conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": ADVISORY_LOCK_ID})
+            yield
+        finally:
+            if conn is not None:
+                conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": ADVISORY_LOCK_ID})
+                conn.close()
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def migrate(engine, target: int = None) -> list:
+    """Apply pending migrations up to target (default: all), returning [(version, name, seconds)]."""
+    done = []
+    with _runner_lock(engine):
+        # Read under the lock: a runner that waited sees what the previous one applied
+        applied = applied_versions(engine)
+        for version, name, module in discover():
+            if version in applied or (target is not None and version > target):
+                continue
+            logger.info("Applying migration %04d %s", version, name)
+            started = time.perf_counter()
+            module.upgrade(engine)
+            elapsed = time.perf_counter() - started
+            with engine.begin() as conn:
+                conn.execute(
+                    text("INSERT INTO schema_migrations (version, name, applied_at, duration_ms) VALUES (:version, :name, :at, :ms)"),
+                    {"version": version, "name": name, "at": datetime.utcnow(), "ms": int(elapsed * 1000)},
+                )
+            done.append((version, name, round(elapsed, 3)))
+    return done
+
+def status(engine) -> list:
+    applied = applied_versions(engine)
+    return [
+        {"version": version, "name": name, "description": (module.__doc__ or "").strip(), "applied_at": applied.get(version)}
+        for version, name, module in discover()
+    ]
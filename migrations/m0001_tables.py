@@ -0,0 +1,8 @@
+"""Create missing tables, with their indexes, from the models."""
+from database import Base
+import models  # noqa: F401  (registers the tables on Base)
+
+def upgrade(engine):
+    # Only tables that don't exist yet; columns and indexes added to existing
+    # tables belong in their own migrations
+    Base.metadata.create_all(bind=engine)
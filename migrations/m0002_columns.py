@@ -0,0 +1,32 @@
+"""Add columns introduced before migrations existed to databases created without them."""
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+import logging
+from database import Base
+import models  # noqa: F401
+
+logger = logging.getLogger("dataforge.migrations")
+
+# Every column here is nullable or has a constant server default, which
+# Postgres (11+) adds without rewriting the table. lock_timeout keeps an ALTER
+# stuck behind a long transaction from queueing every query on the table.
+
+def upgrade(engine):
+    existing = inspect(engine)
+    tables = set(existing.get_table_names())
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            conn.execute(text("SET LOCAL lock_timeout = '10s'"))
+        for table in Base.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            present = {column["name"] for column in existing.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in present:
+                    continue
+                ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                logger.info("Adding %s.%s", table.name, column.name)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+        if engine.dialect.name == "postgresql":
+            # Already compressed (textstore.py): stored out of line without another pglz attempt
+            conn.execute(text("ALTER TABLE uploads ALTER COLUMN content_blob SET STORAGE EXTERNAL"))
@@ -0,0 +1,43 @@
+"""Create the models' indexes missing from older databases, concurrently on Postgres."""
+from sqlalchemy import text
+import logging
+from database import Base
+import models  # noqa: F401
+
+logger = logging.getLogger("dataforge.migrations")
+
+# Covers the hot-query indexes databases created before them lack:
+# ix_uploads_user_created_id (listings), ix_analytics_user_timestamp (analytics
+# reads and rollups), the share_links indexes (share tokens moved there from
+# uploads.share_token, and the token is its primary key), and the job queues'.
+#
+# On Postgres each is built with CREATE INDEX CONCURRENTLY, so writes continue
+# during the build. A concurrent build that fails leaves an INVALID index
+# behind that IF NOT EXISTS would skip, so one is dropped and rebuilt.
+
+INVALID_INDEX = """
+SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+WHERE c.relname = :name AND NOT i.indisvalid
+"""
+
+def _create(conn, index, postgres: bool):
+    quote = conn.dialect.identifier_preparer.quote
+    columns = ", ".join(quote(column.name) for column in index.columns)
+    if postgres and conn.execute(text(INVALID_INDEX), {"name": index.name}).first():
+        logger.warning("Rebuilding invalid index %s", index.name)
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {quote(index.name)}"))
+    conn.execute(text(
+        f"CREATE {'UNIQUE ' if index.unique else ''}INDEX {'CONCURRENTLY ' if postgres else ''}"
+        f"IF NOT EXISTS {quote(index.name)} ON {quote(index.table.name)} ({columns})"
+    ))
+
+def build_index(engine, index):
+    """Create one model index if missing; later migrations adding indexes use this too."""
+    # CONCURRENTLY can't run inside a transaction block
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        _create(conn, index, engine.dialect.name == "postgresql")
+
+def upgrade(engine):
+    for table in Base.metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            build_index(engine, index)
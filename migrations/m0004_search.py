@@ -0,0 +1,16 @@
+"""Full-text search over text uploads: the search column and GIN index, or the SQLite FTS5 table."""
+import logging
+
+logger = logging.getLogger("dataforge.migrations")
+
+# Also indexes existing texts, in small committed batches. On a large database
+# that predates search, run `python manage.py search-index` ahead of the deploy
+# (it is the same, re-runnable step) to keep the backfill off the deploy path.
+
+def upgrade(engine):
+    from search import build_search_index, SearchUnavailable
+    try:
+        logger.info("Search index: %s", build_search_index(engine))
+    except SearchUnavailable as e:
+        # SQLite built without FTS5: the app runs, /api/search answers 503
+        logger.warning("Search index not created: %s", e)
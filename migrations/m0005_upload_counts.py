@@ -0,0 +1,31 @@
+"""Per-user upload counter for the admin user list: add users.uploads_count and fill it in."""
+from sqlalchemy import inspect, text, func, select
+from sqlalchemy.schema import CreateColumn
+import logging
+from models import User
+
+logger = logging.getLogger("dataforge.migrations")
+
+# Counted in batches of users, each its own short transaction. Uploads made by
+# workers still running the previous release while this runs aren't counted;
+# `python manage.py reconcile-storage` recounts everything.
+
+BATCH = 1000
+
+def upgrade(engine):
+    if "uploads_count" not in {column["name"] for column in inspect(engine).get_columns("users")}:
+        ddl = CreateColumn(User.__table__.c.uploads_count).compile(dialect=engine.dialect)
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE users ADD COLUMN {ddl}"))
+    with engine.connect() as conn:
+        last_id = conn.execute(select(func.max(User.id))).scalar() or 0
+    for low in range(0, last_id, BATCH):
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    "UPDATE users SET uploads_count = (SELECT count(*) FROM uploads WHERE uploads.user_id = users.id) "
+                    "WHERE id > :low AND id <= :high"
+                ),
+                {"low": low, "high": low + BATCH},
+            )
+    logger.info("Counted uploads for users up to id %s", last_id)
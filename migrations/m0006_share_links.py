@@ -0,0 +1,17 @@
+"""Move share tokens from the old uploads.share_token / share_expires_at columns into share_links."""
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+import logging
+
+logger = logging.getLogger("dataforge.migrations")
+
+# Shares are served only from share_links, so until this runs every link made
+# before them answers 404 (and sits in the negative cache). Tokens already
+# copied are skipped; `python manage.py migrate-share-links` is the same step.
+
+def upgrade(engine):
+    if "share_token" not in {column["name"] for column in inspect(engine).get_columns("uploads")}:
+        return  # created after the move: nothing to copy
+    from shares import migrate_legacy_share_tokens
+    with Session(engine) as db:
+        logger.info("Copied %s share tokens into share_links", migrate_legacy_share_tokens(db))
@@ -0,0 +1,10 @@
+"""Indexes for the admin user list sorted by uploads or storage, built concurrently on Postgres."""
+from models import User
+from .m0003_indexes import build_index
+
+SORT_INDEXES = ("ix_users_uploads_count_id", "ix_users_storage_used_id")
+
+def upgrade(engine):
+    indexes = {index.name: index for index in User.__table__.indexes}
+    for name in SORT_INDEXES:
+        build_index(engine, indexes[name])
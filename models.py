@@ -1,9 +1,7 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, Text
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, DateTime, Boolean, Text, LargeBinary, Index, UniqueConstraint
+from sqlalchemy.orm import relationship, deferred
 from datetime import datetime
-
-Base = declarative_base()
+from database import Base
 
 class User(Base):
     __tablename__ = "users"
@@ -16,9 +14,16 @@ class User(Base):
     profile_photo = Column(String, nullable=True)
     is_premium = Column(Boolean, default=False)
     storage_limit = Column(Integer, default=1073741824)  # 1GB
+    storage_used = Column(BigInteger, default=0, server_default="0", nullable=False)  # running total of Upload.size_bytes
+    uploads_count = Column(Integer, default=0, server_default="0", nullable=False)  # running count of Upload rows
     is_admin = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     uploads = relationship("Upload", back_populates="owner")
+    __table_args__ = (
+        # Keyset pagination of the admin user list by uploads / storage (admin_stats.py)
+        Index("ix_users_uploads_count_id", "uploads_count", "id"),
+        Index("ix_users_storage_used_id", "storage_used", "id"),
+    )
 
 class Upload(Base):
     __tablename__ = "uploads"
@@ -26,11 +31,48 @@ class Upload(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     type = Column(String)  # text, image, video, document
     file_url = Column(String, nullable=True)
-    content = Column(Text, nullable=True)  # for text
-    share_token = Column(String, nullable=True)  # for sharing
-    share_expires_at = Column(DateTime, nullable=True)
+    content = deferred(Column(Text, nullable=True))  # for small texts; not loaded with the row, ask for it explicitly
+    # Larger texts are stored compressed (textstore.py); content is then NULL
+    content_encoding = Column(String(16), nullable=True)  # zstd, deflate; NULL when inline in content
+    content_blob = deferred(Column(LargeBinary, nullable=True))  # compressed bytes, unless spilled to the file store
+    content_key = Column(String, nullable=True)  # file store key texts/<uuid>.<ext> for the largest texts
+    content_length = Column(BigInteger, nullable=True)  # UTF-8 bytes before compression
+    content_preview = Column(String, nullable=True)  # first characters of a compressed text, for listings
+    size_bytes = Column(BigInteger, default=0, server_default="0", nullable=False)  # bytes on disk, counted against quota
+    filename = Column(String, nullable=True)  # original client filename
+    sha256 = Column(String(64), ForeignKey("blobs.sha256"), nullable=True, index=True)  # content-addressed blob holding the bytes
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Filled in by the media worker (media.py) after upload
+    mime_type = Column(String, nullable=True)  # sniffed from the bytes, not the client's filename
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    duration_ms = Column(Integer, nullable=True)  # video
+    media_status = Column(String, nullable=True)  # pending, done, failed; NULL for text
     owner = relationship("User", back_populates="uploads")
+    blob = relationship("Blob")
+    share_links = relationship("ShareLink", back_populates="upload", cascade="all, delete-orphan")
+    variants = relationship("MediaVariant", back_populates="upload", cascade="all, delete-orphan")
+    __table_args__ = (
+        # Keyset pagination of a user's uploads (listing.py)
+        Index("ix_uploads_user_created_id", "user_id", "created_at", "id"),
+        Index("ix_uploads_user_type_created_id", "user_id", "type", "created_at", "id"),
+    )
+
+class ShareLink(Base):
+    __tablename__ = "share_links"
+    token = Column(String(36), primary_key=True)  # uuid4 from the share URL; the primary key index serves lookups
+    upload_id = Column(Integer, ForeignKey("uploads.id", ondelete="CASCADE"), nullable=False, index=True)
+    expires_at = Column(DateTime, nullable=True, index=True)  # swept by the maintenance worker
+    created_at = Column(DateTime, default=datetime.utcnow)
+    upload = relationship("Upload", back_populates="share_links")
+
+class Blob(Base):
+    __tablename__ = "blobs"
+    sha256 = Column(String(64), primary_key=True)
+    size_bytes = Column(BigInteger, nullable=False)
+    path = Column(String, nullable=False)  # file store key, blobs/<sha256>
+    refcount = Column(Integer, default=1, nullable=False)  # number of Upload rows pointing here
+    created_at = Column(DateTime, default=datetime.utcnow)
 
 class Analytics(Base):
     __tablename__ = "analytics"
@@ -38,4 +80,101 @@ class Analytics(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     event_type = Column(String)  # upload, api_call, etc.
     details = Column(Text)  # JSON string
-    timestamp = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    timestamp = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index("ix_analytics_user_timestamp", "user_id", "timestamp"),)
+
+# Rollups of Analytics, maintained incrementally by the analytics writer
+class AnalyticsHourly(Base):
+    __tablename__ = "analytics_hourly"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    event_type = Column(String, primary_key=True)
+    bucket = Column(DateTime, primary_key=True)  # start of the hour (UTC)
+    count = Column(BigInteger, default=0, nullable=False)
+
+class AnalyticsDaily(Base):
+    __tablename__ = "analytics_daily"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    event_type = Column(String, primary_key=True)
+    bucket = Column(DateTime, primary_key=True)  # start of the day (UTC)
+    count = Column(BigInteger, default=0, nullable=False)
+
+class UploadSession(Base):
+    __tablename__ = "upload_sessions"
+    id = Column(String(36), primary_key=True)  # uuid4, handed to the client
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    type = Column(String)
+    filename = Column(String)
+    share = Column(Boolean, default=False)
+    ttl_hours = Column(Integer, default=24)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, index=True)  # abandoned sessions are garbage-collected after this
+    parts = relationship("UploadPart", back_populates="session", cascade="all, delete-orphan", order_by="UploadPart.part_number")
+
+class UploadPart(Base):
+    __tablename__ = "upload_parts"
+    session_id = Column(String(36), ForeignKey("upload_sessions.id", ondelete="CASCADE"), primary_key=True)
+    part_number = Column(Integer, primary_key=True)
+    size_bytes = Column(BigInteger, nullable=False)
+    sha256 = Column(String(64))
+    received_at = Column(DateTime, default=datetime.utcnow)
+    session = relationship("UploadSession", back_populates="parts")
+
+class ExportJob(Base):
+    __tablename__ = "export_jobs"
+    id = Column(String(36), primary_key=True)  # uuid4, handed to the client
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    status = Column(String, default="pending")  # pending, running, done, failed
+    path = Column(String, nullable=True)  # file store key, exports/<id>.zip once done
+    size_bytes = Column(BigInteger, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    expires_at = Column(DateTime, index=True)  # archive is deleted after this
+
+class MediaJob(Base):
+    # Queue of post-upload processing, drained by the media worker
+    __tablename__ = "media_jobs"
+    id = Column(Integer, primary_key=True)
+    upload_id = Column(Integer, ForeignKey("uploads.id", ondelete="CASCADE"), nullable=False, index=True)
+    status = Column(String, default="queued", nullable=False)  # queued, running, failed (finished jobs are deleted)
+    attempts = Column(Integer, default=0, nullable=False)
+    run_after = Column(DateTime, default=datetime.utcnow, nullable=False)  # retries back off by pushing this out
+    locked_at = Column(DateTime, nullable=True)  # set while running; stale locks are retried
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    __table_args__ = (Index("ix_media_jobs_status_run_after", "status", "run_after"),)
+
+class MediaVariant(Base):
+    # Derived renditions of an upload (thumbnails, resized copies, video posters)
+    __tablename__ = "media_variants"
+    id = Column(Integer, primary_key=True)
+    upload_id = Column(Integer, ForeignKey("uploads.id", ondelete="CASCADE"), nullable=False)
+    name = Column(String, nullable=False)  # thumb, medium, poster
+    key = Column(String, nullable=False)  # file store key, variants/<upload id>_<name>.<ext>
+    mime_type = Column(String, nullable=False)
+    width = Column(Integer)
+    height = Column(Integer)
+    size_bytes = Column(BigInteger, default=0, nullable=False)  # not counted against the owner's quota
+    created_at = Column(DateTime, default=datetime.utcnow)
+    upload = relationship("Upload", back_populates="variants")
+    __table_args__ = (UniqueConstraint("upload_id", "name", name="uq_media_variants_upload_name"),)
+
+class PendingDeletion(Base):
+    __tablename__ = "pending_deletions"
+    id = Column(Integer, primary_key=True)
+    path = Column(String, nullable=False)  # file removed by the maintenance worker, outside any request
+    reason = Column(String)  # user_deleted, ...
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class MaintenanceRun(Base):
+    __tablename__ = "maintenance_runs"
+    id = Column(Integer, primary_key=True)
+    job = Column(String, nullable=False)
+    dry_run = Column(Boolean, default=False)
+    status = Column(String, default="running")  # running, ok, failed
+    stats = Column(Text)  # JSON counters reported by the job
+    error = Column(Text, nullable=True)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    __table_args__ = (Index("ix_maintenance_runs_job_started_at", "job", "started_at"),)
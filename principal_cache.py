@@ -0,0 +1,160 @@
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+import json
+import threading
+import time
+from config import PRINCIPAL_CACHE_BACKEND, PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL
+from models import User
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Read-only copy of the User columns request handlers need.
+
+    Deliberately excludes storage_used and uploads_count, which change on every
+    upload; read them from the database (storage.get_usage) where they matter.
+    """
+    id: int
+    name: str
+    username: str
+    email: str
+    api_key: str
+    profile_photo: str
+    is_premium: bool
+    is_admin: bool
+    storage_limit: int
+
+    @classmethod
+    def from_user(cls, user: User) -> "UserSnapshot":
+        return cls(
+            id=user.id, name=user.name, username=user.username, email=user.email,
+            api_key=user.api_key, profile_photo=user.profile_photo,
+            is_premium=bool(user.is_premium), is_admin=bool(user.is_admin),
+            storage_limit=user.storage_limit,
+        )
+
+class MemoryBackend:
+    # Per-worker LRU with TTL
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+class SharedBackend:
+    # Snapshots kept in the host-wide shared store, so an invalidation in one worker is seen by all
+    def __init__(self, ttl: float):
+        from shared_state import get_shared_store
+        self.ttl = ttl
+        self.store = get_shared_store()
+
+    def get(self, key):
+        raw = self.store.get(f"principal:{key}")
+        return UserSnapshot(**json.loads(raw)) if raw else None
+
+    def set(self, key, value):
+        self.store.set(f"principal:{key}", json.dumps(asdict(value)), self.ttl)
+
+    def delete(self, *keys):
+        self.store.delete(*(f"principal:{key}" for key in keys))
+
+class PrincipalCache:
+    """Maps a principal (JWT subject or API key) to a UserSnapshot."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, kind: str, key: str):
+        snapshot = self.backend.get(f"{kind}:{key}")
+        if snapshot is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return snapshot
+
+    def put(self, user: User) -> UserSnapshot:
+        snapshot = UserSnapshot.from_user(user)
+        self.backend.set(f"username:{snapshot.username}", snapshot)
+        if snapshot.api_key:
+            self.backend.set(f"api_key:{snapshot.api_key}", snapshot)
+        return snapshot
+
+    def invalidate(self, usernames=(), api_keys=()):
+        keys = [f"username:{u}" for u in usernames if u] + [f"api_key:{k}" for k in api_keys if k]
+        if keys:
+            self.backend.delete(*keys)
+            self.invalidations += len(keys)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "backend": PRINCIPAL_CACHE_BACKEND,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "invalidations": self.invalidations,
+            "size": len(self.backend) if hasattr(self.backend, "__len__") else None,
+        }
+
+if PRINCIPAL_CACHE_BACKEND == "shared":
+    principal_cache = PrincipalCache(SharedBackend(PRINCIPAL_CACHE_TTL))
+else:
+    principal_cache = PrincipalCache(MemoryBackend(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL))
+
+# Invalidation: any committed change to a User row (upgrade, deletion, key or
+# username change) evicts both its current and previous principals.
+
+@event.listens_for(Session, "after_flush")
+def _collect_user_changes(session, flush_context):
+    pending = session.info.setdefault("principal_invalidations", set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            state = inspect(obj)
+            for attr, kind in (("username", "username"), ("api_key", "api_key")):
+                history = state.attrs[attr].history
+                for value in list(history.unchanged or ()) + list(history.deleted or ()) + list(history.added or ()):
+                    pending.add((kind, value))
+
+@event.listens_for(Session, "after_commit")
+def _apply_user_invalidations(session):
+    pending = session.info.pop("principal_invalidations", None)
+    if pending:
+        principal_cache.invalidate(
+            usernames=[v for kind, v in pending if kind == "username"],
+            api_keys=[v for kind, v in pending if kind == "api_key"],
+        )
+
+@event.listens_for(Session, "after_rollback")
+def _discard_user_invalidations(session):
+    session.info.pop("principal_invalidations", None)
@@ -0,0 +1,163 @@
+from fastapi import Depends, HTTPException, Request
+from functools import lru_cache
+import logging
+import math
+import sqlite3
+import threading
+import time
+from config import (
+    RATE_LIMIT_ENABLED, RATE_LIMIT_BACKEND, RATE_LIMIT_FREE, RATE_LIMIT_PREMIUM,
+    UPLOAD_RATE_LIMIT_FREE, UPLOAD_RATE_LIMIT_PREMIUM
+)
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+# Token-bucket rate limiting.
+#
+# A limit "n/period" is a bucket of n tokens refilled at n per period; each
+# request takes one. Buckets are keyed by scope and principal: the user id for
+# API-key and JWT requests (switching credentials doesn't reset them), the
+# client IP or share token for anonymous routes. Per-user limits depend on the
+# plan (User.is_premium, PLAN_LIMITS).
+#
+# The "shared" backend keeps buckets in the SharedStore SQLite file, where a
+# take is one atomic UPSERT, so a limit holds across all gunicorn workers rather
+# than per worker. If the store fails the request goes through (fail open).
+#
+# Limited responses carry RateLimit-Limit, RateLimit-Remaining, RateLimit-Reset
+# (seconds until the bucket is full) and RateLimit-Policy, per the IETF
+# RateLimit header fields draft; a 429 also has Retry-After. When one request
+# is checked against several buckets, the headers describe the tightest.
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+# scope -> (free, premium)
+PLAN_LIMITS = {
+    "api": (RATE_LIMIT_FREE, RATE_LIMIT_PREMIUM),
+    "upload": (UPLOAD_RATE_LIMIT_FREE, UPLOAD_RATE_LIMIT_PREMIUM),
+}
+
+RATE_LIMITED = Counter("rate_limited_total", "Requests rejected by a rate limit", ("scope",))
+RATE_LIMIT_ERRORS = Counter("rate_limit_errors_total", "Rate limit checks skipped because the store failed")
+
+@lru_cache(maxsize=64)
+def parse_limit(limit: str) -> tuple:
+    """"300/minute" -> (300, 60)."""
+    count, _, period = limit.partition("/")
+    period = period.strip().lower().rstrip("s")
+    if period not in PERIODS or not count.strip().isdigit() or int(count) < 1:
+        raise ValueError(f"Invalid rate limit {limit!r}")
+    return int(count), PERIODS[period]
+
+class MemoryBuckets:
+    # Per-worker buckets, for single-process runs; a limit applies per worker
+    MAX_BUCKETS = 100000
+
+    def __init__(self):
+        self._buckets = {}  # key -> (tokens, updated, capacity, rate)
+        self._lock = threading.Lock()
+
+    def take_tokens(self, key: str, capacity: float, rate: float, cost: float = 1.0):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, _, _ = self._buckets.get(key, (capacity, now, capacity, rate))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            taken = tokens >= cost
+            if taken:
+                tokens -= cost
+            self._buckets[key] = (tokens, now, capacity, rate)
+            if len(self._buckets) > self.MAX_BUCKETS:
+                self._prune(now)
+        return taken, tokens
+
+    def _prune(self, now: float):
+        # A bucket that has refilled is the same as no bucket
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items()
+            if bucket[0] + (now - bucket[1]) * bucket[3] < bucket[2]
+        }
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+class RateLimiter:
+    def __init__(self, backend):
+        self.backend = backend
+        self.enabled = RATE_LIMIT_ENABLED
+
+    def hit(self, request: Request, scope: str, principal, limit: str, cost: float = 1.0):
+        """Take cost tokens from the (scope, principal) bucket or raise HTTPException(429)."""
+        if not self.enabled:
+            return
+        capacity, period = parse_limit(limit)
+        rate = capacity / period
+        try:
+            taken, tokens = self.backend.take_tokens(f"rl:{scope}:{principal}", capacity, rate, cost)
+        except sqlite3.Error as e:
+            RATE_LIMIT_ERRORS.inc()
+            logger.warning("Rate limit check skipped: %s", e)
+            return
+        headers = {
+            "RateLimit-Limit": str(capacity),
+            "RateLimit-Remaining": str(max(int(tokens), 0)),
+            "RateLimit-Reset": str(math.ceil((capacity - tokens) / rate)),
+            "RateLimit-Policy": f"{capacity};w={period}",
+        }
+        if not taken:
+            RATE_LIMITED.inc((scope,))
+            headers["Retry-After"] = str(max(math.ceil((cost - tokens) / rate), 1))
+            request.state.rate_limit = headers
+            raise HTTPException(429, "Rate limit exceeded", headers=headers)
+        current = getattr(request.state, "rate_limit", None)
+        if current is None or int(headers["RateLimit-Remaining"]) < int(current["RateLimit-Remaining"]):
+            request.state.rate_limit = headers
+
+def plan_limit(scope: str, user) -> str:
+    free, premium = PLAN_LIMITS[scope]
+    return premium if user.is_premium else free
+
+# Dependencies, used as @router.get(..., dependencies=[limit_user(get_current_user)]).
+# The auth dependency is the route's own, so FastAPI resolves it once per request.
+# Plain defs: the shared store's take is a blocking SQLite write that can wait on
+# another worker's lock, so FastAPI runs them in the threadpool, off the event loop.
+
+def limit_user(auth, scope: str = "api"):
+    def check(request: Request, user=Depends(auth)):
+        rate_limiter.hit(request, scope, user.id, plan_limit(scope, user))
+    return Depends(check)
+
+def limit_ip(scope: str, limit: str):
+    def check(request: Request):
+        rate_limiter.hit(request, scope, client_ip(request), limit)
+    return Depends(check)
+
+class RateLimitHeadersMiddleware:
+    """Adds the RateLimit headers recorded by RateLimiter.hit to the response."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                headers = scope.get("state", {}).get("rate_limit")
+                if headers:
+                    existing = {name.lower() for name, _ in message.get("headers", [])}
+                    extra = [
+                        (name.lower().encode(), value.encode())
+                        for name, value in headers.items() if name.lower().encode() not in existing
+                    ]
+                    message["headers"] = list(message.get("headers", [])) + extra
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+if RATE_LIMIT_BACKEND == "shared":
+    from shared_state import get_shared_store
+    rate_limiter = RateLimiter(get_shared_store())
+else:
+    rate_limiter = RateLimiter(MemoryBuckets())
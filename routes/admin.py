@@ -1,32 +1,46 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import select, delete, func
 from sqlalchemy.orm import Session
-import os
-import glob
+from starlette.concurrency import run_in_threadpool
 from utils import get_current_user
-from database import get_db
-from models import User, Upload
+from database import get_db, pool_status
+from models import (
+    User, Upload, ShareLink, MediaJob, MediaVariant, Analytics, AnalyticsHourly, AnalyticsDaily,
+    UploadSession, UploadPart, ExportJob
+)
+from storage import release_blob, schedule_file_deletion, session_dir
+from analytics import analytics_queue
+from admin_stats import list_users, site_totals, invalidate_totals
+from principal_cache import principal_cache
+from shares import share_resolver
+from maintenance import maintenance, run_job, recent_runs, JOBS
+from media import media_worker, queue_stats, retry_failed
+from events import event_hub
 
 router = APIRouter()
 
 @router.get("/")
 def admin_dashboard(
+    limit: int = Query(50, ge=1, le=500),
+    sort: str = Query("id", pattern="^(id|username|created_at|uploads|storage)$"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    cursor: str = Query(None),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Admin only")
-    users = db.query(User).all()
-    total_uploads = db.query(Upload).count()
-    total_storage = sum(os.path.getsize(f) for f in glob.glob("uploads/*") if os.path.exists(f))
-    premium_count = db.query(User).filter(User.is_premium == True).count()
+    try:
+        users, next_cursor = list_users(db, limit=limit, sort=sort, order=order, cursor=cursor)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     return {
-        "users": [{"id": u.id, "username": u.username, "uploads_count": db.query(Upload).filter(Upload.user_id == u.id).count(), "is_premium": u.is_premium} for u in users],
-        "stats": {
-            "total_users": len(users),
-            "total_uploads": total_uploads,
-            "total_storage_gb": round(total_storage / (1024**3), 2),
-            "premium_count": premium_count
-        }
+        "users": [
+            {"id": u.id, "username": u.username, "uploads_count": u.uploads_count, "storage_used": u.storage_used, "is_premium": u.is_premium}
+            for u in users
+        ],
+        "next_cursor": next_cursor,
+        "stats": site_totals(db)
     }
 
 @router.delete("/user/{user_id}")
@@ -35,11 +49,106 @@ def delete_user(user_id: int, current_user: User = Depends(get_current_user), db
         raise HTTPException(status_code=403)
     user = db.query(User).filter(User.id == user_id).first()
     if user:
-        uploads = db.query(Upload).filter(Upload.user_id == user_id).all()
-        for u in uploads:
-            if u.file_url:
-                os.remove(u.file_url)
-            db.delete(u)
+        # Rows only: blob references are dropped here, and the maintenance worker removes
+        # zero-ref blobs, legacy files, spilled texts, multipart parts, export archives
+        # and the profile photo afterwards
+        refs = db.execute(
+            select(Upload.sha256, func.count(Upload.id))
+            .where(Upload.user_id == user_id, Upload.sha256.isnot(None))
+            .group_by(Upload.sha256)
+        ).all()
+        for sha256, count in refs:
+            release_blob(db, sha256, count)
+        legacy_files = db.execute(
+            select(Upload.file_url).where(Upload.user_id == user_id, Upload.sha256.is_(None), Upload.file_url.isnot(None))
+        ).scalars().all()
+        user_uploads = select(Upload.id).where(Upload.user_id == user_id)
+        variants = db.execute(select(MediaVariant.key).where(MediaVariant.upload_id.in_(user_uploads))).scalars().all()
+        texts = db.execute(
+            select(Upload.content_key).where(Upload.user_id == user_id, Upload.content_key.isnot(None))
+        ).scalars().all()
+        sessions = db.execute(select(UploadSession.id).where(UploadSession.user_id == user_id)).scalars().all()
+        exports = db.execute(
+            select(ExportJob.path).where(ExportJob.user_id == user_id, ExportJob.path.isnot(None))
+        ).scalars().all()
+        schedule_file_deletion(
+            db, legacy_files + variants + texts + exports + [session_dir(s) for s in sessions] + [user.profile_photo],
+            reason="user_deleted",
+        )
+        db.execute(delete(ShareLink).where(ShareLink.upload_id.in_(user_uploads)))
+        db.execute(delete(MediaVariant).where(MediaVariant.upload_id.in_(user_uploads)))
+        db.execute(delete(MediaJob).where(MediaJob.upload_id.in_(user_uploads)))
+        db.execute(delete(Upload).where(Upload.user_id == user_id))
+        # Every other row pointing at users.id, or the delete fails where foreign keys are enforced
+        db.execute(delete(UploadPart).where(UploadPart.session_id.in_(sessions)))
+        db.execute(delete(UploadSession).where(UploadSession.user_id == user_id))
+        db.execute(delete(ExportJob).where(ExportJob.user_id == user_id))
+        for table in (Analytics, AnalyticsHourly, AnalyticsDaily):
+            db.execute(delete(table).where(table.user_id == user_id))
         db.delete(user)
         db.commit()
+        invalidate_totals()
     return {"success": True}
+
+@router.get("/analytics/queue")
+def analytics_queue_stats(current_user: User = Depends(get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin only")
+    return analytics_queue.stats()
+
+@router.get("/cache")
+def principal_cache_stats(current_user: User = Depends(get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin only")
+    return principal_cache.stats()
+
+@router.get("/shares")
+def share_cache_stats(current_user: User = Depends(get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin only")
+    return share_resolver.stats()
+
+@router.get("/db-pool")
+def db_pool_stats(current_user: User = Depends(get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin only")
+    return pool_status()
+
+@router.get("/ws")
+def event_hub_stats(current_user: User = Depends(get_current_user)):
+    # This worker only; /metrics has ws_connections summed over workers
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin only")
+    return event_hub.status()
+
+@router.get("/maintenance")
+def maintenance_status(
+    job: str = Query(None),
+    limit: int = Query(20, ge=1, le=200),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin only")
+    return {"scheduler": maintenance.status(), "runs": recent_runs(db, job=job, limit=limit)}
+
+@router.get("/media")
+def media_status(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin only")
+    return {"worker": media_worker.status(), "queue": queue_stats(db)}
+
+@router.post("/media/retry")
+def retry_media_jobs(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin only")
+    return {"requeued": retry_failed(db)}
+
+@router.post("/maintenance/{job}")
+async def run_maintenance_job(job: str, dry_run: bool = Query(True), current_user: User = Depends(get_current_user)):
+    # Dry run unless explicitly disabled, so a stray click only reports
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin only")
+    if job not in JOBS:
+        raise HTTPException(status_code=404, detail=f"Unknown job. Available: {', '.join(JOBS)}")
+    return await run_in_threadpool(run_job, job, dry_run)
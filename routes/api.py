@@ -1,25 +1,38 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Query, Request
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Query, Request, BackgroundTasks
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, delete
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 import os
 import json
 import uuid
-import glob
 from datetime import datetime, timedelta
-import zipfile
-from io import BytesIO
-from utils import get_current_user, api_key_auth
-from database import get_db
-from models import Upload, User, Analytics
+from utils import get_current_user, api_key_auth, get_current_user_or_api_key, naive_utc
+from ratelimit import rate_limiter, limit_user, limit_ip, client_ip
+from database import get_db, get_async_db
+from models import Upload, User, ExportJob, MediaVariant, MediaJob
+from analytics import analytics_queue, query_rollups, event_totals
+from events import event_hub
+from exports import iter_export, build_export
+from serving import file_response, upload_file_response, variant_file_response, cache_control_for
+from filestore import PHOTO_NAME_RE
+from config import EXPORT_TTL_HOURS, SHARE_RATE_LIMIT, SHARE_TOKEN_RATE_LIMIT
+from shares import share_resolver, upload_share_url, share_url, TooManyMisses
+from listing import list_uploads
+from search import search_uploads, parse_query, SearchUnavailable
+from textstore import TEXT_COLUMNS, LOAD_TEXT, read_text, iter_text
+from admin_stats import decode_cursor
+from storage import (
+    release_storage, count_uploads, remaining_quota, save_upload_file, QuotaExceeded,
+    temp_path, create_upload, release_blob, reclaim_blobs, get_usage, schedule_file_deletion
+)
 
 router = APIRouter()
 
-def check_quota(user: User, file_size: int, db: Session):
-    if user.is_premium:
-        return True
-    current_storage = sum(os.path.getsize(f) for f in glob.glob(f"uploads/*_{user.id}_*") if os.path.exists(f))
-    return current_storage + file_size <= user.storage_limit
+MAX_ANALYTICS_RANGE = {"hour": timedelta(days=31), "day": timedelta(days=3660)}
 
-@router.post("/upload")
+@router.post("/upload", dependencies=[limit_user(get_current_user, "upload")])
 async def upload(
     type_: str = Form(..., alias="type"),
     content: str = Form(None),
@@ -37,40 +50,24 @@ async def upload(
     if type_ != "text" and not file:
         raise HTTPException(400, "File required")
 
-    item_id = int(uuid.uuid4().int % (10**9))
-    file_url = None
-    share_link = None
-    share_token = None
-    share_expires_at = None
-
-    if type_ != "text":
-        contents = await file.read()
-        if not check_quota(current_user, len(contents), db):
-            raise HTTPException(403, "Storage limit exceeded. Upgrade to premium!")
-        ext = file.filename.split('.')[-1] if '.' in file.filename else 'bin'
-        file_url = f"uploads/{item_id}_{current_user.id}.{ext}"
-        with open(file_url, "wb") as f:
-            f.write(contents)
-        if share:
-            share_token = str(uuid.uuid4())
-            share_expires_at = datetime.utcnow() + timedelta(hours=ttl_hours)
-            share_link = f"/api/share/{item_id}?token={share_token}"
-
-    new_upload = Upload(
-        user_id=current_user.id,
-        type=type_,
-        file_url=file_url,
-        content=content if type_ == "text" else None,
-        share_token=share_token,
-        share_expires_at=share_expires_at
-    )
-    db.add(new_upload)
-    db.commit()
-    db.refresh(new_upload)
-    # Log to analytics
-    details = json.dumps({"upload_id": new_upload.id, "type": type_})
-    db.add(Analytics(user_id=current_user.id, event_type="upload", details=details))
-    db.commit()
+    # Only the file copy happens on the event loop (in chunks, via the threadpool);
+    # all database work for this sync Session runs in the threadpool too
+    try:
+        if type_ == "text":
+            new_upload = await run_in_threadpool(create_upload, db, current_user, type_, content=content)
+        else:
+            tmp = temp_path()
+            max_size = await run_in_threadpool(remaining_quota, db, current_user)
+            size_bytes, sha256 = await save_upload_file(file, tmp, max_size=max_size)
+            new_upload = await run_in_threadpool(
+                create_upload, db, current_user, type_, tmp=tmp, size_bytes=size_bytes, sha256=sha256,
+                filename=file.filename, share=share, ttl_hours=ttl_hours
+            )
+    except QuotaExceeded:
+        raise HTTPException(403, "Storage limit exceeded. Upgrade to premium!")
+    share_link = upload_share_url(new_upload)
+    analytics_queue.enqueue(current_user.id, "upload", {"upload_id": new_upload.id, "type": type_})
+    event_hub.publish(current_user.id, "upload", {"upload_id": new_upload.id, "type": type_, "size": new_upload.size_bytes})
     return {
         "success": True,
         "item_id": new_upload.id,
@@ -78,39 +75,163 @@ async def upload(
         "share_link": share_link
     }
 
-@router.get("/v2/{username}")
+@router.get("/uploads", dependencies=[limit_user(get_current_user_or_api_key)])
+def get_uploads(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: str = Query(None),
+    type_: str = Query(None, alias="type", pattern="^(text|image|video|document)$"),
+    start: datetime = Query(None),
+    end: datetime = Query(None),
+    current_user: User = Depends(get_current_user_or_api_key),
+    db: Session = Depends(get_db)
+):
+    # Metadata only; text content comes from /api/v2/{username}?uploads=<id> or /api/uploads/batch
+    try:
+        items, next_cursor = list_uploads(db, current_user.id, limit, cursor, type_, naive_utc(start), naive_utc(end))
+    except (ValueError, TypeError):
+        raise HTTPException(400, "Invalid cursor")
+    for item in items:
+        if item["type"] != "text":
+            item["file_url"] = f"/api/files/{item['id']}"
+            for name, variant in item["variants"].items():
+                variant["url"] = f"/api/files/{item['id']}?variant={name}"
+        item["share_links"] = [
+            {"url": share_url(item["id"], link["token"]), "expires_at": link["expires_at"]}
+            for link in item["share_links"]
+        ]
+    return {"items": items, "next_cursor": next_cursor}
+
+@router.get("/search", dependencies=[limit_user(get_current_user_or_api_key)])
+def search(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: str = Query(None),
+    current_user: User = Depends(get_current_user_or_api_key),
+    db: Session = Depends(get_db)
+):
+    # Text uploads only, best match first; full content comes from /api/v2/{username}?uploads=<id>
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except (ValueError, TypeError):
+            raise HTTPException(400, "Invalid cursor")
+    try:
+        items, next_cursor = search_uploads(db, current_user.id, q, limit, cursor)
+    except SearchUnavailable as e:
+        raise HTTPException(503, str(e))
+    except (ValueError, TypeError) as e:
+        raise HTTPException(400, str(e))
+    analytics_queue.enqueue(current_user.id, "search", {"terms": len(parse_query(q)), "results": len(items)})
+    return {"items": items, "next_cursor": next_cursor}
+
+@router.get("/v2/{username}", dependencies=[limit_user(api_key_auth)])
 async def get_upload(
     username: str,
+    request: Request,
     uploads: int = Query(...),
+    format: str = Query("json", pattern="^(json|raw)$", description="raw sends a text upload's body as text/plain"),
     user = Depends(api_key_auth),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     if user.username != username:
         raise HTTPException(403, "Access denied")
-    upload = db.query(Upload).filter(Upload.id == uploads, Upload.user_id == user.id).first()
+    upload = (await db.execute(select(Upload).options(*LOAD_TEXT).where(Upload.id == uploads, Upload.user_id == user.id))).scalar_one_or_none()
     if not upload:
         raise HTTPException(404, "Upload not found")
+    if format == "raw":
+        if upload.type != "text":
+            raise HTTPException(400, "format=raw is only for text uploads; files are at /api/files/{id}")
+        # Compressed texts go out as stored when the client accepts their coding
+        coding, body = iter_text(upload, request.headers.get("accept-encoding", ""))
+        headers = {"Vary": "Accept-Encoding"}
+        if coding:
+            headers["Content-Encoding"] = coding
+        return StreamingResponse(body, media_type="text/plain; charset=utf-8", headers=headers)
     response = {
         "owner": username,
         "type": upload.type,
         "created_at": upload.created_at.isoformat()
     }
     if upload.type == "text":
-        response["content"] = upload.content
+        response["content"] = await run_in_threadpool(read_text, upload)
     else:
-        response["file_url"] = f"/{upload.file_url}"
+        response["file_url"] = f"/api/files/{upload.id}"
+        response["media"] = {
+            "status": upload.media_status,
+            "mime_type": upload.mime_type,
+            "width": upload.width,
+            "height": upload.height,
+            "duration_ms": upload.duration_ms,
+        }
+        variants = (await db.execute(
+            select(MediaVariant.name, MediaVariant.mime_type, MediaVariant.width, MediaVariant.height, MediaVariant.size_bytes)
+            .where(MediaVariant.upload_id == upload.id)
+        )).all()
+        response["variants"] = {
+            v.name: {"url": f"/api/files/{upload.id}?variant={v.name}", "mime_type": v.mime_type,
+                     "width": v.width, "height": v.height, "size": v.size_bytes}
+            for v in variants
+        }
     return response
 
-@router.get("/share/{item_id}")
-def get_shared(item_id: int, token: str = Query(...), db: Session = Depends(get_db)):
-    upload = db.query(Upload).filter(Upload.id == item_id, Upload.share_token == token).first()
-    if not upload or (upload.share_expires_at and upload.share_expires_at < datetime.utcnow()):
+def get_variant(db: Session, upload_id: int, name: str) -> MediaVariant:
+    variant = db.query(MediaVariant).filter(MediaVariant.upload_id == upload_id, MediaVariant.name == name).first()
+    if not variant:
+        raise HTTPException(404, "Variant not available")
+    return variant
+
+@router.get("/share/{item_id}", dependencies=[limit_ip("share", SHARE_RATE_LIMIT)])
+def get_shared(item_id: int, request: Request, token: str = Query(...), variant: str = Query(None), db: Session = Depends(get_db)):
+    rate_limiter.hit(request, "share_token", token, SHARE_TOKEN_RATE_LIMIT)
+    try:
+        shared = share_resolver.resolve(db, item_id, token, client_ip(request))
+    except TooManyMisses:
+        raise HTTPException(429, "Too many invalid share links")
+    if not shared:
         raise HTTPException(404, "Share link invalid or expired")
-    if upload.type == "text":
-        return {"content": upload.content}
-    return FileResponse(upload.file_url, filename=f"shared_{item_id}{os.path.splitext(upload.file_url)[1]}")
+    event_hub.publish(shared.user_id, "share_access", {"upload_id": item_id, "variant": variant})
+    if shared.type == "text":
+        return {"content": read_text(db.query(*TEXT_COLUMNS).filter(Upload.id == item_id).one())}
+    # Caches must not outlive the share itself
+    max_age = int((shared.expires_at - datetime.utcnow()).total_seconds()) if shared.expires_at else None
+    name = f"shared_{item_id}{os.path.splitext(shared.filename or shared.file_url)[1]}"
+    try:
+        if variant:
+            return variant_file_response(request, get_variant(db, item_id, variant), shared.type, public=True, max_age=max_age)
+        return upload_file_response(request, shared, public=True, max_age=max_age, download_name=name)
+    except FileNotFoundError:
+        # Deleted since it was cached by this worker
+        share_resolver.invalidate(token)
+        raise HTTPException(404, "Share link invalid or expired")
+
+@router.get("/photos/{name}")
+def get_photo(name: str, request: Request):
+    if not PHOTO_NAME_RE.match(name):
+        raise HTTPException(404, "Photo not found")
+    try:
+        return file_response(request, f"photos/{name}", cache_control=cache_control_for("image", public=True), inline=True)
+    except OSError:
+        raise HTTPException(404, "Photo not found")
 
-@router.delete("/delete/{item_id}")
+@router.get("/files/{item_id}", dependencies=[limit_user(get_current_user_or_api_key)])
+def get_file(
+    item_id: int,
+    request: Request,
+    variant: str = Query(None, description="A derived rendition such as thumb or medium, from /api/v2"),
+    current_user: User = Depends(get_current_user_or_api_key),
+    db: Session = Depends(get_db)
+):
+    upload = db.query(Upload).filter(Upload.id == item_id, Upload.user_id == current_user.id).first()
+    if not upload or not upload.file_url:
+        raise HTTPException(404, "Upload not found")
+    try:
+        if variant:
+            return variant_file_response(request, get_variant(db, item_id, variant), upload.type)
+        return upload_file_response(request, upload)
+    except FileNotFoundError:
+        raise HTTPException(404, "File missing from storage")
+
+@router.delete("/delete/{item_id}", dependencies=[limit_user(get_current_user)])
 def delete_upload(
     item_id: int,
     current_user: User = Depends(get_current_user),
@@ -119,19 +240,50 @@ def delete_upload(
     upload = db.query(Upload).filter(Upload.id == item_id, Upload.user_id == current_user.id).first()
     if not upload:
         raise HTTPException(404, "Upload not found")
-    if upload.file_url and os.path.exists(upload.file_url):
-        os.remove(upload.file_url)
+    if upload.sha256:
+        release_blob(db, upload.sha256)
+    elif upload.file_url:
+        schedule_file_deletion(db, [upload.file_url], reason="upload_deleted")
+    elif upload.content_key:
+        schedule_file_deletion(db, [upload.content_key], reason="upload_deleted")
+    schedule_file_deletion(db, [v.key for v in upload.variants], reason="upload_deleted")
+    db.execute(delete(MediaJob).where(MediaJob.upload_id == upload.id))
+    release_storage(db, current_user.id, upload.size_bytes)
+    count_uploads(db, current_user.id, -1)
     db.delete(upload)
     db.commit()
+    if upload.sha256:
+        reclaim_blobs(db, [upload.sha256])
+    event_hub.publish(current_user.id, "delete", {"upload_id": item_id})
     return {"success": True}
 
-@router.get("/analytics")
-def get_analytics(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    uploads_count = db.query(Upload).filter(Upload.user_id == current_user.id).count()
-    analytics = db.query(Analytics).filter(Analytics.user_id == current_user.id).all()
-    storage_used = sum(os.path.getsize(f) for f in glob.glob(f"uploads/*_{current_user.id}_*") if os.path.exists(f))
-    labels = [a.event_type for a in analytics[-10:]]
-    counts = [1 for _ in labels]
+@router.get("/analytics", dependencies=[limit_user(get_current_user)])
+def get_analytics(
+    start: datetime = Query(None),
+    end: datetime = Query(None),
+    granularity: str = Query(None, pattern="^(hour|day)$"),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    # Time-bucketed mode, served from the rollup tables
+    if granularity:
+        start, end = naive_utc(start), naive_utc(end)
+        end = end or datetime.utcnow()
+        start = start or end - (timedelta(days=1) if granularity == "hour" else timedelta(days=30))
+        if start >= end:
+            raise HTTPException(400, "start must be before end")
+        if end - start > MAX_ANALYTICS_RANGE[granularity]:
+            raise HTTPException(400, f"Range too large for {granularity} granularity")
+        return {
+            "granularity": granularity,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "series": query_rollups(db, current_user.id, start, end, granularity)
+        }
+    storage_used, uploads_count = get_usage(db, current_user.id)
+    totals = event_totals(db, current_user.id)
+    labels = sorted(totals)
+    counts = [totals[label] for label in labels]
     return {
         "uploads_count": uploads_count,
         "storage_used": storage_used,
@@ -139,15 +291,58 @@ def get_analytics(current_user: User = Depends(get_current_user), db: Session =
         "datasets": [{"data": counts}]
     }
 
-@router.get("/export")
-def export_data(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    uploads = db.query(Upload).filter(Upload.user_id == current_user.id).all()
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        for upload in uploads:
-            if upload.content:
-                zip_file.writestr(f"{upload.id}.txt", upload.content)
-            elif upload.file_url:
-                zip_file.write(upload.file_url, f"{upload.id}{os.path.splitext(upload.file_url)[1]}")
-    zip_buffer.seek(0)
-    return FileResponse(zip_buffer, media_type="application/zip", filename="dataforge_export.zip")
+@router.get("/export", dependencies=[limit_user(get_current_user)])
+def export_data(current_user: User = Depends(get_current_user)):
+    # Streamed straight from disk: no in-memory archive, first bytes go out immediately
+    return StreamingResponse(
+        iter_export(current_user.id),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="dataforge_export.zip"'}
+    )
+
+@router.post("/export/jobs", dependencies=[limit_user(get_current_user)])
+def create_export_job(
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    # Deferred mode for large accounts: build the archive in the background, download it later
+    job = ExportJob(
+        id=str(uuid.uuid4()),
+        user_id=current_user.id,
+        status="pending",
+        expires_at=datetime.utcnow() + timedelta(hours=EXPORT_TTL_HOURS)
+    )
+    db.add(job)
+    db.commit()
+    background_tasks.add_task(build_export, job.id)
+    return {"job_id": job.id, "status": job.status, "status_url": f"/api/export/jobs/{job.id}"}
+
+def get_export_job(job_id: str, user: User, db: Session) -> ExportJob:
+    job = db.query(ExportJob).filter(ExportJob.id == job_id, ExportJob.user_id == user.id).first()
+    if not job:
+        raise HTTPException(404, "Export job not found")
+    return job
+
+@router.get("/export/jobs/{job_id}", dependencies=[limit_user(get_current_user)])
+def export_job_status(job_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    job = get_export_job(job_id, current_user, db)
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "size": job.size_bytes,
+        "error": job.error,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "download_url": f"/api/export/jobs/{job.id}/download" if job.status == "done" else None
+    }
+
+@router.get("/export/jobs/{job_id}/download", dependencies=[limit_user(get_current_user)])
+def download_export(job_id: str, request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    job = get_export_job(job_id, current_user, db)
+    if job.status != "done" or not job.path:
+        raise HTTPException(409, "Export is not ready")
+    try:
+        return file_response(request, job.path, media_type="application/zip", filename="dataforge_export.zip")
+    except FileNotFoundError:
+        raise HTTPException(409, "Export is not ready")
@@ -1,10 +1,15 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request  # Add Request
+from sqlalchemy import select
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 import uuid
-from utils import create_access_token, get_password_hash, verify_password, get_current_user, limiter
-from database import get_db
+from utils import create_access_token, get_password_hash_async, verify_password_async, password_needs_rehash, get_current_user
+from ratelimit import limit_ip
+from config import SIGNUP_RATE_LIMIT, LOGIN_RATE_LIMIT
+from database import get_db, get_async_db
 from models import User
+from filestore import photo_url
 
 router = APIRouter()
 
@@ -19,14 +24,13 @@ class UserLogin(BaseModel):
     username: str
     password: str
 
-@router.post("/signup")
-@limiter.limit("5/minute")
-def signup(request: Request, user: UserSignup, db: Session = Depends(get_db)):
-    if db.query(User).filter(User.username == user.username).first():
+@router.post("/signup", dependencies=[limit_ip("signup", SIGNUP_RATE_LIMIT)])
+async def signup(request: Request, user: UserSignup, db: AsyncSession = Depends(get_async_db)):
+    if (await db.execute(select(User.id).where(User.username == user.username))).first():
         raise HTTPException(status_code=400, detail="Username taken")
-    if db.query(User).filter(User.email == user.email).first():
+    if (await db.execute(select(User.id).where(User.email == user.email))).first():
         raise HTTPException(status_code=400, detail="Email taken")
-    hashed_pw = get_password_hash(user.password)
+    hashed_pw = await get_password_hash_async(user.password)
     api_key = str(uuid.uuid4())
     new_user = User(
         name=user.name,
@@ -39,17 +43,18 @@ def signup(request: Request, user: UserSignup, db: Session = Depends(get_db)):
         is_admin=False
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
     access_token = create_access_token(data={"sub": user.username})
     return {"access_token": access_token, "api_key": api_key, "token_type": "bearer"}
 
-@router.post("/login")
-@limiter.limit("10/minute")
-def login(request: Request, user: UserLogin, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.username == user.username).first()
-    if not db_user or not verify_password(user.password, db_user.password_hash):
+@router.post("/login", dependencies=[limit_ip("login", LOGIN_RATE_LIMIT)])
+async def login(request: Request, user: UserLogin, db: AsyncSession = Depends(get_async_db)):
+    db_user = (await db.execute(select(User).where(User.username == user.username))).scalar_one_or_none()
+    if not db_user or not await verify_password_async(user.password, db_user.password_hash):
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if password_needs_rehash(db_user.password_hash):
+        db_user.password_hash = await get_password_hash_async(user.password)
+        await db.commit()
     access_token = create_access_token(data={"sub": user.username})
     return {"access_token": access_token, "api_key": db_user.api_key, "token_type": "bearer"}
 
@@ -62,12 +67,14 @@ def me(current_user: User = Depends(get_current_user)):
         "email": current_user.email,
         "api_key": current_user.api_key,
         "is_premium": current_user.is_premium,
-        "profile_photo": current_user.profile_photo
+        "profile_photo": photo_url(current_user.profile_photo)
     }
 
 @router.post("/upgrade")
 def upgrade(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    current_user.is_premium = True
-    current_user.storage_limit = 999999999999
+    # current_user is a cached snapshot; update the row itself (the commit evicts the snapshot)
+    user = db.get(User, current_user.id)
+    user.is_premium = True
+    user.storage_limit = 999999999999
     db.commit()
     return {"message": "Upgraded to premium! Contact WhatsApp +91 8011971924 for payment confirmation."}
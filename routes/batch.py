@@ -0,0 +1,303 @@
+from fastapi import APIRouter, Depends, HTTPException, Request, Query, Body
+from fastapi.responses import StreamingResponse
+from starlette.datastructures import UploadFile
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+import base64
+import binascii
+import io
+import json
+import os
+from utils import get_current_user_or_api_key
+from ratelimit import limit_user
+from database import get_db, SessionLocal
+from models import Upload
+from analytics import analytics_queue
+from events import event_hub
+from shares import share_url
+from textstore import TEXT_COLUMNS, read_text
+from config import BATCH_MAX_ITEMS, BATCH_MAX_FETCH_IDS, BATCH_MAX_LINE_BYTES
+from storage import (
+    remaining_quota, save_upload_file, copy_stream, temp_path, create_uploads_bulk, QuotaExceeded
+)
+
+# Batch endpoints for sync clients:
+#   POST /api/upload/batch    many text/file items in one request, one transaction
+#   GET  /api/uploads/batch   ?ids=1,2,3 -> NDJSON, one line per upload, streamed as rows are read
+#   POST /api/uploads/batch   {"ids": [...]} for id lists too long for a query string
+#
+# Upload bodies are either NDJSON, one item per line:
+#   {"type": "text", "content": "..."}
+#   {"type": "image", "filename": "a.png", "data_base64": "...", "share": true, "ttl_hours": 48}
+# or multipart/form-data where the field name is the item type:
+#   text=<value>, image=@a.png, video=@b.mp4, document=@c.pdf (plus optional share / ttl_hours for all files)
+
+router = APIRouter()
+
+FILE_TYPES = ("image", "video", "document")
+# NDJSON lines longer than this are parsed and decoded in the threadpool, off the event loop
+INLINE_PARSE_BYTES = 64 * 1024
+
+class ItemError(Exception):
+    pass
+
+class BatchBuilder:
+    """Collects validated items, writing file bytes to temp files within the user's remaining quota."""
+
+    def __init__(self, quota):
+        self.quota = quota  # None means unlimited
+        self.used = 0
+        self.items = []  # (index, item)
+        self.results = {}  # index -> result dict
+        self.count = 0
+
+    def next_index(self) -> int:
+        index = self.count
+        self.count += 1
+        if index >= BATCH_MAX_ITEMS:
+            raise ItemError(f"Too many items in one batch (max {BATCH_MAX_ITEMS})")
+        return index
+
+    def fail(self, index: int, message: str):
+        self.results[index] = {"index": index, "ok": False, "error": message}
+
+    def add_text(self, index: int, content):
+        if not isinstance(content, str) or not content:
+            raise ItemError("Content required for text")
+        self.items.append((index, {"type": "text", "content": content}))
+
+    async def add_file(self, index: int, type_: str, filename: str, write, share: bool, ttl_hours: int):
+        """write(tmp, max_size) copies the bytes and returns (size, sha256)."""
+        if type_ not in FILE_TYPES:
+            raise ItemError("Invalid type")
+        max_size = None if self.quota is None else max(self.quota - self.used, 0)
+        tmp = temp_path()
+        try:
+            size, sha256 = await write(tmp, max_size)
+        except QuotaExceeded:
+            raise ItemError("Storage limit exceeded. Upgrade to premium!")
+        self.used += size
+        self.items.append((index, {
+            "type": type_, "tmp": tmp, "size_bytes": size, "sha256": sha256,
+            "filename": filename, "share": share, "ttl_hours": ttl_hours,
+        }))
+
+    def discard_files(self):
+        for _, item in self.items:
+            if item.get("tmp") and os.path.exists(item["tmp"]):
+                os.remove(item["tmp"])
+
+def _parse_line(line: bytes):
+    """(item, decoded file bytes or None for text) from one NDJSON line; raises ItemError."""
+    try:
+        item = json.loads(line)
+    except ValueError:
+        raise ItemError("Invalid JSON")
+    if not isinstance(item, dict):
+        raise ItemError("Each line must be a JSON object")
+    if item.get("type") == "text":
+        return item, None
+    try:
+        data = base64.b64decode(item.get("data_base64") or "", validate=True)
+    except (binascii.Error, TypeError):
+        raise ItemError("data_base64 is not valid base64")
+    if not data:
+        raise ItemError("File required")
+    return item, data
+
+async def _read_ndjson(request: Request, batch: BatchBuilder):
+    async def handle(line: bytes, too_long: bool = False):
+        if not too_long and not line.strip():
+            return
+        try:
+            index = batch.next_index()
+        except ItemError as e:
+            batch.fail(batch.count - 1, str(e))
+            return
+        try:
+            if too_long:
+                raise ItemError(f"Line too long (max {BATCH_MAX_LINE_BYTES} bytes); send large files as multipart/form-data")
+            if len(line) > INLINE_PARSE_BYTES:
+                item, data = await run_in_threadpool(_parse_line, line)
+            else:
+                item, data = _parse_line(line)
+            type_ = item.get("type")
+            if type_ == "text":
+                batch.add_text(index, item.get("content"))
+                return
+            ttl_hours = item.get("ttl_hours", 24)
+            if not isinstance(ttl_hours, int) or ttl_hours < 1:
+                raise ItemError("ttl_hours must be a positive integer")
+            await batch.add_file(
+                index, type_, item.get("filename"),
+                lambda tmp, max_size: run_in_threadpool(copy_stream, io.BytesIO(data), tmp, max_size),
+                bool(item.get("share")), ttl_hours,
+            )
+        except ItemError as e:
+            batch.fail(index, str(e))
+
+    # Only each new chunk is split; the current line's pieces are joined once it ends.
+    # Past BATCH_MAX_LINE_BYTES its bytes are dropped, but still counted to the newline.
+    pending, size = [], 0
+
+    async def finish(tail: bytes):
+        nonlocal pending, size
+        size += len(tail)
+        if size > BATCH_MAX_LINE_BYTES:
+            await handle(b"", too_long=True)
+        else:
+            pending.append(tail)
+            await handle(b"".join(pending))
+        pending, size = [], 0
+
+    async for chunk in request.stream():
+        *lines, rest = chunk.split(b"\n")
+        for line in lines:
+            await finish(line)
+        size += len(rest)
+        if size <= BATCH_MAX_LINE_BYTES:
+            pending.append(rest)
+        else:
+            pending = []
+    await finish(b"")
+
+async def _read_multipart(request: Request, batch: BatchBuilder):
+    try:
+        form = await request.form(max_files=BATCH_MAX_ITEMS, max_fields=BATCH_MAX_ITEMS + 2)
+    except Exception:
+        raise HTTPException(400, f"Invalid multipart body (at most {BATCH_MAX_ITEMS} items)")
+    try:
+        share = str(form.get("share", "false")).lower() in ("1", "true", "yes", "on")
+        try:
+            ttl_hours = int(form.get("ttl_hours", 24))
+        except ValueError:
+            raise HTTPException(400, "ttl_hours must be a positive integer")
+        if ttl_hours < 1:
+            raise HTTPException(400, "ttl_hours must be a positive integer")
+        for key, value in form.multi_items():
+            if key in ("share", "ttl_hours"):
+                continue
+            try:
+                index = batch.next_index()
+            except ItemError as e:
+                batch.fail(batch.count - 1, str(e))
+                continue
+            try:
+                if isinstance(value, UploadFile):
+                    await batch.add_file(
+                        index, key, value.filename,
+                        lambda tmp, max_size, f=value: save_upload_file(f, tmp, max_size=max_size),
+                        share, ttl_hours,
+                    )
+                elif key == "text":
+                    batch.add_text(index, value)
+                else:
+                    raise ItemError("Invalid type" if key not in FILE_TYPES else "File required")
+            except ItemError as e:
+                batch.fail(index, str(e))
+    finally:
+        await form.close()
+
+@router.post("/upload/batch", dependencies=[limit_user(get_current_user_or_api_key, "upload")])
+async def upload_batch(
+    request: Request,
+    current_user=Depends(get_current_user_or_api_key),
+    db: Session = Depends(get_db)
+):
+    content_type = request.headers.get("content-type", "")
+    quota = await run_in_threadpool(remaining_quota, db, current_user)
+    batch = BatchBuilder(quota)
+    try:
+        if content_type.startswith(("application/x-ndjson", "application/jsonl")):
+            await _read_ndjson(request, batch)
+        elif content_type.startswith("multipart/form-data"):
+            await _read_multipart(request, batch)
+        else:
+            raise HTTPException(415, "Send application/x-ndjson or multipart/form-data")
+    except BaseException:
+        batch.discard_files()
+        raise
+
+    items = batch.items
+    if items:
+        try:
+            created = await run_in_threadpool(create_uploads_bulk, db, current_user, [item for _, item in items])
+        except QuotaExceeded:
+            # Lost a race with a concurrent upload: keep the text items, fail the files
+            for index, item in items:
+                if item.get("tmp"):
+                    batch.fail(index, "Storage limit exceeded. Upgrade to premium!")
+            items = [(index, item) for index, item in items if not item.get("tmp")]
+            created = await run_in_threadpool(create_uploads_bulk, db, current_user, [item for _, item in items]) if items else []
+        for (index, item), (upload_id, token) in zip(items, created):
+            batch.results[index] = {
+                "index": index,
+                "ok": True,
+                "item_id": upload_id,
+                "type": item["type"],
+                "size": item.get("size_bytes", 0),
+                "access_url": f"/api/v2/{current_user.username}?uploads={upload_id}",
+                "share_link": share_url(upload_id, token) if token else None,
+            }
+            analytics_queue.enqueue(current_user.id, "upload", {"upload_id": upload_id, "type": item["type"], "batch": True})
+            event_hub.publish(current_user.id, "upload", {"upload_id": upload_id, "type": item["type"], "size": item.get("size_bytes", 0)})
+
+    results = [batch.results[i] for i in sorted(batch.results)]
+    return {
+        "created": sum(1 for r in results if r["ok"]),
+        "failed": sum(1 for r in results if not r["ok"]),
+        "results": results,
+    }
+
+def iter_uploads_ndjson(user_id: int, ids):
+    """One JSON line per requested id, in id order, read with a server-side cursor; unknown ids last."""
+    db = SessionLocal()
+    try:
+        rows = db.execute(
+            select(Upload.id, Upload.type, Upload.filename, Upload.size_bytes, Upload.created_at, *TEXT_COLUMNS)
+            .where(Upload.user_id == user_id, Upload.id.in_(ids))
+            .order_by(Upload.id)
+            .execution_options(yield_per=200)
+        )
+        seen = set()
+        for row in rows:
+            seen.add(row.id)
+            item = {
+                "id": row.id,
+                "type": row.type,
+                "filename": row.filename,
+                "size": row.size_bytes,
+                "created_at": row.created_at.isoformat() if row.created_at else None,
+            }
+            if row.type == "text":
+                item["content"] = read_text(row)
+            else:
+                item["file_url"] = f"/api/files/{row.id}"
+            yield json.dumps(item) + "\n"
+        for upload_id in ids:
+            if upload_id not in seen:
+                yield json.dumps({"id": upload_id, "error": "Upload not found"}) + "\n"
+    finally:
+        db.close()
+
+def _fetch_response(user, ids):
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        raise HTTPException(400, "No ids given")
+    if len(ids) > BATCH_MAX_FETCH_IDS:
+        raise HTTPException(400, f"At most {BATCH_MAX_FETCH_IDS} ids per request")
+    analytics_queue.enqueue(user.id, "batch_fetch", {"count": len(ids)})
+    return StreamingResponse(iter_uploads_ndjson(user.id, ids), media_type="application/x-ndjson")
+
+@router.get("/uploads/batch", dependencies=[limit_user(get_current_user_or_api_key)])
+def fetch_batch(ids: str = Query(..., description="Comma-separated upload ids"), current_user=Depends(get_current_user_or_api_key)):
+    try:
+        parsed = [int(i) for i in ids.split(",") if i.strip()]
+    except ValueError:
+        raise HTTPException(400, "ids must be comma-separated integers")
+    return _fetch_response(current_user, parsed)
+
+@router.post("/uploads/batch", dependencies=[limit_user(get_current_user_or_api_key)])
+def fetch_batch_post(ids: list[int] = Body(..., embed=True), current_user=Depends(get_current_user_or_api_key)):
+    return _fetch_response(current_user, ids)
@@ -1,12 +1,23 @@
-from fastapi import APIRouter, Depends, Request, Form, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, Request, Form, UploadFile, File, Query
 from fastapi.responses import HTMLResponse, RedirectResponse
+from sqlalchemy import select
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 import os
 import uuid
 from config import templates  # Import templates from config
-from utils import create_access_token, get_password_hash, verify_password, get_current_user
-from database import get_db
-from models import User, Upload
+from utils import create_access_token, get_password_hash_async, verify_password_async, password_needs_rehash, get_current_user
+from database import get_db, get_async_db
+from models import User
+from storage import save_upload_file, get_usage, temp_path
+from filestore import file_store, PHOTO_NAME_RE
+from serving import file_response, cache_control_for
+from analytics import event_totals
+from admin_stats import list_users, site_totals
+from listing import list_uploads
+
+DASHBOARD_PAGE_SIZE = 24
 
 router = APIRouter()
 
@@ -19,16 +30,19 @@ def login_page(request: Request):
     return templates.TemplateResponse("login.html", {"request": request})
 
 @router.post("/login")
-async def login_post(request: Request, db: Session = Depends(get_db)):
+async def login_post(request: Request, db: AsyncSession = Depends(get_async_db)):
     form = await request.form()
     username = form.get("username")
     password = form.get("password")
-    db_user = db.query(User).filter(User.username == username).first()
-    if not db_user or not verify_password(password, db_user.password_hash):
+    db_user = (await db.execute(select(User).where(User.username == username))).scalar_one_or_none()
+    if not db_user or not await verify_password_async(password, db_user.password_hash):
         return templates.TemplateResponse("login.html", {"request": request, "error": "Invalid credentials"})
+    if password_needs_rehash(db_user.password_hash):
+        db_user.password_hash = await get_password_hash_async(password)
+        await db.commit()
     token = create_access_token({"sub": username})
     response = RedirectResponse(url="/dashboard")
-    response.set_cookie(key="access_token", value=token, httponly=True)
+    response.set_cookie(key="access_token", value=token, httponly=True, samesite="lax")
     return response
 
 @router.get("/signup", response_class=HTMLResponse)
@@ -43,22 +57,24 @@ async def signup_post(
     email: str = Form(...),
     password: str = Form(...),
     profile_photo: UploadFile = File(None),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    if db.query(User).filter(User.username == username).first():
+    if (await db.execute(select(User.id).where(User.username == username))).first():
         return templates.TemplateResponse("signup.html", {"request": request, "error": "Username taken"})
-    if db.query(User).filter(User.email == email).first():
+    if (await db.execute(select(User.id).where(User.email == email))).first():
         return templates.TemplateResponse("signup.html", {"request": request, "error": "Email taken"})
     profile_photo_url = None
     if profile_photo:
         item_id = int(uuid.uuid4().int % (10**9))
         ext = profile_photo.filename.split('.')[-1] if '.' in profile_photo.filename else 'jpg'
-        profile_photo_url = f"uploads/profile_{item_id}.{ext}"
-        contents = await profile_photo.read()
-        with open(profile_photo_url, "wb") as f:
-            f.write(contents)
+        if not PHOTO_NAME_RE.match(f"profile_0.{ext}"):
+            ext = "jpg"  # only names of that shape are served
+        profile_photo_url = f"photos/profile_{item_id}.{ext}"
+        tmp = temp_path()
+        await save_upload_file(profile_photo, tmp)
+        await run_in_threadpool(file_store.put, profile_photo_url, tmp)
 
-    hashed_pw = get_password_hash(password)
+    hashed_pw = await get_password_hash_async(password)
     api_key = str(uuid.uuid4())
     new_user = User(
         name=name,
@@ -69,29 +85,49 @@ async def signup_post(
         profile_photo=profile_photo_url
     )
     db.add(new_user)
-    db.commit()
+    await db.commit()
     token = create_access_token({"sub": username})
     response = RedirectResponse(url="/dashboard")
-    response.set_cookie(key="access_token", value=token, httponly=True)
+    response.set_cookie(key="access_token", value=token, httponly=True, samesite="lax")
     return response
 
+# Profile photos saved before the file store, at uploads/profile_<id>.<ext>, until
+# `manage.py migrate-storage` moves them under photos/. Nothing else in uploads/
+# is served: it holds private blobs, spilled texts and export archives.
+@router.get("/uploads/profile_{name}")
+def legacy_profile_photo(name: str, request: Request):
+    if not PHOTO_NAME_RE.match(f"profile_{name}"):
+        raise HTTPException(404, "Photo not found")
+    try:
+        return file_response(request, f"uploads/profile_{name}", cache_control=cache_control_for("image", public=True), inline=True)
+    except OSError:
+        raise HTTPException(404, "Photo not found")
+
 @router.get("/dashboard", response_class=HTMLResponse)
 def dashboard(
     request: Request,
+    cursor: str = None,
+    type: str = Query(None, pattern="^(text|image|video|document)$"),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    uploads = db.query(Upload).filter(Upload.user_id == current_user.id).all()
-    import glob
-    storage_used = sum(os.path.getsize(f) for f in glob.glob(f"uploads/*_{current_user.id}_*") if os.path.exists(f))
+    try:
+        uploads, next_cursor = list_uploads(db, current_user.id, DASHBOARD_PAGE_SIZE, cursor, type)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # Counters on the user row (current_user is a cached snapshot without them)
+    storage_used, uploads_count = get_usage(db, current_user.id)
+    totals = event_totals(db, current_user.id)
     analytics_data = {
         "labels": ["Uploads", "API Calls"],
-        "datasets": [{"data": [len(uploads), 5]}]
+        "datasets": [{"data": [uploads_count, totals.get("api_call", 0)]}]
     }
     return templates.TemplateResponse("dashboard.html", {
         "request": request,
         "user": current_user,
         "uploads": uploads,
+        "next_cursor": next_cursor,
+        "type": type,
         "storage_used": storage_used,
         "analytics": analytics_data
     })
@@ -99,20 +135,17 @@ def dashboard(
 @router.get("/admin", response_class=HTMLResponse)
 def admin_page(
     request: Request,
+    cursor: str = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Admin only")
-    users = db.query(User).all()
-    import glob
-    total_storage = sum(os.path.getsize(f) for f in glob.glob("uploads/*") if os.path.exists(f))
-    stats = {
-        "total_users": len(users),
-        "total_uploads": db.query(Upload).count(),
-        "total_storage_gb": round(total_storage / (1024**3), 2),
-        "premium_count": db.query(User).filter(User.is_premium == True).count()
-    }
+    try:
+        users, next_cursor = list_users(db, cursor=cursor)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    stats = site_totals(db)
     analytics_data = {
         "labels": ["Premium", "Free"],
         "datasets": [{"data": [stats["premium_count"], stats["total_users"] - stats["premium_count"]]}]
@@ -120,6 +153,7 @@ def admin_page(
     return templates.TemplateResponse("admin.html", {
         "request": request,
         "users": users,
+        "next_cursor": next_cursor,
         "stats": stats,
         "analytics": analytics_data
     })
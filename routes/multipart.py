@@ -0,0 +1,151 @@
+from fastapi import APIRouter, Depends, HTTPException, Form, Request
+from sqlalchemy.orm import Session, selectinload
+import os
+import uuid
+from datetime import datetime, timedelta
+from starlette.concurrency import run_in_threadpool
+from utils import get_current_user
+from ratelimit import limit_user
+from database import get_db
+from models import User, UploadSession, UploadPart
+from analytics import analytics_queue
+from events import event_hub
+from shares import upload_share_url
+from config import MULTIPART_MAX_PART_SIZE, UPLOAD_SESSION_TTL_HOURS
+from storage import (
+    remaining_quota, save_request_stream, assemble_parts, create_upload,
+    session_dir, part_path, remove_session_files, temp_path, QuotaExceeded
+)
+
+# Resumable multipart uploads:
+#   POST   /api/upload/sessions                    -> start a session
+#   PUT    /api/upload/sessions/{id}/parts/{n}     -> upload part n (raw body), any order, in parallel
+#   GET    /api/upload/sessions/{id}               -> list parts already received (for resuming)
+#   POST   /api/upload/sessions/{id}/complete      -> assemble parts 1..N into an Upload
+#   DELETE /api/upload/sessions/{id}               -> abort
+
+router = APIRouter()
+
+def get_session(session_id: str, user: User, db: Session) -> UploadSession:
+    session = (
+        db.query(UploadSession)
+        .options(selectinload(UploadSession.parts))
+        .filter(UploadSession.id == session_id, UploadSession.user_id == user.id)
+        .first()
+    )
+    if not session or session.expires_at < datetime.utcnow():
+        raise HTTPException(404, "Upload session not found or expired")
+    return session
+
+def session_info(session: UploadSession):
+    return {
+        "session_id": session.id,
+        "type": session.type,
+        "filename": session.filename,
+        "expires_at": session.expires_at.isoformat(),
+        "max_part_size": MULTIPART_MAX_PART_SIZE,
+        "parts": [{"part_number": p.part_number, "size": p.size_bytes, "sha256": p.sha256} for p in session.parts]
+    }
+
+@router.post("/sessions", dependencies=[limit_user(get_current_user, "upload")])
+def create_session(
+    type_: str = Form(..., alias="type"),
+    filename: str = Form(...),
+    share: bool = Form(False),
+    ttl_hours: int = Form(24, ge=1),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if type_ not in ["image", "video", "document"]:
+        raise HTTPException(400, "Invalid type")
+    session = UploadSession(
+        id=str(uuid.uuid4()),
+        user_id=current_user.id,
+        type=type_,
+        filename=filename,
+        share=share,
+        ttl_hours=ttl_hours,
+        expires_at=datetime.utcnow() + timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+    )
+    db.add(session)
+    db.commit()
+    os.makedirs(session_dir(session.id), exist_ok=True)
+    return session_info(session)
+
+@router.get("/sessions/{session_id}", dependencies=[limit_user(get_current_user)])
+def get_session_status(session_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    return session_info(get_session(session_id, current_user, db))
+
+def record_part(db: Session, session_id: str, part_number: int, size: int, sha256: str):
+    db.merge(UploadPart(session_id=session_id, part_number=part_number, size_bytes=size, sha256=sha256, received_at=datetime.utcnow()))
+    db.commit()
+
+@router.put("/sessions/{session_id}/parts/{part_number}", dependencies=[limit_user(get_current_user)])
+async def upload_part(
+    session_id: str,
+    part_number: int,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if part_number < 1:
+        raise HTTPException(400, "Part numbers start at 1")
+    session = await run_in_threadpool(get_session, session_id, current_user, db)
+    # Bytes already held by other parts count against the quota before the session completes
+    received = sum(p.size_bytes for p in session.parts if p.part_number != part_number)
+    quota = await run_in_threadpool(remaining_quota, db, current_user)
+    max_size = MULTIPART_MAX_PART_SIZE if quota is None else min(MULTIPART_MAX_PART_SIZE, max(quota - received, 0))
+    path = part_path(session_id, part_number)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(session_dir(session_id), exist_ok=True)
+    try:
+        size, sha256 = await save_request_stream(request.stream(), tmp_path, max_size=max_size)
+    except QuotaExceeded:
+        if quota is not None and quota - received < MULTIPART_MAX_PART_SIZE:
+            raise HTTPException(403, "Storage limit exceeded. Upgrade to premium!")
+        raise HTTPException(413, f"Parts are limited to {MULTIPART_MAX_PART_SIZE} bytes")
+    # A retried part replaces the earlier attempt atomically
+    os.replace(tmp_path, path)
+    await run_in_threadpool(record_part, db, session_id, part_number, size, sha256)
+    return {"part_number": part_number, "size": size, "sha256": sha256}
+
+@router.post("/sessions/{session_id}/complete", dependencies=[limit_user(get_current_user)])
+async def complete_session(session_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    session = await run_in_threadpool(get_session, session_id, current_user, db)
+    part_numbers = [p.part_number for p in session.parts]
+    if not part_numbers:
+        raise HTTPException(400, "No parts uploaded")
+    missing = sorted(set(range(1, part_numbers[-1] + 1)) - set(part_numbers))
+    if missing:
+        raise HTTPException(400, {"message": "Missing parts", "missing_parts": missing})
+
+    tmp = temp_path()
+    size_bytes, sha256 = await run_in_threadpool(assemble_parts, session_id, part_numbers, tmp)
+    # The session row is deleted in the same transaction that creates the upload
+    db.delete(session)
+    try:
+        new_upload = await run_in_threadpool(
+            create_upload, db, current_user, session.type, tmp=tmp, size_bytes=size_bytes, sha256=sha256,
+            filename=session.filename, share=session.share, ttl_hours=session.ttl_hours
+        )
+    except QuotaExceeded:
+        raise HTTPException(403, "Storage limit exceeded. Upgrade to premium!")
+    remove_session_files(session_id)
+    analytics_queue.enqueue(current_user.id, "upload", {"upload_id": new_upload.id, "type": new_upload.type, "multipart": True})
+    event_hub.publish(current_user.id, "upload", {"upload_id": new_upload.id, "type": new_upload.type, "size": new_upload.size_bytes})
+    return {
+        "success": True,
+        "item_id": new_upload.id,
+        "size": size_bytes,
+        "sha256": sha256,
+        "access_url": f"/api/v2/{current_user.username}?uploads={new_upload.id}",
+        "share_link": upload_share_url(new_upload)
+    }
+
+@router.delete("/sessions/{session_id}", dependencies=[limit_user(get_current_user)])
+def abort_session(session_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    session = get_session(session_id, current_user, db)
+    db.delete(session)
+    db.commit()
+    remove_session_files(session_id)
+    return {"success": True}
@@ -0,0 +1,80 @@
+from fastapi import APIRouter, WebSocket, HTTPException
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import json
+from urllib.parse import urlsplit
+from config import WS_ALLOWED_ORIGINS
+from database import SessionLocal
+from events import event_hub, TooManyConnections
+from utils import user_from_token
+
+# Live activity for dashboards:
+#   ws://<host>/ws/logs?token=<access token>   (or the access_token cookie, from the app's own pages)
+#
+# Server -> client messages are JSON objects, one per event:
+#   {"type": "upload" | "delete" | "share_access" | "api_call", "data": {...}, "ts": "..."}
+# api_call events carry "count" when several were merged, and
+# {"type": "dropped", "count": n} means n events were lost because the client fell behind.
+# Anything the client sends is ignored. Events come from events.event_hub; an
+# idle connection costs two suspended coroutines and no database or polling work.
+
+router = APIRouter()
+
+def _authenticate(token: str):
+    db = SessionLocal()  # only used on a principal cache miss
+    try:
+        return user_from_token(token, db)
+    except HTTPException:
+        return None
+    finally:
+        db.close()
+
+def _same_origin(websocket: WebSocket) -> bool:
+    # Browsers send Origin on every WebSocket handshake and attach cookies whichever
+    # site opened it, so the cookie only counts when the page is ours
+    origin = websocket.headers.get("origin")
+    if not origin:
+        return False
+    return origin.rstrip("/") in WS_ALLOWED_ORIGINS or urlsplit(origin).netloc == websocket.headers.get("host")
+
+async def _read_until_closed(websocket: WebSocket, sub):
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+    except Exception:
+        pass
+    finally:
+        sub.close()
+
+@router.websocket("/ws/logs")
+async def live_events(websocket: WebSocket):
+    token = websocket.query_params.get("token")
+    if not token and _same_origin(websocket):
+        token = websocket.cookies.get("access_token")
+    user = await run_in_threadpool(_authenticate, token) if token else None
+    if user is None:
+        await websocket.close(code=1008)  # policy violation
+        return
+    try:
+        sub = event_hub.subscribe(user.id)
+    except TooManyConnections:
+        await websocket.close(code=1013)  # try again later
+        return
+    reader = None
+    try:
+        await websocket.accept()
+        reader = asyncio.ensure_future(_read_until_closed(websocket, sub))
+        while True:
+            events = await sub.get()
+            if events is None:
+                break
+            for event in events:
+                await websocket.send_text(json.dumps(event, default=str))
+    except Exception:
+        pass  # client went away mid-send
+    finally:
+        if reader is not None:
+            reader.cancel()
+        event_hub.unsubscribe(sub)
@@ -0,0 +1,267 @@
+from sqlalchemy import text, select, bindparam, Integer, BigInteger, DateTime, Float
+from sqlalchemy.orm import Session
+import logging
+import re
+from config import SEARCH_TS_CONFIG, SEARCH_INDEX_CHARS, SEARCH_MAX_TERMS
+from admin_stats import encode_cursor, decode_cursor
+from models import Upload
+from textstore import TEXT_COLUMNS, read_text_head
+
+# Full-text search over text uploads (GET /api/search).
+#
+# Texts above TEXT_INLINE_MAX are stored compressed (textstore.py), so the
+# database can't index uploads.content itself; the index is written from the
+# text by index_texts(), in the same transaction as the upload, and a row
+# delete removes its entry.
+#
+# Postgres: uploads.search_vector, a tsvector of the first SEARCH_INDEX_CHARS
+# characters, with a GIN index on (user_id, search_vector) (btree_gin) so a
+# lookup only touches one user's postings. Built once with
+# `python manage.py search-index`, which also indexes existing rows.
+#
+# SQLite (local runs): an FTS5 table, uploads_fts, keyed by upload id and
+# emptied by a delete trigger on uploads; created at startup.
+#
+# Every query term is matched as a prefix; results are ranked (ts_rank_cd /
+# bm25) and paged by keyset on (score, id). bm25 depends on corpus statistics,
+# so on SQLite a page boundary can shift if uploads change between requests.
+
+logger = logging.getLogger("dataforge.search")
+
+class SearchUnavailable(Exception):
+    pass
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_CONFIG_RE = re.compile(r"^\w+$")
+SNIPPET_MARK = "**"
+BACKFILL_BATCH = 500
+
+def parse_query(q: str) -> list:
+    """Search terms: words of two or more characters, lowercased, at most SEARCH_MAX_TERMS."""
+    terms = []
+    for word in _WORD_RE.findall(q.lower()):
+        word = word.strip("_")
+        if len(word) >= 2 and word not in terms:
+            terms.append(word)
+    return terms[:SEARCH_MAX_TERMS]
+
+def _ts_config() -> str:
+    if not _CONFIG_RE.match(SEARCH_TS_CONFIG):
+        raise RuntimeError(f"Invalid SEARCH_TS_CONFIG {SEARCH_TS_CONFIG!r}")
+    return SEARCH_TS_CONFIG
+
+# Index maintenance
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE uploads_fts USING fts5("
+    "content, tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER uploads_fts_ad AFTER DELETE ON uploads BEGIN "
+    "DELETE FROM uploads_fts WHERE rowid = old.id; END",
+]
+# The first version of the SQLite index read uploads.content directly
+SQLITE_OLD_OBJECTS = ("uploads_fts_ai", "uploads_fts_ad", "uploads_fts_au")
+
+POSTGRES_INDEX = (
+    "UPDATE uploads SET search_vector = to_tsvector(CAST(:config AS regconfig), :doc) WHERE id = :id"
+)
+SQLITE_INDEX = "INSERT OR REPLACE INTO uploads_fts(rowid, content) VALUES (:id, :doc)"
+
+_ready = {}  # dialect -> True once the index has been seen
+
+def _index_exists(db) -> bool:
+    dialect = db.bind.dialect.name
+    if dialect in _ready:
+        return True
+    if dialect == "postgresql":
+        found = db.execute(text(
+            "SELECT 1 FROM information_schema.columns WHERE table_name = 'uploads' AND column_name = 'search_vector'"
+        )).first()
+    elif dialect == "sqlite":
+        found = db.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'uploads_fts'")).first()
+    else:
+        found = None
+    if found:
+        _ready[dialect] = True
+    return bool(found)
+
+def index_texts(db, docs):
+    """Index [(upload_id, text)] in the caller's transaction; a no-op until the index is built."""
+    if not docs or not _index_exists(db):
+        return
+    rows = [{"id": upload_id, "doc": doc[:SEARCH_INDEX_CHARS]} for upload_id, doc in docs]
+    if db.bind.dialect.name == "postgresql":
+        config = _ts_config()
+        for row in rows:
+            row["config"] = config
+        db.execute(text(POSTGRES_INDEX), rows)
+    else:
+        db.execute(text(SQLITE_INDEX), rows)
+
+def _backfill(conn, where: str, sql: str, config: str = None) -> int:
+    """Index existing text rows matching where, in batches; returns how many."""
+    done = 0
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            select(Upload.id, *TEXT_COLUMNS)
+            .where(Upload.id > last_id, Upload.type == "text", text(where))
+            .order_by(Upload.id)
+            .limit(BACKFILL_BATCH)
+        ).all()
+        if not rows:
+            return done
+        params = [{"id": r.id, "doc": read_text_head(r, SEARCH_INDEX_CHARS) or "", "config": config} for r in rows]
+        conn.execute(text(sql), params)
+        conn.commit()
+        done += len(rows)
+        last_id = rows[-1].id
+
+def ensure_sqlite_index(engine) -> bool:
+    """Create and fill the FTS5 table if missing; True if it was created."""
+    if engine.dialect.name != "sqlite":
+        return False
+    with engine.connect() as conn:
+        existing = conn.execute(text("SELECT sql FROM sqlite_master WHERE name = 'uploads_fts'")).scalar()
+        if existing and "content='uploads'" not in existing:
+            return False
+        if not conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'uploads'")).first():
+            return False  # schema not created yet
+        try:
+            for name in SQLITE_OLD_OBJECTS:
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+            conn.execute(text("DROP TABLE IF EXISTS uploads_fts"))
+            for statement in SQLITE_DDL:
+                conn.execute(text(statement))
+        except Exception as e:
+            # SQLite built without FTS5: search stays unavailable
+            logger.warning("Could not create the search index: %s", e)
+            raise SearchUnavailable("This SQLite build has no FTS5 support") from e
+        conn.commit()
+        _backfill(conn, "1 = 1", SQLITE_INDEX)
+    return True
+
+def build_search_index(engine) -> str:
+    """Add the search column and index and index existing texts; safe to re-run.
+
+    On Postgres the index is built CONCURRENTLY and rows are indexed in
+    small committed batches, so this can run against a live app.
+    """
+    if engine.dialect.name == "sqlite":
+        return "created uploads_fts" if ensure_sqlite_index(engine) else "uploads_fts already exists"
+    if engine.dialect.name != "postgresql":
+        raise SearchUnavailable(f"Search is not supported on {engine.dialect.name}")
+    config = _ts_config()
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("ALTER TABLE uploads ADD COLUMN IF NOT EXISTS search_vector tsvector"))
+        # Databases set up with the earlier generated-column version keep their vectors
+        conn.execute(text("ALTER TABLE uploads ALTER COLUMN search_vector DROP EXPRESSION IF EXISTS"))
+        try:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gin"))
+            columns = "user_id, search_vector"
+        except Exception as e:
+            logger.warning("btree_gin unavailable (%s); indexing search_vector alone", e)
+            columns = "search_vector"
+        conn.execute(text(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_uploads_search ON uploads USING GIN ({columns}) WHERE type = 'text'"
+        ))
+    with engine.connect() as conn:
+        indexed = _backfill(conn, "search_vector IS NULL", POSTGRES_INDEX, config)
+    _ready.clear()
+    return f"search_vector and GIN index on ({columns}), {indexed} texts indexed"
+
+def _check_ready(db: Session) -> str:
+    if not _index_exists(db):
+        raise SearchUnavailable("Search index not built; run `python manage.py search-index`")
+    return db.bind.dialect.name
+
+# Queries
+
+POSTGRES_SEARCH = """
+SELECT id, created_at, size, score FROM (
+    SELECT u.id, u.created_at, u.content_length AS size, ts_rank_cd(u.search_vector, q.query)::float8 AS score
+    FROM uploads u, to_tsquery(CAST(:config AS regconfig), :query) AS q(query)
+    WHERE u.user_id = :user_id AND u.type = 'text' AND u.search_vector @@ q.query
+) matches
+WHERE :first OR score < :score OR (score = :score AND id < :last_id)
+ORDER BY score DESC, id DESC
+LIMIT :limit
+"""
+
+# Headlines are built from the text head passed in, since compressed texts aren't in content
+POSTGRES_SNIPPETS = f"""
+SELECT t.id, ts_headline(CAST(:config AS regconfig), t.doc, to_tsquery(CAST(:config AS regconfig), :query),
+    'StartSel={SNIPPET_MARK}, StopSel={SNIPPET_MARK}, MaxWords=24, MinWords=8, MaxFragments=2')
+FROM unnest(CAST(:ids AS integer[]), CAST(:docs AS text[])) AS t(id, doc)
+"""
+
+SQLITE_SEARCH = """
+SELECT id, created_at, size, score FROM (
+    SELECT u.id, u.created_at, u.content_length AS size, -bm25(uploads_fts) AS score
+    FROM uploads_fts JOIN uploads u ON u.id = uploads_fts.rowid
+    WHERE uploads_fts MATCH :query AND u.user_id = :user_id AND u.type = 'text'
+) matches
+WHERE :first OR score < :score OR (score = :score AND id < :last_id)
+ORDER BY score DESC, id DESC
+LIMIT :limit
+"""
+
+SQLITE_SNIPPETS = f"""
+SELECT rowid, snippet(uploads_fts, 0, '{SNIPPET_MARK}', '{SNIPPET_MARK}', '…', 24)
+FROM uploads_fts WHERE uploads_fts MATCH :query AND rowid IN :ids
+"""
+
+RESULT_COLUMNS = {"id": Integer, "created_at": DateTime, "size": BigInteger, "score": Float}
+
+def _snippets(db: Session, dialect: str, query: str, ids: list) -> dict:
+    if dialect == "postgresql":
+        rows = db.execute(select(Upload.id, *TEXT_COLUMNS).where(Upload.id.in_(ids))).all()
+        docs = {r.id: read_text_head(r, SEARCH_INDEX_CHARS) or "" for r in rows}
+        return dict(db.execute(text(POSTGRES_SNIPPETS), {
+            "config": _ts_config(), "query": query, "ids": list(docs), "docs": list(docs.values()),
+        }).all())
+    return dict(db.execute(
+        text(SQLITE_SNIPPETS).bindparams(bindparam("ids", expanding=True)), {"query": query, "ids": ids}
+    ).all())
+
+def search_uploads(db: Session, user_id: int, q: str, limit: int = 20, cursor: str = None):
+    """One page of a user's text uploads matching q, best first, plus the cursor for the next page.
+
+    Raises ValueError for a query with no usable terms and SearchUnavailable
+    when the index hasn't been built.
+    """
+    terms = parse_query(q)
+    if not terms:
+        raise ValueError("Query needs at least one word of two or more characters")
+    dialect = _check_ready(db)
+    if dialect == "postgresql":
+        query = " & ".join(f"'{t}':*" for t in terms)
+        search_sql = POSTGRES_SEARCH
+    else:
+        query = " ".join(f'"{t}"*' for t in terms)
+        search_sql = SQLITE_SEARCH
+
+    params = {"query": query, "user_id": user_id, "limit": limit + 1, "first": True, "score": 0.0, "last_id": 0}
+    if dialect == "postgresql":
+        params["config"] = _ts_config()
+    if cursor:
+        score, last_id = decode_cursor(cursor)
+        params.update(first=False, score=float(score), last_id=int(last_id))
+
+    rows = db.execute(text(search_sql).columns(**RESULT_COLUMNS), params).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].score, rows[-1].id)
+
+    snippets = _snippets(db, dialect, query, [r.id for r in rows]) if rows else {}
+    items = [
+        {
+            "id": r.id,
+            "created_at": r.created_at,
+            "size": r.size,
+            "score": round(r.score, 6),
+            "snippet": snippets.get(r.id),
+        }
+        for r in rows
+    ]
+    return items, next_cursor
@@ -0,0 +1,208 @@
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from email.utils import formatdate, parsedate_to_datetime
+from datetime import datetime, timezone
+import mimetypes
+import os
+import re
+import unicodedata
+import uuid
+from urllib.parse import quote
+from config import FILE_CACHE_MAX_AGE
+from filestore import file_store
+
+# File responses with HTTP Range (single and multi-range), strong ETags and
+# conditional GET, shared by downloads, owner file links and share links.
+# Bytes are read through the file store, so they may be local or remote.
+
+MAX_RANGES = 16
+_RANGE_SPEC_RE = re.compile(r"^(\d*)-(\d*)$")
+
+def parse_ranges(header: str, size: int):
+    """Return a sorted, merged list of inclusive (start, end) ranges, or None to serve the whole file.
+
+    Raises ValueError when no requested range can be satisfied.
+    """
+    if not header or not header.strip().startswith("bytes="):
+        return None
+    ranges = []
+    for spec in header.strip()[len("bytes="):].split(","):
+        match = _RANGE_SPEC_RE.match(spec.strip())
+        if not match:
+            return None  # malformed: ignore the header, as RFC 9110 allows
+        first, last = match.groups()
+        if not first and not last:
+            return None
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(size - length, 0), size - 1))
+            continue
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start < size and start <= end:
+            ranges.append((start, end))
+    if not ranges:
+        raise ValueError("range not satisfiable")
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    if len(merged) > MAX_RANGES:
+        return None  # too fragmented to be worth it; send the whole thing
+    return merged
+
+def iter_multipart(key: str, ranges, size: int, media_type: str, boundary: str):
+    for start, end in ranges:
+        yield (
+            f"\r\n--{boundary}\r\nContent-Type: {media_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ).encode()
+        yield from file_store.iter_range(key, start, end - start + 1)
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+def _multipart_length(ranges, size: int, media_type: str, boundary: str) -> int:
+    total = len(f"\r\n--{boundary}--\r\n")
+    for start, end in ranges:
+        total += len(
+            f"\r\n--{boundary}\r\nContent-Type: {media_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ) + end - start + 1
+    return total
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if not header or not etag:
+        return False
+    if header.strip() == "*":
+        return True
+    # Weak comparison, as If-None-Match requires
+    bare = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == bare for tag in header.split(","))
+
+def _not_modified_since(header: str, last_modified: datetime) -> bool:
+    if not header or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    return int(last_modified.timestamp()) <= int(since.timestamp())
+
+def cache_control_for(upload_type: str, public: bool = False, max_age: int = None) -> str:
+    age = FILE_CACHE_MAX_AGE.get(upload_type, FILE_CACHE_MAX_AGE["default"])
+    if max_age is not None:
+        age = max(min(age, max_age), 0)
+    if age == 0:
+        return "no-cache"
+    return f"{'public' if public else 'private'}, max-age={age}"
+
+def content_disposition(filename: str, inline: bool = False) -> str:
+    # ASCII fallback for old clients plus the exact name as RFC 5987 filename*
+    fallback = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode()
+    fallback = re.sub(r"[\x00-\x1f\x7f]", "_", fallback).strip() or "download"
+    quoted = fallback.replace("\\", "\\\\").replace('"', '\\"')
+    value = f'{"inline" if inline else "attachment"}; filename="{quoted}"'
+    if fallback != filename:
+        value += f"; filename*=UTF-8''{quote(filename, safe='')}"
+    return value
+
+def file_response(
+    request: Request,
+    key: str,
+    media_type: str = None,
+    filename: str = None,
+    etag: str = None,
+    last_modified: datetime = None,
+    cache_control: str = None,
+    inline: bool = False,
+):
+    """Serve the stored file key honouring Range, If-Range, If-None-Match and If-Modified-Since.
+
+    Raises FileNotFoundError if nothing is stored under key.
+    """
+    size, mtime = file_store.stat(key)
+    media_type = media_type or (mimetypes.guess_type(filename or key)[0]) or "application/octet-stream"
+    if last_modified is None:
+        last_modified = mtime
+    elif last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    if etag is None:
+        etag = f'W/"{int(last_modified.timestamp()):x}-{size:x}"'
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": formatdate(last_modified.timestamp(), usegmt=True),
+    }
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    if filename:
+        headers["Content-Disposition"] = content_disposition(filename, inline)
+
+    # Conditional GET: If-None-Match wins over If-Modified-Since when both are sent
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    elif _not_modified_since(request.headers.get("if-modified-since"), last_modified):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and if_range:
+        # Only honour the range if the client's copy is still current (strong match)
+        if if_range.startswith(("\"", "W/")):
+            if etag.startswith("W/") or if_range.strip() != etag:
+                range_header = None
+        elif not _not_modified_since(if_range, last_modified):
+            range_header = None
+    try:
+        ranges = parse_ranges(range_header, size)
+    except ValueError:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status_code=416, headers=headers)
+
+    if not ranges:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(file_store.iter_range(key, 0, size), media_type=media_type, headers=headers)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(file_store.iter_range(key, start, end - start + 1), status_code=206, media_type=media_type, headers=headers)
+    boundary = uuid.uuid4().hex
+    headers["Content-Length"] = str(_multipart_length(ranges, size, media_type, boundary))
+    return StreamingResponse(
+        iter_multipart(key, ranges, size, media_type, boundary),
+        status_code=206,
+        media_type=f"multipart/byteranges; boundary={boundary}",
+        headers=headers,
+    )
+
+def variant_file_response(request: Request, variant, upload_type: str, public: bool = False, max_age: int = None):
+    """Serve a MediaVariant; its ETag changes whenever the variant is regenerated."""
+    return file_response(
+        request,
+        variant.key,
+        media_type=variant.mime_type,
+        etag=f'"v{variant.id}-{int(variant.created_at.timestamp()):x}"',
+        last_modified=variant.created_at,
+        cache_control=cache_control_for(upload_type, public=public, max_age=max_age),
+        inline=True,
+    )
+
+def upload_file_response(request: Request, upload, public: bool = False, max_age: int = None, download_name: str = None):
+    """Serve an Upload's bytes with a strong ETag from its content hash."""
+    return file_response(
+        request,
+        upload.file_url,
+        filename=download_name or upload.filename or os.path.basename(upload.file_url),
+        etag=f'"{upload.sha256}"' if upload.sha256 else None,
+        last_modified=upload.created_at,
+        cache_control=cache_control_for(upload.type, public=public, max_age=max_age),
+        inline=True,
+    )
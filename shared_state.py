@@ -0,0 +1,84 @@
+import sqlite3
+import threading
+import time
+import random
+from config import SHARED_STATE_PATH
+
+class SharedStore:
+    """Small key/value store with per-key expiry, visible to every worker on the host.
+
+    Backed by a SQLite file in WAL mode (on tmpfs by default), so it needs
+    no extra service and survives individual worker restarts.
+    """
+
+    def __init__(self, path: str = SHARED_STATE_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL, ok INTEGER) WITHOUT ROWID"
+            )
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str):
+        row = self.conn.execute("SELECT value FROM kv WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: float):
+        now = time.time()
+        self.conn.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)", (key, value, now + ttl))
+        if random.random() < 0.01:
+            self.conn.execute("DELETE FROM kv WHERE expires <= ?", (now,))
+
+    def scan(self, prefix: str):
+        """All live (key, value) pairs whose key starts with prefix."""
+        return self.conn.execute(
+            "SELECT key, value FROM kv WHERE key >= ? AND key < ? AND expires > ?",
+            (prefix, prefix + "\uffff", time.time())
+        ).fetchall()
+
+    def delete(self, *keys: str):
+        if keys:
+            self.conn.execute(f"DELETE FROM kv WHERE key IN ({','.join('?' * len(keys))})", keys)
+
+    def take_tokens(self, key: str, capacity: float, rate: float, cost: float = 1.0):
+        """Token bucket: refill at rate per second up to capacity, then take cost if available.
+
+        One UPSERT, so concurrent takes from any worker are serialized by
+        SQLite. Returns (taken, tokens left).
+        """
+        now = time.time()
+        ok, tokens = self.conn.execute(TAKE_TOKENS, {"key": key, "capacity": capacity, "rate": rate, "cost": cost, "now": now}).fetchone()
+        if random.random() < 0.001:
+            # An idle bucket refills; once full it is the same as no row
+            self.conn.execute("DELETE FROM buckets WHERE updated < ?", (now - BUCKET_IDLE,))
+        return bool(ok), tokens
+
+# SET expressions all see the row as it was before the update
+_AVAILABLE = "min(:capacity, tokens + max(:now - updated, 0) * :rate)"
+TAKE_TOKENS = f"""
+INSERT INTO buckets (key, tokens, updated, ok) VALUES (:key, :capacity - :cost, :now, :capacity >= :cost)
+ON CONFLICT (key) DO UPDATE SET
+    tokens = CASE WHEN {_AVAILABLE} >= :cost THEN {_AVAILABLE} - :cost ELSE {_AVAILABLE} END,
+    ok = {_AVAILABLE} >= :cost,
+    updated = :now
+RETURNING ok, tokens
+"""
+BUCKET_IDLE = 86400  # longest refill period ratelimit.py accepts
+
+_store = None
+
+def get_shared_store() -> SharedStore:
+    global _store
+    if _store is None:
+        _store = SharedStore()
+    return _store
@@ -0,0 +1,157 @@
+from sqlalchemy import select, event, insert, text, DateTime
+from sqlalchemy.orm import Session
+from dataclasses import dataclass
+from datetime import datetime
+import uuid
+from config import (
+    SHARE_CACHE_SIZE, SHARE_CACHE_TTL, SHARE_NEGATIVE_CACHE_SIZE, SHARE_NEGATIVE_CACHE_TTL,
+    SHARE_MAX_MISSES_PER_IP, SHARE_MISS_WINDOW
+)
+from models import Upload, ShareLink
+from principal_cache import MemoryBackend
+
+# Share-link resolution for GET /api/share/{id}?token=...
+# Tokens are random uuid4s minted with the link, so a token that is unknown now
+# can never become valid later; that is what makes the negative cache safe.
+
+class TooManyMisses(Exception):
+    pass
+
+@dataclass(frozen=True)
+class SharedFile:
+    """The Upload columns needed to serve a share (same names, so serving.upload_file_response accepts it)."""
+    id: int
+    type: str
+    file_url: str
+    filename: str
+    sha256: str
+    created_at: datetime
+    expires_at: datetime
+    user_id: int  # owner, for share_access events
+
+def share_url(upload_id: int, token: str) -> str:
+    return f"/api/share/{upload_id}?token={token}"
+
+def upload_share_url(upload: Upload):
+    return share_url(upload.id, upload.share_links[0].token) if upload.share_links else None
+
+def _well_formed(token: str) -> bool:
+    try:
+        return str(uuid.UUID(token)) == token
+    except (ValueError, AttributeError, TypeError):
+        return False
+
+class ShareResolver:
+    def __init__(self):
+        self.positive = MemoryBackend(SHARE_CACHE_SIZE, SHARE_CACHE_TTL)
+        self.negative = MemoryBackend(SHARE_NEGATIVE_CACHE_SIZE, SHARE_NEGATIVE_CACHE_TTL)
+        self.misses_by_ip = MemoryBackend(SHARE_NEGATIVE_CACHE_SIZE, SHARE_MISS_WINDOW)
+        self.hits = 0
+        self.negative_hits = 0
+        self.lookups = 0
+        self.rejected = 0
+
+    def _miss(self, token: str, client_ip: str):
+        self.negative.set(token, True)
+        if client_ip:
+            # Each miss extends the window, so a client that keeps guessing stays blocked
+            self.misses_by_ip.set(client_ip, (self.misses_by_ip.get(client_ip) or 0) + 1)
+
+    def resolve(self, db: Session, item_id: int, token: str, client_ip: str = None):
+        """Return the SharedFile for a valid, unexpired link, or None.
+
+        Raises TooManyMisses, before any database work, for clients that have
+        sent too many unknown tokens recently.
+        """
+        now = datetime.utcnow()
+        shared = self.positive.get(token)
+        if shared is not None:
+            if shared.id == item_id and (shared.expires_at is None or shared.expires_at > now):
+                self.hits += 1
+                return shared
+            return None
+        if client_ip and (self.misses_by_ip.get(client_ip) or 0) >= SHARE_MAX_MISSES_PER_IP:
+            self.rejected += 1
+            raise TooManyMisses()
+        if not _well_formed(token) or self.negative.get(token):
+            self.negative_hits += 1
+            self._miss(token, client_ip)
+            return None
+
+        self.lookups += 1
+        row = db.execute(
+            select(
+                Upload.id, Upload.type, Upload.file_url, Upload.filename, Upload.sha256, Upload.created_at,
+                ShareLink.expires_at, Upload.user_id
+            )
+            .join(ShareLink, ShareLink.upload_id == Upload.id)
+            .where(ShareLink.token == token)
+        ).first()
+        if row is None or (row.expires_at is not None and row.expires_at <= now):
+            self._miss(token, client_ip)
+            return None
+        shared = SharedFile(*row)
+        self.positive.set(token, shared)
+        # A valid token for the wrong item is a miss for this request only
+        return shared if shared.id == item_id else None
+
+    def invalidate(self, *tokens):
+        self.positive.delete(*tokens)
+
+    def stats(self):
+        return {
+            "cached": len(self.positive),
+            "negative_cached": len(self.negative),
+            "throttled_ips": len(self.misses_by_ip),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "db_lookups": self.lookups,
+            "rejected": self.rejected,
+        }
+
+share_resolver = ShareResolver()
+
+# Links deleted through the ORM (upload deletion, revocation) leave this worker's
+# cache on commit; other workers drop them within SHARE_CACHE_TTL.
+
+@event.listens_for(Session, "after_flush")
+def _collect_share_deletions(session, flush_context):
+    tokens = [obj.token for obj in session.deleted if isinstance(obj, ShareLink)]
+    if tokens:
+        session.info.setdefault("share_invalidations", set()).update(tokens)
+
+@event.listens_for(Session, "after_commit")
+def _apply_share_invalidations(session):
+    tokens = session.info.pop("share_invalidations", None)
+    if tokens:
+        share_resolver.invalidate(*tokens)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_share_invalidations(session):
+    session.info.pop("share_invalidations", None)
+
+def migrate_legacy_share_tokens(db: Session, batch_size: int = 1000) -> int:
+    """Copy uploads.share_token / share_expires_at (the old inline columns) into share_links."""
+    migrated = 0
+    last_id = 0
+    while True:
+        rows = db.execute(
+            text(
+                "SELECT id, share_token, share_expires_at FROM uploads "
+                "WHERE id > :last_id AND share_token IS NOT NULL ORDER BY id LIMIT :limit"
+            ).columns(share_expires_at=DateTime),  # typed, so SQLite's text timestamps come back as datetimes
+            {"last_id": last_id, "limit": batch_size},
+        ).all()
+        if not rows:
+            break
+        existing = set(db.execute(select(ShareLink.token).where(ShareLink.token.in_([r[1] for r in rows]))).scalars())
+        new = [
+            {"token": token, "upload_id": upload_id, "expires_at": expires_at, "created_at": datetime.utcnow()}
+            for upload_id, token, expires_at in rows if token not in existing
+        ]
+        if new:
+            db.execute(insert(ShareLink), new)
+        db.commit()
+        migrated += len(new)
+        last_id = rows[-1][0]
+    return migrated
@@ -0,0 +1,492 @@
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import update, select, insert, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+import os
+import shutil
+import hashlib
+import time
+import uuid
+from datetime import datetime, timedelta
+from config import UPLOAD_CHUNK_SIZE
+from metrics import observe_upload
+from filestore import file_store, LocalBackend, LEGACY_PREFIX
+from models import User, Upload, UploadSession, Blob, PendingDeletion, ShareLink, MediaJob
+from textstore import pack_text, NO_TEXT
+from search import index_texts
+
+class QuotaExceeded(Exception):
+    pass
+
+# Storage accounting
+# User.storage_used is a running total of Upload.size_bytes, and User.uploads_count
+# of Upload rows, kept in step with the uploads table inside the same transaction,
+# so quota checks and the admin user list never aggregate uploads.
+
+def reserve_storage(db: Session, user: User, size: int) -> bool:
+    # Atomic check-and-increment so concurrent uploads can't overshoot the quota
+    stmt = update(User).where(User.id == user.id)
+    if not user.is_premium:
+        stmt = stmt.where(User.storage_used + size <= User.storage_limit)
+    result = db.execute(stmt.values(storage_used=User.storage_used + size))
+    return result.rowcount == 1
+
+def get_usage(db: Session, user_id: int):
+    """(storage_used, uploads_count) from the maintained counters, in one primary key lookup."""
+    return db.query(User.storage_used, User.uploads_count).filter(User.id == user_id).one()
+
+def remaining_quota(db: Session, user: User):
+    # None means unlimited
+    if user.is_premium:
+        return None
+    limit, used = db.query(User.storage_limit, User.storage_used).filter(User.id == user.id).one()
+    return max(limit - used, 0)
+
+def release_storage(db: Session, user_id: int, size: int):
+    if size:
+        db.execute(update(User).where(User.id == user_id).values(storage_used=User.storage_used - size))
+
+def count_uploads(db: Session, user_id: int, delta: int):
+    db.execute(update(User).where(User.id == user_id).values(uploads_count=User.uploads_count + delta))
+
+# Streaming ingest
+
+def copy_stream(src, dest_path: str, max_size: int = None):
+    """Copy a file object to dest_path chunk by chunk, returning (size, sha256 hex).
+
+    Raises QuotaExceeded as soon as more than max_size bytes have been read;
+    the partial file is removed on any failure.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(dest_path, "wb") as out:
+            while True:
+                chunk = src.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise QuotaExceeded()
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+    return size, digest.hexdigest()
+
+async def save_upload_file(file: UploadFile, dest_path: str, max_size: int = None):
+    # The whole copy runs in the threadpool so disk I/O never blocks the event loop
+    await file.seek(0)
+    started = time.perf_counter()
+    size, sha256 = await run_in_threadpool(copy_stream, file.file, dest_path, max_size)
+    observe_upload("form", size, time.perf_counter() - started)
+    return size, sha256
+
+async def save_request_stream(stream, dest_path: str, max_size: int = None):
+    # Same contract as copy_stream, for a raw request body (request.stream())
+    digest = hashlib.sha256()
+    size = 0
+    started = time.perf_counter()
+    out = await run_in_threadpool(open, dest_path, "wb")
+    try:
+        async for chunk in stream:
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise QuotaExceeded()
+            digest.update(chunk)
+            await run_in_threadpool(out.write, chunk)
+    except BaseException:
+        out.close()
+        os.remove(dest_path)
+        raise
+    await run_in_threadpool(out.close)
+    observe_upload("stream", size, time.perf_counter() - started)
+    return size, digest.hexdigest()
+
+# Multipart upload sessions keep their parts under uploads/.parts/<session_id>/
+
+def session_dir(session_id: str) -> str:
+    return os.path.join("uploads", ".parts", session_id)
+
+def part_path(session_id: str, part_number: int) -> str:
+    return os.path.join(session_dir(session_id), f"{part_number:05d}")
+
+def assemble_parts(session_id: str, part_numbers, dest_path: str):
+    """Concatenate the given parts into dest_path, returning (size, sha256 hex)."""
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(dest_path, "wb") as out:
+            for n in part_numbers:
+                with open(part_path(session_id, n), "rb") as src:
+                    while True:
+                        chunk = src.read(UPLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+                        digest.update(chunk)
+                        out.write(chunk)
+    except BaseException:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+    return size, digest.hexdigest()
+
+def remove_session_files(session_id: str):
+    shutil.rmtree(session_dir(session_id), ignore_errors=True)
+
+def gc_upload_sessions(db: Session, now: datetime = None, batch_size: int = 100):
+    """Delete expired multipart sessions and their parts, returning how many were removed."""
+    now = now or datetime.utcnow()
+    removed = 0
+    while True:
+        sessions = (
+            db.query(UploadSession)
+            .filter(UploadSession.expires_at < now)
+            .order_by(UploadSession.expires_at)
+            .limit(batch_size)
+            .all()
+        )
+        if not sessions:
+            break
+        for session in sessions:
+            db.delete(session)
+        db.commit()
+        for session in sessions:
+            remove_session_files(session.id)
+        removed += len(sessions)
+    return removed
+
+# Rows written before the file store hold uploads/... paths, which are always on local disk
+legacy_files = LocalBackend()
+
+# Content-addressed blob store
+# File bytes live once per distinct SHA-256 under the file store key blobs/<sha256>
+# (uploads/blobs/ab/cd/<sha256> on local disk); Upload rows point at a Blob and
+# Blob.refcount counts those rows.
+
+def temp_path() -> str:
+    os.makedirs(os.path.join("uploads", "tmp"), exist_ok=True)
+    return os.path.join("uploads", "tmp", uuid.uuid4().hex)
+
+def blob_key(sha256: str) -> str:
+    return f"blobs/{sha256}"
+
+def store_blob(db: Session, src_path: str, size: int, sha256: str) -> str:
+    """Take ownership of src_path and return the file store key of the blob holding its bytes.
+
+    An existing blob just gains a reference and src_path is discarded, so a
+    duplicate upload costs no extra disk. Runs inside the caller's transaction.
+    """
+    blob = db.query(Blob).filter(Blob.sha256 == sha256).with_for_update().first()
+    if blob is None:
+        key = blob_key(sha256)
+        file_store.put(key, src_path)
+        try:
+            with db.begin_nested():
+                db.add(Blob(sha256=sha256, size_bytes=size, path=key, refcount=1))
+            return key
+        except IntegrityError:
+            # Another request stored the same bytes first; fall through and share its blob
+            blob = db.query(Blob).filter(Blob.sha256 == sha256).with_for_update().one()
+    elif os.path.exists(src_path):
+        os.remove(src_path)
+    blob.refcount = Blob.refcount + 1
+    return blob.path
+
+def create_upload(
+    db: Session, user, type_: str, content: str = None, tmp: str = None, size_bytes: int = 0,
+    sha256: str = None, filename: str = None, share: bool = False, ttl_hours: int = 24
+) -> Upload:
+    """Persist a new Upload in one transaction, together with its blob and media job for file uploads.
+
+    tmp is a fully written temp file (see temp_path); raises QuotaExceeded
+    if the user's quota can't absorb size_bytes. Anything else pending on
+    db (e.g. a finished upload session being deleted) commits with it.
+    """
+    file_url = None
+    share_links = []
+    if tmp is not None:
+        if not reserve_storage(db, user, size_bytes):
+            db.rollback()
+            os.remove(tmp)
+            raise QuotaExceeded()
+        file_url = store_blob(db, tmp, size_bytes, sha256)
+        if share:
+            share_links.append(ShareLink(token=str(uuid.uuid4()), expires_at=datetime.utcnow() + timedelta(hours=ttl_hours)))
+    text_values = pack_text(content) if content is not None else {}
+    upload = Upload(
+        user_id=user.id,
+        type=type_,
+        file_url=file_url,
+        **text_values,
+        size_bytes=size_bytes,
+        filename=filename,
+        sha256=sha256,
+        share_links=share_links,
+        media_status="pending" if file_url else None
+    )
+    db.add(upload)
+    count_uploads(db, user.id, 1)
+    if file_url or content is not None:
+        db.flush()
+    if file_url:
+        enqueue_media_jobs(db, [upload.id])
+    if content is not None:
+        index_texts(db, [(upload.id, content)])
+    db.commit()
+    db.refresh(upload)
+    db.refresh(upload, ["share_links"])  # loaded here so callers on the event loop don't lazy-load
+    return upload
+
+def create_uploads_bulk(db: Session, user, items) -> list:
+    """Persist many uploads in one transaction with a single multi-row INSERT.
+
+    items are dicts with type plus either content or a finished temp file
+    (tmp, size_bytes, sha256), and optionally filename, share and ttl_hours.
+    Returns [(upload_id, share_token or None)] in item order. Raises
+    QuotaExceeded, writing nothing, if the files don't fit the quota.
+    """
+    total = sum(item["size_bytes"] for item in items if item.get("tmp"))
+    if total and not reserve_storage(db, user, total):
+        db.rollback()
+        for item in items:
+            if item.get("tmp") and os.path.exists(item["tmp"]):
+                os.remove(item["tmp"])
+        raise QuotaExceeded()
+    now = datetime.utcnow()
+    rows = []
+    for item in items:
+        tmp = item.get("tmp")
+        content = item.get("content")
+        rows.append({
+            "user_id": user.id,
+            "type": item["type"],
+            "file_url": store_blob(db, tmp, item["size_bytes"], item["sha256"]) if tmp else None,
+            **(pack_text(content) if content is not None else NO_TEXT),  # same keys on every row
+            "size_bytes": item["size_bytes"] if tmp else 0,
+            "filename": item.get("filename"),
+            "sha256": item["sha256"] if tmp else None,
+            "created_at": now,
+            "media_status": "pending" if tmp else None,
+        })
+    ids = db.execute(insert(Upload).returning(Upload.id, sort_by_parameter_order=True), rows).scalars().all()
+    count_uploads(db, user.id, len(ids))
+    tokens, links = [], []
+    for upload_id, item in zip(ids, items):
+        token = None
+        if item.get("tmp") and item.get("share"):
+            token = str(uuid.uuid4())
+            links.append({"token": token, "upload_id": upload_id, "created_at": now,
+                          "expires_at": now + timedelta(hours=item.get("ttl_hours") or 24)})
+        tokens.append(token)
+    if links:
+        db.execute(insert(ShareLink), links)
+    enqueue_media_jobs(db, [upload_id for upload_id, item in zip(ids, items) if item.get("tmp")])
+    index_texts(db, [(upload_id, item["content"]) for upload_id, item in zip(ids, items) if item.get("content") is not None])
+    db.commit()
+    return list(zip(ids, tokens))
+
+def release_blob(db: Session, sha256: str, count: int = 1):
+    # Drop references; zero-ref blobs are reclaimed after commit, by the caller or the maintenance worker
+    db.execute(update(Blob).where(Blob.sha256 == sha256).values(refcount=Blob.refcount - count))
+
+def schedule_file_deletion(db: Session, paths, reason: str):
+    # Queued in the caller's transaction; the maintenance worker removes the files later
+    rows = [{"path": p, "reason": reason, "created_at": datetime.utcnow()} for p in paths if p]
+    if rows:
+        db.execute(insert(PendingDeletion), rows)
+
+def enqueue_media_jobs(db: Session, upload_ids):
+    # Queued in the caller's transaction, so an upload is never committed without its job
+    now = datetime.utcnow()
+    rows = [{"upload_id": i, "status": "queued", "attempts": 0, "run_after": now, "created_at": now} for i in upload_ids]
+    if rows:
+        db.execute(insert(MediaJob), rows)
+
+def reclaim_blobs(db: Session, shas) -> int:
+    """Delete blobs whose refcount dropped to zero, returning how many were removed."""
+    removed = 0
+    for sha256 in set(shas):
+        # Row lock is held while the file goes, so a concurrent upload of the same
+        # bytes either revives the blob first or writes a fresh one afterwards
+        blob = db.query(Blob).filter(Blob.sha256 == sha256, Blob.refcount <= 0).with_for_update().first()
+        if blob:
+            file_store.delete(blob.path)
+            db.delete(blob)
+            removed += 1
+        db.commit()
+    return removed
+
+def migrate_legacy_files(db: Session, batch_size: int = 100) -> int:
+    """Move flat uploads/{item}_{user}.{ext} files into the blob store.
+
+    The old file is removed once the row points at its blob.
+    """
+    migrated = 0
+    last_id = 0
+    while True:
+        uploads = (
+            db.query(Upload)
+            .filter(Upload.id > last_id, Upload.file_url.isnot(None), Upload.sha256.is_(None))
+            .order_by(Upload.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not uploads:
+            break
+        for upload in uploads:
+            legacy_path = upload.file_url
+            tmp = temp_path()
+            try:
+                with legacy_files.open(legacy_path) as src:
+                    size, sha256 = copy_stream(src, tmp)
+            except FileNotFoundError:
+                continue
+            upload.file_url = store_blob(db, tmp, size, sha256)
+            upload.sha256 = sha256
+            upload.size_bytes = size
+            upload.filename = upload.filename or os.path.basename(legacy_path)
+            db.commit()
+            legacy_files.delete(legacy_path)
+            migrated += 1
+        last_id = uploads[-1].id
+    return migrated
+
+# Moving files into the keyed, sharded layout (manage.py migrate-storage).
+# Both steps can run while the app serves traffic: a row only changes once its
+# bytes exist under the new key, and old paths are queued for the maintenance
+# worker to delete rather than removed under a request that may still read them.
+
+def _place(legacy_path: str, key: str) -> bool:
+    """Make sure key holds the bytes at legacy_path; False if the old file is gone."""
+    if file_store.exists(key):
+        return True
+    tmp = temp_path()
+    try:
+        with legacy_files.open(legacy_path) as src:
+            copy_stream(src, tmp)
+    except FileNotFoundError:
+        return False
+    file_store.put(key, tmp)
+    return True
+
+def _retire(db: Session, legacy_path: str, key: str):
+    if file_store.local_path(key) != legacy_path:
+        schedule_file_deletion(db, [legacy_path], reason="storage_migrated")
+
+def rekey_legacy_paths(db: Session, batch_size: int = 100, pause: float = 0.0) -> dict:
+    """Rewrite blob and profile photo rows that still hold uploads/... paths as file store keys."""
+    stats = {"blobs": 0, "photos": 0, "missing": 0}
+    last = ""
+    while True:
+        rows = db.execute(
+            select(Blob.sha256, Blob.path)
+            .where(Blob.sha256 > last, Blob.path.like(LEGACY_PREFIX + "%"))
+            .order_by(Blob.sha256)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        for sha256, path in rows:
+            key = blob_key(sha256)
+            if not _place(path, key):
+                stats["missing"] += 1
+                continue
+            db.execute(update(Blob).where(Blob.sha256 == sha256).values(path=key))
+            db.execute(update(Upload).where(Upload.sha256 == sha256).values(file_url=key))
+            _retire(db, path, key)
+            stats["blobs"] += 1
+        db.commit()
+        last = rows[-1].sha256
+        time.sleep(pause)
+    last_id = 0
+    while True:
+        # ORM updates, so the principal cache drops the old photo path
+        users = (
+            db.query(User)
+            .filter(User.id > last_id, User.profile_photo.like(LEGACY_PREFIX + "%"))
+            .order_by(User.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not users:
+            break
+        for user in users:
+            path = user.profile_photo
+            key = f"photos/{os.path.basename(path)}"
+            if not _place(path, key):
+                stats["missing"] += 1
+                continue
+            user.profile_photo = key
+            _retire(db, path, key)
+            stats["photos"] += 1
+        db.commit()
+        last_id = users[-1].id
+        time.sleep(pause)
+    return stats
+
+def copy_store(source, target, namespaces=("blobs", "photos", "exports", "variants", "texts"), batch_size: int = 100, pause: float = 0.0) -> dict:
+    """Copy everything in source to target, skipping keys target already holds at the same size.
+
+    Rows need no change, since keys mean the same thing on every backend.
+    Safe to re-run; the last run after switching STORAGE_BACKEND picks up
+    anything written to the old backend in the meantime.
+    """
+    stats = {"copied": 0, "skipped": 0, "bytes": 0}
+    for namespace in namespaces:
+        for key, size, _ in source.list(namespace):
+            try:
+                if target.stat(key)[0] == size:
+                    stats["skipped"] += 1
+                    continue
+            except FileNotFoundError:
+                pass
+            tmp = temp_path()
+            try:
+                with source.open(key) as src:
+                    copy_stream(src, tmp)
+            except FileNotFoundError:
+                continue  # deleted since it was listed
+            target.put(key, tmp)
+            stats["copied"] += 1
+            stats["bytes"] += size
+            if stats["copied"] % batch_size == 0:
+                time.sleep(pause)
+    return stats
+
+def reconcile_storage(db: Session, batch_size: int = 1000):
+    """Rebuild Upload.size_bytes from the stored files, then User.storage_used and uploads_count."""
+    updated = 0
+    last_id = 0
+    while True:
+        rows = db.execute(
+            select(Upload.id, Upload.file_url, Upload.size_bytes)
+            .where(Upload.id > last_id, Upload.file_url.isnot(None))
+            .order_by(Upload.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        for upload_id, file_url, size_bytes in rows:
+            try:
+                actual = file_store.stat(file_url)[0]
+            except FileNotFoundError:
+                actual = 0
+            if actual != size_bytes:
+                db.execute(update(Upload).where(Upload.id == upload_id).values(size_bytes=actual))
+                updated += 1
+        db.commit()
+        last_id = rows[-1][0]
+    totals = (
+        select(func.coalesce(func.sum(Upload.size_bytes), 0))
+        .where(Upload.user_id == User.id)
+        .scalar_subquery()
+    )
+    counts = select(func.count(Upload.id)).where(Upload.user_id == User.id).scalar_subquery()
+    db.execute(update(User).values(storage_used=totals, uploads_count=counts))
+    db.commit()
+    return updated
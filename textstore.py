@@ -0,0 +1,160 @@
+from sqlalchemy.orm import undefer
+import uuid
+import zlib
+from config import UPLOAD_CHUNK_SIZE, TEXT_INLINE_MAX, TEXT_SPILL_BYTES, TEXT_COMPRESSION, TEXT_COMPRESSION_LEVEL
+from models import Upload
+from filestore import file_store
+
+# Size-tiered storage for text uploads. A text row is in one of three tiers:
+#   inline      content holds the text; content_encoding is NULL
+#   compressed  content_blob (deferred) holds the compressed UTF-8 bytes
+#   spilled     the compressed bytes live in the file store at content_key (texts/<uuid>.<ext>)
+# Codecs are named after their HTTP content codings, "zstd" and "deflate" (zlib
+# format, which is what HTTP calls deflate), so stored bytes can go to clients
+# that accept that coding without being decompressed. content_length is the UTF-8
+# size before compression, and content_preview the first PREVIEW_CHARS + 1
+# characters, so listings never decompress anything.
+#
+# Rows written before tiering are inline whatever their size; the compress_text
+# maintenance job moves them into the right tier.
+
+PREVIEW_CHARS = 100
+EXTENSIONS = {"zstd": "zst", "deflate": "zz"}
+MIN_SAVING = 0.1  # texts that compress worse than this stay inline
+
+# Columns (and loader options) needed by read_text / iter_text
+TEXT_COLUMNS = (Upload.content, Upload.content_encoding, Upload.content_blob, Upload.content_key)
+LOAD_TEXT = (undefer(Upload.content), undefer(Upload.content_blob))
+NO_TEXT = dict.fromkeys(("content", "content_encoding", "content_blob", "content_key", "content_length", "content_preview"))
+
+def _zstd():
+    import zstandard  # optional dependency, only needed for the zstd codec
+    return zstandard
+
+def default_encoding() -> str:
+    if TEXT_COMPRESSION != "auto":
+        return TEXT_COMPRESSION
+    try:
+        _zstd()
+        return "zstd"
+    except ImportError:
+        return "deflate"
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return _zstd().ZstdCompressor(level=TEXT_COMPRESSION_LEVEL).compress(data)
+    if encoding == "deflate":
+        return zlib.compress(data, TEXT_COMPRESSION_LEVEL)
+    raise ValueError(f"Unknown text encoding {encoding!r}")
+
+def iter_decompress(chunks, encoding: str):
+    if encoding == "zstd":
+        decompressor = _zstd().ZstdDecompressor().decompressobj()
+    elif encoding == "deflate":
+        decompressor = zlib.decompressobj()
+    else:
+        raise ValueError(f"Unknown text encoding {encoding!r}")
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+def pack_text(text: str, encoding: str = None) -> dict:
+    """Column values holding text in the tier its size calls for.
+
+    Spilled texts are written to the file store here, before the row that
+    owns them commits; if it never does, the orphan scan removes the file.
+    """
+    data = text.encode("utf-8")
+    values = dict(NO_TEXT, content=text, content_length=len(data))
+    if len(data) <= TEXT_INLINE_MAX:
+        return values
+    encoding = encoding or default_encoding()
+    packed = compress(data, encoding)
+    if len(packed) > len(data) * (1 - MIN_SAVING):
+        return values
+    values.update(content=None, content_encoding=encoding, content_preview=text[:PREVIEW_CHARS + 1])
+    if len(packed) <= TEXT_SPILL_BYTES:
+        values["content_blob"] = packed
+        return values
+    from storage import temp_path  # storage imports this module
+    key = f"texts/{uuid.uuid4().hex}.{EXTENSIONS[encoding]}"
+    tmp = temp_path()
+    with open(tmp, "wb") as f:
+        f.write(packed)
+    file_store.put(key, tmp)
+    values["content_key"] = key
+    return values
+
+def iter_stored(row):
+    """The stored bytes of a compressed or spilled text, as they are (still compressed)."""
+    if row.content_key:
+        with file_store.open(row.content_key) as f:
+            while True:
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    elif row.content_blob is not None:
+        yield bytes(row.content_blob)
+
+def read_text(row) -> str:
+    """The full text of a row loaded with TEXT_COLUMNS (or LOAD_TEXT); None for file uploads."""
+    if row.content_encoding is None:
+        return row.content
+    return b"".join(iter_decompress(iter_stored(row), row.content_encoding)).decode("utf-8")
+
+def read_text_head(row, max_chars: int) -> str:
+    """At most the first max_chars characters, decompressing no more than needed."""
+    if row.content_encoding is None:
+        return row.content[:max_chars] if row.content is not None else None
+    head = bytearray()
+    chunks = iter_decompress(iter_stored(row), row.content_encoding)
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= max_chars * 4:  # UTF-8 is at most 4 bytes a character
+            chunks.close()
+            break
+    return head.decode("utf-8", errors="ignore")[:max_chars]
+
+def accepts_encoding(accept_encoding: str, coding: str) -> bool:
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() in (coding, "*"):
+            q = params.strip()
+            try:
+                return not (q.startswith("q=") and float(q[2:]) == 0)
+            except ValueError:
+                return False
+    return False
+
+def iter_text(row, accept_encoding: str = ""):
+    """(content coding or None, iterator of body bytes) for sending a text to a client.
+
+    The stored bytes go out untouched when the client accepts their coding;
+    otherwise they are decompressed as they stream.
+    """
+    if row.content_encoding is None:
+        return None, iter([(row.content or "").encode("utf-8")])
+    if accepts_encoding(accept_encoding, row.content_encoding):
+        return row.content_encoding, iter_stored(row)
+    return None, iter_decompress(iter_stored(row), row.content_encoding)
+
+def compress_existing(db, upload_id: int, encoding: str = None) -> bool:
+    """Move one inline text row into its tier; False if it stays inline or changed underneath."""
+    row = db.query(Upload).options(undefer(Upload.content)).filter(
+        Upload.id == upload_id, Upload.content_encoding.is_(None), Upload.content.isnot(None)
+    ).first()
+    if row is None:
+        return False
+    values = pack_text(row.content, encoding)
+    if values["content_encoding"] is None:
+        if row.content_length is None:
+            row.content_length = values["content_length"]
+        return False
+    for name, value in values.items():
+        setattr(row, name, value)
+    return True
@@ -1,24 +1,34 @@
 from fastapi import HTTPException, status, Request, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy import select
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 import jwt
 import uuid
 from passlib.context import CryptContext
 from bcrypt import hashpw, gensalt, checkpw
 import os
-from datetime import datetime, timedelta
-from slowapi import Limiter
-from slowapi.util import get_remote_address
-from database import get_db
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from database import get_db, get_async_db
 import models
+from principal_cache import principal_cache
 
 # Env vars
 SECRET_KEY = os.getenv("SECRET_KEY", str(uuid.uuid4()))
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", 64))
 
-# Rate limiter
-limiter = Limiter(key_func=get_remote_address)
+def naive_utc(value: datetime):
+    # Timestamps are stored as naive UTC; query bounds given with an offset are converted
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
 
 # JWT utils
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -27,7 +37,40 @@ def verify_password(plain_password, hashed_password):
     return checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
 def get_password_hash(password):
-    return hashpw(password.encode('utf-8'), gensalt()).decode('utf-8')
+    return hashpw(password.encode('utf-8'), gensalt(BCRYPT_ROUNDS)).decode('utf-8')
+
+def password_needs_rehash(hashed_password):
+    # bcrypt hashes look like $2b$<cost>$<salt+hash>
+    try:
+        return int(hashed_password.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+# bcrypt is deliberately slow, so async handlers run it on a small dedicated pool.
+# At most PASSWORD_HASH_WORKERS hashes run at once and PASSWORD_HASH_QUEUE more may
+# wait; beyond that callers get a 503 instead of piling up behind the pool.
+_hash_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_hash_slots = asyncio.Semaphore(PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE)
+_inflight_verifies = {}
+
+async def _run_hash(fn, *args):
+    if _hash_slots.locked():
+        raise HTTPException(status_code=503, detail="Server busy, try again", headers={"Retry-After": "1"})
+    async with _hash_slots:
+        return await asyncio.get_running_loop().run_in_executor(_hash_pool, fn, *args)
+
+async def verify_password_async(plain_password, hashed_password):
+    # Identical concurrent checks (same password against the same hash) share one bcrypt run
+    key = (hashed_password, hashlib.sha256(plain_password.encode('utf-8')).digest())
+    future = _inflight_verifies.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_run_hash(verify_password, plain_password, hashed_password))
+        _inflight_verifies[key] = future
+        future.add_done_callback(lambda _: _inflight_verifies.pop(key, None))
+    return await asyncio.shield(future)
+
+async def get_password_hash_async(password):
+    return await _run_hash(get_password_hash, password)
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -47,25 +90,53 @@ def get_current_user(
         token = request.cookies.get("access_token")
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
+    return user_from_token(token, db)
+
+def user_from_token(token: str, db: Session):
+    """The principal for a JWT access token; raises HTTPException(401) if it is invalid."""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise HTTPException(status_code=401, detail="Invalid token")
-        user = db.query(models.User).filter(models.User.username == username).first()
+        user = principal_cache.get("username", username)
         if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
+            db_user = db.query(models.User).filter(models.User.username == username).first()
+            if db_user is None:
+                raise HTTPException(status_code=401, detail="User not found")
+            user = principal_cache.put(db_user)
         return user
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-async def api_key_auth(request: Request, db: Session = Depends(get_db)):
+async def api_key_auth(request: Request, db: AsyncSession = Depends(get_async_db)):
     auth = request.headers.get("Authorization")
     if not auth or not auth.startswith("Bearer "):
         raise HTTPException(status_code=403, detail="Authorization required")
     api_key = auth.split(" ")[1]
-    user = db.query(models.User).filter(models.User.api_key == api_key).first()
-    if not user:
-        raise HTTPException(status_code=403, detail="Invalid API key")
+    user = principal_cache.get("api_key", api_key)
+    if user is None:
+        db_user = (await db.execute(select(models.User).where(models.User.api_key == api_key))).scalar_one_or_none()
+        if not db_user:
+            raise HTTPException(status_code=403, detail="Invalid API key")
+        user = principal_cache.put(db_user)
     request.state.user_id = user.id  # Store user_id for middleware
     return user
+
+def get_current_user_or_api_key(
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer(auto_error=False)),
+    db: Session = Depends(get_db)
+):
+    # File links are fetched both by API clients (API key) and by the dashboard (JWT cookie)
+    if credentials and credentials.credentials.count(".") != 2:
+        api_key = credentials.credentials
+        user = principal_cache.get("api_key", api_key)
+        if user is None:
+            db_user = db.query(models.User).filter(models.User.api_key == api_key).first()
+            if not db_user:
+                raise HTTPException(status_code=403, detail="Invalid API key")
+            user = principal_cache.put(db_user)
+        request.state.user_id = user.id
+        return user
+    return get_current_user(credentials, request, db)